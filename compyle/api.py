@@ -9,11 +9,14 @@ from .ext_module import ExtModule
 from .extern import Extern
 from .low_level import Kernel, LocalMem, Cython, cast
 from .parallel import (
-    Elementwise, Reduction, Scan, elementwise
+    Elementwise, Histogram, Reduction, Scan, SegmentedReduction, compile_all,
+    elementwise, fuse, synchronize
 )
 from .profile import (
-    get_profile_info, named_profile, profile, profile_ctx, print_profile,
-    profile_kernel, ProfileContext, profile2csv
+    clear_build_records, get_build_records, get_profile_info,
+    get_throughput_info, measure_bandwidth, named_profile, profile,
+    profile_ctx, print_build_summary, print_profile, profile_kernel,
+    ProfileContext, profile2csv, start_trace, stop_trace
 )
 from .translator import (
     CConverter, CStructHelper, OpenCLConverter, detect_type, ocl_detect_type,
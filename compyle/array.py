@@ -1,6 +1,7 @@
 import numpy as np
 import math
-import mako.template as mkt
+import numbers
+import weakref
 import time
 from pytools import memoize, memoize_method
 
@@ -8,9 +9,12 @@ from .config import get_config
 from .types import (annotate, dtype_to_ctype, ctype_to_dtype, declare,
                     dtype_to_knowntype, knowntype_to_ctype)
 from .template import Template
-from .sort import radix_sort
+from .sort import can_radix_sort, radix_sort, segment_radix_keys
+from .memory_pool import (get_allocator as get_pool_allocator,
+                          get_cl_memory_pool, get_memory_pool)
 from .profile import profile
-from .parallel import Elementwise
+from .parallel import (Elementwise, Reduction, SegmentedReduction,
+                       get_index_dtype)
 
 try:
     import pycuda
@@ -40,183 +44,6 @@ def get_backend(backend=None):
         return backend
 
 
-minmax_tpl = """
-
-    WITHIN_KERNEL ${dtype} mmc_neutral()
-    {
-        ${dtype} result;
-
-        % for prop in prop_names:
-        % if not only_max:
-        result.cur_min_${prop} = ${inf};
-        % endif
-        % if not only_min:
-        result.cur_max_${prop} = -${inf};
-        % endif
-        % endfor
-
-        return result;
-    }
-
-    WITHIN_KERNEL ${dtype} mmc_from_scalar(${args})
-    {
-        ${dtype} result;
-
-        % for prop in prop_names:
-        % if not only_max:
-        result.cur_min_${prop} = ${prop};
-        % endif
-        % if not only_min:
-        result.cur_max_${prop} = ${prop};
-        % endif
-        % endfor
-
-        return result;
-    }
-
-    WITHIN_KERNEL ${dtype} agg_mmc(${dtype} a, ${dtype} b)
-    {
-        ${dtype} result = a;
-
-        % for prop in prop_names:
-        % if not only_max:
-        if (b.cur_min_${prop} < result.cur_min_${prop})
-            result.cur_min_${prop} = b.cur_min_${prop};
-        % endif
-        % if not only_min:
-        if (b.cur_max_${prop} > result.cur_max_${prop})
-            result.cur_max_${prop} = b.cur_max_${prop};
-        % endif
-        % endfor
-
-        return result;
-    }
-
-    """
-
-
-minmax_operator_tpl = """
-
-    __device__ ${dtype} volatile &operator=(
-        ${dtype} const &src) volatile
-    {
-        % for prop in prop_names:
-        % if not only_max:
-        this->cur_min_${prop} = src.cur_min_${prop};
-        % endif
-        % if not only_min:
-        this->cur_max_${prop} = src.cur_max_${prop};
-        % endif
-        % endfor
-        return *this;
-    }
-"""
-
-
-def minmax_collector_key(device, dtype, props, name, *args):
-    return (device, dtype, tuple(props), name)
-
-
-@memoize(key=minmax_collector_key)
-def make_collector_dtype(device, dtype, props, name, only_min, only_max,
-                         backend):
-    fields = [("pad", np.int32)]
-
-    for prop in props:
-        if not only_min:
-            fields.append(("cur_max_%s" % prop, dtype))
-        if not only_max:
-            fields.append(("cur_min_%s" % prop, dtype))
-
-    custom_dtype = np.dtype(fields)
-
-    if backend == 'opencl':
-        from pyopencl.tools import get_or_register_dtype, match_dtype_to_c_struct
-    elif backend == 'cuda':
-        from compyle.cuda import match_dtype_to_c_struct
-        from pycuda.tools import get_or_register_dtype
-
-    custom_dtype, c_decl = match_dtype_to_c_struct(device, name, custom_dtype)
-    custom_dtype = get_or_register_dtype(name, custom_dtype)
-
-    return custom_dtype, c_decl
-
-
-@memoize(key=lambda *args: (args[-3], args[-2], args[-1]))
-def get_minmax_kernel(ctx, dtype, inf, mmc_dtype, prop_names,
-                      only_min, only_max, name, mmc_c_decl, backend):
-    tpl_args = ", ".join(
-        ["%(dtype)s %(prop)s" % {'dtype': dtype, 'prop': prop}
-            for prop in prop_names]
-    )
-
-    if backend == 'cuda':
-        # overload assignment operator in struct
-        mmc_overload = mkt.Template(text=minmax_operator_tpl).render(
-            prop_names=prop_names, dtype=name,
-            only_min=only_min, only_max=only_max
-        )
-        mmc_c_decl_lines = mmc_c_decl.splitlines()
-        mmc_c_decl_lines = mmc_c_decl_lines[:-2] + \
-            mmc_overload.splitlines() + mmc_c_decl_lines[-2:]
-        mmc_c_decl = '\n'.join(mmc_c_decl_lines)
-
-    mmc_preamble = mmc_c_decl + minmax_tpl
-    preamble = mkt.Template(text=mmc_preamble).render(
-        args=tpl_args, prop_names=prop_names, dtype=name,
-        only_min=only_min, only_max=only_max, inf=inf
-    )
-
-    map_args = ", ".join(
-        ["%(prop)s[i]" % {'dtype': dtype, 'prop': prop}
-            for prop in prop_names]
-    )
-
-    if backend == 'opencl':
-        knl_args = ", ".join(
-            ["__global %(dtype)s* %(prop)s" % {'dtype': dtype, 'prop': prop}
-                for prop in prop_names]
-        )
-
-        from pyopencl._cluda import CLUDA_PREAMBLE
-        from pyopencl.reduction import ReductionKernel
-
-        cluda_preamble = mkt.Template(text=CLUDA_PREAMBLE).render(
-            double_support=True
-        )
-
-        knl = ReductionKernel(
-            ctx, mmc_dtype, neutral="mmc_neutral()",
-            reduce_expr="agg_mmc(a, b)",
-            map_expr="mmc_from_scalar(%s)" % map_args,
-            arguments=knl_args,
-            preamble='\n'.join([cluda_preamble, preamble])
-        )
-
-    elif backend == 'cuda':
-        knl_args = ", ".join(
-            ["%(dtype)s* %(prop)s" % {'dtype': dtype, 'prop': prop}
-                for prop in prop_names]
-        )
-
-        from pycuda._cluda import CLUDA_PREAMBLE
-        from pycuda.reduction import ReductionKernel
-
-        cluda_preamble = mkt.Template(text=CLUDA_PREAMBLE).render(
-            double_support=True
-        )
-
-        knl = ReductionKernel(
-            mmc_dtype, neutral="mmc_neutral()",
-            reduce_expr="agg_mmc(a, b)",
-            map_expr="mmc_from_scalar(%s)" % map_args,
-            arguments=knl_args,
-            preamble='\n'.join([cluda_preamble, preamble])
-        )
-
-    return knl
-
-
 def wrap_array(arr, backend):
     if isinstance(arr, Array):
         if arr.backend == backend:
@@ -278,16 +105,29 @@ def wrap(*args, **kw):
         return [wrap_array(x, backend) for x in args]
 
 
+def _get_alloc_kw(backend):
+    allocator = get_pool_allocator(backend)
+    return {} if allocator is None else dict(allocator=allocator)
+
+
+def _np_empty(n, dtype):
+    if get_config().use_memory_pool:
+        return get_memory_pool('cython').empty(n, dtype)
+    else:
+        return np.empty(n, dtype=dtype)
+
+
 def to_device(array, backend='cython'):
     if backend == 'cython':
         out = array
     elif backend == 'opencl':
         import pyopencl.array as gpuarray
         from .opencl import get_queue
-        out = gpuarray.to_device(get_queue(), array)
+        out = gpuarray.to_device(get_queue(), array,
+                                 **_get_alloc_kw(backend))
     elif backend == 'cuda':
         import pycuda.gpuarray as gpuarray
-        out = gpuarray.to_gpu(array)
+        out = gpuarray.to_gpu(array, **_get_alloc_kw(backend))
     return wrap_array(out, backend)
 
 
@@ -301,7 +141,8 @@ def ones_like(array, backend=None):
         import pycuda.gpuarray as gpuarray
         out = gpuarray.ones_like(array.dev)
     else:
-        out = np.ones_like(array.dev)
+        out = _np_empty(len(array.dev), array.dev.dtype)
+        out.fill(1)
     return wrap_array(out, backend)
 
 
@@ -309,12 +150,14 @@ def ones(n, dtype, backend='cython'):
     if backend == 'opencl':
         import pyopencl.array as gpuarray
         from .opencl import get_queue
-        out = 1 + gpuarray.zeros(get_queue(), n, dtype)
+        out = 1 + gpuarray.zeros(get_queue(), n, dtype,
+                                 **_get_alloc_kw(backend))
     elif backend == 'cuda':
         import pycuda.gpuarray as gpuarray
-        out = 1 + gpuarray.zeros(n, dtype)
+        out = 1 + gpuarray.zeros(n, dtype, **_get_alloc_kw(backend))
     else:
-        out = np.ones(n, dtype=dtype)
+        out = _np_empty(n, dtype)
+        out.fill(1)
     return wrap_array(out, backend)
 
 
@@ -322,12 +165,12 @@ def empty(n, dtype, backend='cython'):
     if backend == 'opencl':
         import pyopencl.array as gpuarray
         from .opencl import get_queue
-        out = gpuarray.empty(get_queue(), n, dtype)
+        out = gpuarray.empty(get_queue(), n, dtype, **_get_alloc_kw(backend))
     elif backend == 'cuda':
         import pycuda.gpuarray as gpuarray
-        out = gpuarray.empty(n, dtype)
+        out = gpuarray.empty(n, dtype, **_get_alloc_kw(backend))
     else:
-        out = np.empty(n, dtype=dtype)
+        out = _np_empty(n, dtype)
     return wrap_array(out, backend)
 
 
@@ -339,12 +182,13 @@ def zeros(n, dtype, backend='cython'):
     if backend == 'opencl':
         import pyopencl.array as gpuarray
         from .opencl import get_queue
-        out = gpuarray.zeros(get_queue(), n, dtype)
+        out = gpuarray.zeros(get_queue(), n, dtype, **_get_alloc_kw(backend))
     elif backend == 'cuda':
         import pycuda.gpuarray as gpuarray
-        out = gpuarray.zeros(n, dtype)
+        out = gpuarray.zeros(n, dtype, **_get_alloc_kw(backend))
     else:
-        out = np.zeros(n, dtype=dtype)
+        out = _np_empty(n, dtype)
+        out.fill(0)
     return wrap_array(out, backend)
 
 
@@ -358,7 +202,8 @@ def zeros_like(array, backend=None):
         import pycuda.gpuarray as gpuarray
         out = gpuarray.zeros_like(array.dev)
     else:
-        out = np.zeros_like(array.dev)
+        out = _np_empty(len(array.dev), array.dev.dtype)
+        out.fill(0)
     return wrap_array(out, backend)
 
 
@@ -367,7 +212,7 @@ def arange(start, stop, step, dtype=np.int32, backend='cython'):
         import pyopencl.array as gpuarray
         from .opencl import get_queue
         out = gpuarray.arange(get_queue(), start, stop,
-                              step, dtype=dtype)
+                              step, dtype=dtype, **_get_alloc_kw(backend))
     elif backend == 'cuda':
         import pycuda.gpuarray as gpuarray
         out = gpuarray.arange(start, stop, step, dtype=dtype)
@@ -376,35 +221,37 @@ def arange(start, stop, step, dtype=np.int32, backend='cython'):
     return wrap_array(out, backend)
 
 
+@annotate
+def linspace_elwise(i, out, start, delta):
+    out[i] = start + i*delta
+
+
+@memoize
+def linspace_kernel(backend, dtype):
+    e = Elementwise(linspace_elwise, backend=backend)
+    return e
+
+
 def linspace(start, stop, num, dtype=np.float64, backend='opencl',
-             endpoint=True):
+             endpoint=True, out=None):
     if not type(num) == int:
         raise TypeError("num should be an integer but got %s" % type(num))
     if num <= 0:
         raise ValueError("Number of samples, %s, must be positive." % num)
-    if backend == 'opencl':
-        import pyopencl.array as gpuarray
-        from .opencl import get_queue
-        if endpoint:
-            delta = (stop-start)/(num-1)
-        else:
-            delta = (stop-start)/num
-        out = gpuarray.arange(get_queue(), 0, num,
-                              1, dtype=dtype)
-        out = out * delta+start
-    elif backend == 'cuda':
-        import pycuda.gpuarray as gpuarray
-        import pycuda.autoinit
-        if endpoint:
-            delta = (stop-start)/(num-1)
-        else:
-            delta = (stop-start)/num
-        out = gpuarray.arange(0, num, 1, dtype=dtype)
-        out = out*delta+start
-    else:
-        out = np.linspace(start, stop, num,
-                          endpoint=endpoint, dtype=dtype)
-    return wrap_array(out, backend)
+    if out is None:
+        if backend == 'cython':
+            out = np.linspace(start, stop, num,
+                              endpoint=endpoint, dtype=dtype)
+            return wrap_array(out, backend)
+        out = empty(num, dtype, backend=backend)
+    elif out.length != num:
+        raise ValueError(
+            "out should have length %s but got %s" % (num, out.length))
+    n_intervals = num - 1 if endpoint else num
+    delta = (stop - start)/n_intervals if n_intervals > 0 else 0.0
+    e = linspace_kernel(out.backend, out.dtype)
+    e(out, float(start), float(delta))
+    return out
 
 
 @annotate
@@ -425,11 +272,12 @@ def diff_kernel(backend, dtype):
     return e
 
 
-def diff(a, n, backend=None):
+def diff(a, n, backend=None, out=None):
     """
-    calculate the first discrete difference of the given array.
+    calculate the n-th discrete difference of the given array.
 
-    The first difference is given by ``out[i] = a[i+1] - a[i]``
+    The first difference is given by ``out[i] = a[i+1] - a[i]``.  The result
+    is stored in `out` if it is given.
     """
     if n == 0:
         return a
@@ -444,15 +292,22 @@ def diff(a, n, backend=None):
     if backend is None:
         backend = a.backend
 
-    if backend == 'opencl' or backend == 'cuda':
-        from compyle.api import Elementwise
+    if backend == 'opencl' or backend == 'cuda' or out is not None:
         binom_coeff = np.zeros(n+1)
         sign_fac = 1 if (n % 2 == 0) else -1
         for i in range(n+1):
             binom_coeff[i] = choose(n, i) * (-1)**i * sign_fac
         binom_coeff = wrap(binom_coeff, backend=backend)
         len_ar = len(a)
-        y = zeros(len_ar - n, dtype=a.dtype, backend=backend)
+        if out is None:
+            y = zeros(len_ar - n, dtype=a.dtype, backend=backend)
+        elif out.length != len_ar - n:
+            raise ValueError(
+                "out should have length %s but got %s" % (len_ar - n,
+                                                          out.length))
+        else:
+            y = out
+            y.fill(0)
         e = diff_kernel(backend, a.dtype)
         e(y, a, binom_coeff, len(binom_coeff))
         return y
@@ -540,7 +395,7 @@ def where_kernel(backend, dtype):
     return e
 
 
-def where(condition, x, y, backend=None):
+def where(condition, x, y, backend=None, out=None):
     if backend is None:
         backend = x.backend
         if y.backend is not x.backend:
@@ -553,13 +408,39 @@ def where(condition, x, y, backend=None):
                 x.dtype, y.dtype))
 
     e = where_kernel(backend, x.dtype)
-    ans = empty(x.length, dtype=x.dtype, backend=backend)
-    e(condition, x, y, ans)
-    return ans
+    if out is None:
+        out = empty(x.length, dtype=x.dtype, backend=backend)
+    e(condition, x, y, out)
+    return out
+
+
+def _cl_ordered_key(dtype, name):
+    """Return the OpenCL expression for the unsigned integer that orders the
+    key `name` of the given type like the radix sort on Cython.
+    """
+    dtype = np.dtype(dtype)
+    bits = 8 * dtype.itemsize
+    utype = dtype_to_ctype(np.dtype('u%d' % dtype.itemsize))
+    if dtype.kind == 'f':
+        u = 'as_%s(%s)' % (utype, name)
+        return '((%s >> %d) ? ~%s : %s | ((%s)1 << %d))' % (
+            u, bits - 1, u, u, utype, bits - 1
+        )
+    elif dtype.kind == 'i':
+        return '((%s)%s ^ ((%s)1 << %d))' % (
+            utype, name, utype, bits - 1
+        )
+    return name
 
 
-@memoize(key=lambda *args: tuple(args[0]))
-def get_cl_sort_kernel(arg_types, ary_list):
+def _cl_key_dtype(dtype):
+    return np.uint64 if np.dtype(dtype).itemsize == 8 else np.uint32
+
+
+@memoize(key=lambda arg_types, ary_list, index_dtype=np.int32: (
+    tuple(arg_types) + (np.dtype(index_dtype),)
+))
+def get_cl_sort_kernel(arg_types, ary_list, index_dtype=np.int32):
     import pyopencl as cl
     from pyopencl.scan import GenericScanKernel
     import pyopencl.algorithm
@@ -572,36 +453,64 @@ def get_cl_sort_kernel(arg_types, ary_list):
     sort_args = [arg.replace('GLOBAL_MEM', '__global')
                  for arg in sort_args]
 
+    # Signed integer and floating point keys are sorted by their bits mapped
+    # to unsigned integers with the same order.
+    key_dtype = ary_list[0].dtype
+    key_expr = _cl_ordered_key(key_dtype, "ary_0[i]")
+
     sort_knl = cl.algorithm.RadixSort(
         get_context(),
         sort_args,
-        scan_kernel=GenericScanKernel, key_expr="ary_0[i]",
-        sort_arg_names=arg_names
+        scan_kernel=GenericScanKernel, key_expr=key_expr,
+        sort_arg_names=arg_names, index_dtype=index_dtype,
+        key_dtype=_cl_key_dtype(key_dtype)
     )
 
     return sort_knl
 
 
-@memoize(key=lambda q: q)
-def get_allocator(queue):
+@memoize(key=lambda dtype, index_dtype: (
+    np.dtype(dtype), np.dtype(index_dtype)
+))
+def get_cl_segmented_sort_kernel(dtype, index_dtype):
+    """Return the OpenCL radix sort of the indices by the segment ids and
+    then the keys of the given type which must be at most 32 bits wide.
+    """
     import pyopencl as cl
+    from pyopencl.scan import GenericScanKernel
+    import pyopencl.algorithm
+    from compyle.opencl import get_context
 
-    allocator = cl.tools.MemoryPool(
-        cl.tools.ImmediateAllocator(queue)
+    args = ['__global %s *keys' % dtype_to_ctype(dtype),
+            '__global int *seg_ids',
+            '__global %s *indices' % dtype_to_ctype(index_dtype)]
+    key_expr = '(((ulong)seg_ids[i]) << 32) | (ulong)%s' % (
+        _cl_ordered_key(dtype, 'keys[i]')
+    )
+    return cl.algorithm.RadixSort(
+        get_context(), args, scan_kernel=GenericScanKernel,
+        key_expr=key_expr, sort_arg_names=['indices'],
+        index_dtype=index_dtype, key_dtype=np.uint64
     )
 
-    return allocator
+
+def get_allocator(queue):
+    return get_cl_memory_pool(queue).allocator
 
 
 @profile
 def sort_by_keys(ary_list, out_list=None, key_bits=None,
-                 backend=None, use_radix_sort=False):
+                 backend=None, use_radix_sort=None):
     # FIXME: Need to use returned values, cuda backend uses
     # thrust that will internally allocate a new array for storing
     # the sorted data so out_list will not have the sorted arrays
     # first arg of ary_list is the key
     if backend is None:
         backend = ary_list[0].backend
+    if use_radix_sort is None:
+        # The parallel radix sort is used for integer and floating point keys
+        # on Cython.
+        use_radix_sort = can_radix_sort(ary_list[0].dtype)
     if backend == 'opencl':
         from .jit import get_ctype_from_arg
         from compyle.opencl import get_queue
@@ -615,10 +524,16 @@ def sort_by_keys(ary_list, out_list=None, key_bits=None,
         arg_types = [get_ctype_from_arg(arg, backend=backend)
                      for arg in ary_list]
 
-        sort_knl = get_cl_sort_kernel(arg_types, ary_list)
+        sort_knl = get_cl_sort_kernel(
+            arg_types, ary_list, get_index_dtype(ary_list[0].length)
+        )
         allocator = get_allocator(get_queue())
 
         arg_list = [ary.dev for ary in ary_list]
+        # Signed and float keys are mapped to unsigned integers whose high
+        # bits are set, so `key_bits` would drop the bits that matter.
+        if ary_list[0].dtype.kind in 'fi':
+            key_bits = None
 
         out_arrays, event = sort_knl(*arg_list, key_bits=key_bits,
                                      allocator=allocator)
@@ -644,70 +559,283 @@ def sort_by_keys(ary_list, out_list=None, key_bits=None,
         return [ary_list[0]] + out_list
 
 
-def argsort(ary, backend=None):
-    # FIXME: Implement an OpenCL backend and add tests
-    # NOTE: argsort also sorts the array
+def argsort(ary, backend=None, inplace=True):
+    """Return the permutation that sorts `ary`.
+
+    The sort is stable on Cython and OpenCL.  If `inplace` is True, `ary` is
+    also sorted.  On OpenCL integer and float32/float64 keys are supported.
+    Like ``numpy.argsort``, the permutation is an ``intp`` array on Cython
+    and CUDA, on OpenCL it has the index type of the kernels.
+    """
     if backend is None:
         backend = ary.backend
-    if backend == 'cython':
-        result = np.argsort(ary.dev)
-        ary.dev = np.take(ary.dev, result)
+    if backend == 'cython' and can_radix_sort(ary.dtype):
+        (result,), order = radix_sort([ary], backend=backend,
+                                      index_dtype=np.intp)
+        if inplace:
+            ary.set_data(result.dev)
+        return order
+    elif backend == 'cython':
+        result = np.argsort(ary.dev, kind='stable')
+        if inplace:
+            ary.dev = np.take(ary.dev, result)
         return wrap_array(result, backend=backend)
     elif backend == 'cuda':
         from compyle.cuda import argsort
-        return argsort(ary)
+        # The input is sorted along with the permutation.
+        return argsort(ary if inplace else ary.copy())
+    elif backend == 'opencl':
+        indices = arange(0, ary.length, 1, dtype=get_index_dtype(ary.length),
+                         backend=backend)
+        result, order = sort_by_keys([ary, indices], backend=backend)
+        if inplace:
+            ary.set_data(result.dev)
+        return order
     else:
-        raise ValueError("Only cython and cuda backends supported")
+        raise ValueError("Unsupported backend %s" % backend)
+
+
+@annotate(i='int', gintp='seg_ids, offsets', n_segments='int')
+def segment_ids_elwise(i, seg_ids, offsets, n_segments):
+    lo, hi, mid = declare('int', 3)
+    lo = 0
+    hi = n_segments
+    while hi - lo > 1:
+        mid = (lo + hi) >> 1
+        if offsets[mid] <= i:
+            lo = mid
+        else:
+            hi = mid
+    seg_ids[i] = lo
 
 
-def update_minmax_gpu(ary_list, only_min=False, only_max=False,
-                      backend=None):
-    if not backend:
+@memoize
+def segment_ids_kernel(backend):
+    return Elementwise(segment_ids_elwise, backend=backend)
+
+
+@annotate
+def segment_rank_elwise(i, seg_ids, order, n, out):
+    # The rank does not fit in an int when there are many segments.
+    seg = declare('long')
+    seg = seg_ids[order[i]]
+    out[i] = seg * n + i
+
+
+@memoize
+def segment_rank_kernel(backend):
+    return Elementwise(segment_rank_elwise, backend=backend)
+
+
+def segmented_argsort(keys, offsets, backend=None):
+    """Return the permutation that sorts `keys` within each segment.
+
+    The segment ``s`` is made of the elements ``offsets[s]`` to
+    ``offsets[s + 1] - 1`` where `offsets` is an int32 array of the
+    ``n_segments + 1`` offsets starting with 0 and ending with the number of
+    keys.  The elements stay in their segment and, as for ``argsort``, the
+    sort is stable on Cython and OpenCL.
+
+    The keys are sorted in a single pass by the segment id and then the key
+    on Cython if the segment ids and the range of the keys fit in 64 bits,
+    and on OpenCL if the keys are at most 32 bits wide.  Otherwise the keys
+    are sorted and then the segment ids of the sorted keys along with their
+    position.
+    """
+    if backend is None:
+        backend = keys.backend
+    if offsets.dtype != np.int32:
+        raise ValueError('offsets must be an int32 array')
+    n_segments = offsets.length - 1
+    if keys.length == 0 or n_segments < 2:
+        return argsort(keys, backend=backend, inplace=False)
+    seg_ids = empty(keys.length, np.int32, backend=backend)
+    segment_ids_kernel(backend)(seg_ids, offsets, n_segments)
+    if backend == 'cython' and can_radix_sort(keys.dtype):
+        seg_keys = segment_radix_keys(keys, seg_ids, n_segments)
+        if seg_keys is not None:
+            return argsort(seg_keys, backend=backend, inplace=False)
+    elif backend == 'opencl' and keys.dtype.itemsize <= 4:
+        from compyle.opencl import get_queue
+        index_dtype = get_index_dtype(keys.length)
+        indices = arange(0, keys.length, 1, dtype=index_dtype,
+                         backend=backend)
+        sort_knl = get_cl_segmented_sort_kernel(keys.dtype, index_dtype)
+        (order,), event = sort_knl(
+            keys.dev, seg_ids.dev, indices.dev,
+            key_bits=32 + int(n_segments - 1).bit_length(),
+            allocator=get_allocator(get_queue())
+        )
+        out = Array(index_dtype, allocate=False, backend=backend)
+        out.set_data(order)
+        return out
+    # Sort by the keys and then by the segment ids of the sorted keys along
+    # with their position which does not need a stable sort.
+    order = argsort(keys, backend=backend, inplace=False)
+    ranks = empty(keys.length, np.int64, backend=backend)
+    segment_rank_kernel(backend)(seg_ids, order, keys.length, ranks)
+    seg_order = argsort(ranks, backend=backend, inplace=False)
+    return take(order, seg_order, backend=backend)
+
+
+def segmented_sort(ary_list, offsets, out_list=None, backend=None):
+    """Sort the arrays in `ary_list` by the keys in the first array within
+    each segment given by `offsets`, see ``segmented_argsort``.
+
+    Returns the list of sorted arrays which are stored in `out_list` if it is
+    passed.
+    """
+    if backend is None:
         backend = ary_list[0].backend
+    order = segmented_argsort(ary_list[0], offsets, backend=backend)
+    return align(ary_list, order, out_list=out_list, backend=backend)
 
-    if only_min and only_max:
-        raise ValueError("Only one of only_min and only_max can be True")
 
-    props = ['ary_%s' % i for i in range(len(ary_list))]
+@annotate
+def key_change_elwise(i, keys, flags):
+    if i == 0 or keys[i] != keys[i - 1]:
+        flags[i] = 1
+    else:
+        flags[i] = 0
 
-    dtype = ary_list[0].dtype
-    ctype = dtype_to_ctype(dtype, backend=backend)
 
-    op = 'min' if not only_max else ''
-    op += 'max' if not only_min else ''
-    name = "%s_collector_%s" % (op, ''.join([ctype] + props))
+@annotate
+def segment_start_elwise(i, keys, flags, seg_ids, offsets, unique_keys):
+    if flags[i] == 1:
+        offsets[seg_ids[i] - 1] = i
+        unique_keys[seg_ids[i] - 1] = keys[i]
+
+
+@memoize
+def key_change_kernel(backend):
+    return Elementwise(key_change_elwise, backend=backend)
+
+
+@memoize
+def segment_start_kernel(backend):
+    return Elementwise(segment_start_elwise, backend=backend)
+
+
+def segment_offsets(keys, backend=None):
+    """Return the offsets of the runs of equal keys in `keys` along with the
+    key of each run.
+
+    The offsets are an array of the ``n_segments + 1`` offsets of the runs
+    starting with 0 and ending with the number of keys as used by
+    ``SegmentedReduction``.  The keys are usually sorted so that every key
+    makes up a single run.
+    """
+    if backend is None:
+        backend = keys.backend
+    n = keys.length
+    index_dtype = get_index_dtype(n)
+    if n == 0:
+        return (zeros(1, index_dtype, backend=backend),
+                empty(0, keys.dtype, backend=backend))
+    flags = empty(n, index_dtype, backend=backend)
+    key_change_kernel(backend)(keys, flags)
+    seg_ids = cumsum(flags, backend=backend)
+    n_segments = int(seg_ids[-1])
+    offsets = empty(n_segments + 1, index_dtype, backend=backend)
+    unique_keys = empty(n_segments, keys.dtype, backend=backend)
+    segment_start_kernel(backend)(
+        keys, flags, seg_ids, offsets, unique_keys
+    )
+    offsets[n_segments] = n
+    return offsets, unique_keys
+
+
+@memoize
+def reduce_by_key_kernel(reduce_expr, neutral, dtype, backend):
+    return SegmentedReduction(reduce_expr, dtype_out=dtype, neutral=neutral,
+                              backend=backend)
 
-    if backend == 'opencl':
-        from compyle.opencl import get_context
-        ctx = get_context()
-        device = ctx.devices[0]
-    elif backend == 'cuda':
-        ctx = None
-        device = None
 
-    mmc_dtype, mmc_c_decl = make_collector_dtype(device,
-                                                 dtype, props, name,
-                                                 only_min, only_max,
-                                                 backend)
+def reduce_by_key(keys, values, reduce_expr='a+b', neutral='0',
+                  backend=None):
+    """Reduce the `values` of each run of equal `keys` with `reduce_expr`.
+
+    Returns the key of each run and the reduced values of the run.  The keys
+    are usually sorted so that all the values of a key are reduced together.
+    """
+    if backend is None:
+        backend = keys.backend
+    offsets, unique_keys = segment_offsets(keys, backend=backend)
+    knl = reduce_by_key_kernel(reduce_expr, neutral, values.dtype, backend)
+    return unique_keys, knl(values, offsets=offsets)
+
+
+def _get_item_func(index, dtype, backend):
+    # A map function returning the element of the array with the given index.
+    name = 'item_%d' % index
+    src = 'def {name}(i, ary_{k}):\n    return ary_{k}[i]\n'.format(
+        name=name, k=index
+    )
+    namespace = {'__name__': __name__}
+    exec(src, namespace)
+    func = namespace[name]
+    func.source = src
+    return annotate(func, i='int', return_=dtype_to_knowntype(dtype),
+                    **{'ary_%d' % index: dtype_to_knowntype(dtype, 'global')})
+
+
+@memoize
+def minmax_kernel(n_arrays, dtype, only_min, only_max, backend):
+    """Return a Reduction that finds the minimum and/or the maximum of
+    `n_arrays` arrays of the given type in one pass.
 
+    The fields of the result are named ``min_<index>`` and ``max_<index>``.
+    """
     if np.issubdtype(dtype, np.floating):
-        inf = np.finfo(dtype).max
+        big, small = 'INFINITY', '-INFINITY'
     else:
-        inf = np.iinfo(dtype).max
-
-    knl = get_minmax_kernel(ctx, ctype, inf, mmc_dtype, props,
-                            only_min, only_max, name, mmc_c_decl,
-                            backend)
+        info = np.iinfo(dtype)
+        big = str(info.max)
+        # The most negative integer is not a valid literal.
+        small = '(%d - 1)' % (info.min + 1) if info.min else '0'
+    fields, map_funcs, reduce_exprs, neutral = [], [], [], []
+    for index in range(n_arrays):
+        item = _get_item_func(index, dtype, backend)
+        if not only_max:
+            fields.append(('min_%d' % index, dtype))
+            map_funcs.append(item)
+            reduce_exprs.append('min(a, b)')
+            neutral.append(big)
+        if not only_min:
+            fields.append(('max_%d' % index, dtype))
+            map_funcs.append(item)
+            reduce_exprs.append('max(a, b)')
+            neutral.append(small)
+    return Reduction(tuple(reduce_exprs), map_func=tuple(map_funcs),
+                     dtype_out=np.dtype(fields), neutral=tuple(neutral),
+                     backend=backend)
+
+
+def update_minmax(ary_list, only_min=False, only_max=False, backend=None):
+    """Set the ``minimum`` and ``maximum`` attributes of the arrays in
+    `ary_list`, which must be of the same type, in one pass over them.
+    """
+    if not backend:
+        backend = ary_list[0].backend
 
-    args = [ary.dev for ary in ary_list]
+    if only_min and only_max:
+        raise ValueError("Only one of only_min and only_max can be True")
 
-    result = knl(*args).get()
+    knl = minmax_kernel(len(ary_list), ary_list[0].dtype, only_min, only_max,
+                        backend)
+    result = knl(*ary_list)
 
-    for ary, prop in zip(ary_list, props):
+    for index, ary in enumerate(ary_list):
         if not only_max:
-            ary.minimum = result["cur_min_%s" % prop]
+            ary.minimum = result['min_%d' % index]
         if not only_min:
-            ary.maximum = result["cur_max_%s" % prop]
+            ary.maximum = result['max_%d' % index]
+
+
+def update_minmax_gpu(ary_list, only_min=False, only_max=False,
+                      backend=None):
+    update_minmax(ary_list, only_min=only_min, only_max=only_max,
+                  backend=backend)
 
 
 @annotate
@@ -725,6 +853,7 @@ def take(ary, indices, backend=None, out=None):
         take_knl = parallel.Elementwise(take_elwise, backend=backend)
         take_knl(indices, ary, out)
     elif backend == 'cython':
+        out._evaluate_dependents()
         np.take(ary.dev, indices.dev, out=out.dev)
     return out
 
@@ -753,7 +882,10 @@ def cumsum(ary, backend=None, out=None):
         cumsum_scan(ary=ary, out=out)
         return out
     elif backend == 'cython':
-        _out = out.dev if out is not None else out
+        _out = None
+        if out is not None:
+            out._evaluate_dependents()
+            _out = out.dev
         output = np.cumsum(ary.dev, out=_out)
         return wrap_array(output, backend)
 
@@ -770,14 +902,22 @@ def take_bool_kernel(backend, dtype_ar):
     return e
 
 
-def take_bool(ary, condition, backend=None):
+def take_bool(ary, condition, backend=None, out=None):
+    """Return the elements of `ary` where `condition` is true.
+
+    If `out` is given, it is resized to the number of selected elements and
+    the result is stored in it.
+    """
     if backend is None:
         backend = ary.backend
     cumsum_ar = cumsum(condition, backend=backend)
-    out_ar = ones(cumsum_ar[-1], ary.dtype, backend=backend)
+    if out is None:
+        out = empty(cumsum_ar[-1], ary.dtype, backend=backend)
+    else:
+        out.resize(cumsum_ar[-1])
     e = take_bool_kernel(backend, ary.dtype)
-    e(condition, ary, cumsum_ar, out_ar)
-    return out_ar
+    e(condition, ary, cumsum_ar, out)
+    return out
 
 
 class AlignMultiple(Template):
@@ -837,64 +977,67 @@ def align(ary_list, order, out_list=None, backend=None):
     return out_list
 
 
-def gt_elwise(i, x, val, ans):
-    ans[i] = x[i] > val
-
-
-def lt_elwise(i, x, val, ans):
-    ans[i] = x[i] < val
-
-
-def ge_elwise(i, x, val, ans):
-    ans[i] = x[i] >= val
+class ExpressionTemplate(Template):
+    """Generates the elementwise function ``out[i] = expr`` where `expr` is
+    an expression of the arguments ``a0, a1, ...``.
+    """
+    def __init__(self, name, expr, out_type, arg_types):
+        super(ExpressionTemplate, self).__init__(name=name)
+        self.expr = expr
+        self.out_type = out_type
+        self.arg_types = arg_types
 
+    def extra_args(self):
+        args = ['a%d' % num for num in range(len(self.arg_types))]
+        annotations = dict(zip(args, self.arg_types))
+        annotations.update(i='int', out=self.out_type)
+        return ['out'] + args, annotations
 
-def le_elwise(i, x, val, ans):
-    ans[i] = x[i] <= val
+    def template(self, i):
+        '''
+        out[i] = ${obj.expr}
+        '''
 
 
-def eq_elwise(i, x, val, ans):
-    ans[i] = x[i] == val
+_comparison_ops = ('>', '<', '>=', '<=', '==', '!=')
 
+_arithmetic_ops = ('+', '-', '*', '/')
 
-def ne_elwise(i, x, val, ans):
-    ans[i] = x[i] is not val
 
+def key_expression_kernel(expr, backend, out_type, arg_types):
+    return (expr, backend, out_type, arg_types, get_config().use_openmp)
 
-@memoize
-def comparison_kernel(func, backend, ary_type, other_type):
-    func_annotated = annotate(func, i='int', x=ary_type,
-                              val=other_type, ans='intp')
-    e = Elementwise(func_annotated, backend=backend)
-    return e
 
+@memoize(key=key_expression_kernel)
+def expression_kernel(expr, backend, out_type, arg_types):
+    template = ExpressionTemplate('array_expression', expr, out_type,
+                                  arg_types)
+    return Elementwise(template.function, backend=backend)
 
-def comparison_template(func, other, arr, backend=None):
-    if backend is None:
-        backend = arr.backend
-    from compyle.parallel import Elementwise
-    other_type = dtype_to_ctype(type(other))
-    ary_type = dtype_to_ctype(arr.dtype) + 'p'
-    ans = empty(arr.length, dtype=np.int32, backend=arr.backend)
-    e = comparison_kernel(func, arr.backend, ary_type, other_type)
-    e(arr, other, ans)
-    return ans
 
+def _is_scalar(x):
+    return isinstance(x, numbers.Number)
 
-@annotate
-def add_elwise(i, a, b, out):
-    out[i] = a[i] + b[i]
 
+def binary_op(op, a, b, out=None):
+    """Compute ``a op b`` elementwise.
 
-@memoize
-def add_kernel(backend, dtype):
-    e = Elementwise(add_elwise, backend=backend)
-    return e
+    One of `a` or `b` may be a scalar, which is passed to the kernel as is
+    instead of being broadcast to an array.  Without `out` the result is a
+    lazy ``ArrayExpression``.  With `out` the result is computed right away
+    and stored in `out`, which may also be one of the operands.
 
+    Parameters
+    ----------
 
-@annotate
-def sub_elwise(i, a, b, out):
-    out[i] = a[i] - b[i]
+    op: str: one of '+', '-', '*', '/', '>', '<', '>=', '<=', '==', '!='.
+    a, b: Array or scalar: the operands.
+    out: Array: optional array to store the result in.
+    """
+    expr = ArrayExpression(op, a, b)
+    if out is None:
+        return expr
+    return expr.evaluate(out=out)
 
 
 class Array(object):
@@ -911,6 +1054,8 @@ class Array(object):
         self.data = None
         self._data = None
         self.dev = None
+        # Unevaluated expressions that use this array, see ArrayExpression.
+        self._dependents = None
         if allocate:
             length = n
             if n == 0:
@@ -939,6 +1084,7 @@ class Array(object):
             return self.dev[key]
 
     def __setitem__(self, key, value):
+        self._evaluate_dependents()
         if self.backend == 'cuda':
             if isinstance(key, slice):
                 if isinstance(value, np.ndarray):
@@ -950,56 +1096,90 @@ class Array(object):
         else:
             self.dev[key] = value
 
-    def __add__(self, other):
-        if isinstance(other, Array):
-            e = add_kernel(self.backend, self.dtype)
-            out = empty_like(self)
-            e(self, other, out)
-            return out
+    def _binary_op(self, op, other, reflected=False):
+        if not (isinstance(other, Array) or _is_scalar(other)):
+            return NotImplemented
+        if reflected:
+            return ArrayExpression(op, other, self)
         else:
+            return ArrayExpression(op, self, other)
+
+    def _inplace_op(self, op, other):
+        if not (isinstance(other, Array) or _is_scalar(other)):
             return NotImplemented
+        return ArrayExpression(op, self, other).evaluate(out=self)
+
+    def __add__(self, other):
+        return self._binary_op('+', other)
 
     def __sub__(self, other):
-        if isinstance(other, Array):
-            e = Elementwise(sub_elwise, backend=self.backend)
-            out = empty_like(self)
-            e(self, other, out)
-            return out
-        else:
-            return NotImplemented
+        return self._binary_op('-', other)
+
+    def __mul__(self, other):
+        return self._binary_op('*', other)
+
+    def __truediv__(self, other):
+        return self._binary_op('/', other)
 
     def __radd__(self, other):
-        if isinstance(other, Array):
-            other = other.dev
-        ans = other + self.dev
-        return wrap_array(ans, self.backend)
+        return self._binary_op('+', other, reflected=True)
 
     def __rsub__(self, other):
-        if isinstance(other, Array):
-            other = other.dev
-        ans = other - self.dev
-        return wrap_array(ans, self.backend)
+        return self._binary_op('-', other, reflected=True)
+
+    def __rmul__(self, other):
+        return self._binary_op('*', other, reflected=True)
+
+    def __rtruediv__(self, other):
+        return self._binary_op('/', other, reflected=True)
+
+    def __iadd__(self, other):
+        return self._inplace_op('+', other)
+
+    def __isub__(self, other):
+        return self._inplace_op('-', other)
+
+    def __imul__(self, other):
+        return self._inplace_op('*', other)
+
+    def __itruediv__(self, other):
+        return self._inplace_op('/', other)
 
     def __str__(self):
         return self.dev.__str__()
 
     def __gt__(self, other):
-        return comparison_template(gt_elwise, other, self)
+        return self._binary_op('>', other)
 
     def __lt__(self, other):
-        return comparison_template(lt_elwise, other, self)
+        return self._binary_op('<', other)
 
     def __ge__(self, other):
-        return comparison_template(ge_elwise, other, self)
+        return self._binary_op('>=', other)
 
     def __le__(self, other):
-        return comparison_template(le_elwise, other, self)
+        return self._binary_op('<=', other)
 
     def __eq__(self, other):
-        return comparison_template(eq_elwise, other, self)
+        return self._binary_op('==', other)
 
     def __ne__(self, other):
-        return comparison_template(ne_elwise, other, self)
+        return self._binary_op('!=', other)
+
+    def _add_dependent(self, expr):
+        if self._dependents is None:
+            self._dependents = weakref.WeakValueDictionary()
+        self._dependents[id(expr)] = expr
+
+    def _evaluate_dependents(self, exclude=None):
+        """Evaluate the expressions that use this array before it is
+        modified.
+        """
+        if self._dependents:
+            for expr in list(self._dependents.values()):
+                if expr is not exclude:
+                    expr.evaluate()
+            self._dependents.clear()
 
     def _update_array_ref(self):
         # For PyCUDA compatibility
@@ -1047,16 +1227,19 @@ class Array(object):
         self.data[:] = self.get()
 
     def push(self):
+        self._evaluate_dependents()
         if self.backend == 'opencl' or self.backend == 'cuda':
             self._data.set(self._get_np_data())
             self.set_data(self._data)
 
     def resize(self, size):
+        self._evaluate_dependents()
         self.reserve(size)
         self.length = size
         self._update_array_ref()
 
     def reserve(self, size):
+        self._evaluate_dependents()
         if size > self.alloc:
             new_data = empty(size, self.dtype, backend=self.backend)
             # For PyCUDA compatibility
@@ -1069,6 +1252,10 @@ class Array(object):
     def set_data(self, data):
         # data can be an Array instance or
         # a numpy/cl array/cuda array
+        self._evaluate_dependents()
+        self._set_data(data)
+
+    def _set_data(self, data):
         if isinstance(data, Array):
             data = data.dev
         self._data = data
@@ -1090,18 +1277,14 @@ class Array(object):
 
     @profile
     def update_min_max(self, only_min=False, only_max=False):
-        if self.backend == 'cython':
-            self.minimum = minimum(self, backend=self.backend)
-            self.maximum = maximum(self, backend=self.backend)
-            self.minimum = self.minimum.astype(self.dtype)
-            self.maximum = self.maximum.astype(self.dtype)
-        else:
-            update_minmax_gpu([self])
+        update_minmax([self], only_min=only_min, only_max=only_max)
 
     def fill(self, value):
+        self._evaluate_dependents()
         self.dev.fill(value)
 
     def append(self, value):
+        self._evaluate_dependents()
         if self.length >= self.alloc:
             self.reserve(2 * self.length)
         self._data[self.length] = np.asarray(value, dtype=self.dtype)
@@ -1109,6 +1292,7 @@ class Array(object):
         self._update_array_ref()
 
     def extend(self, ary):
+        self._evaluate_dependents()
         if self.length + len(ary.dev) > self.alloc:
             self.reserve(self.length + len(ary.dev))
         self._data[-len(ary.dev):] = ary.dev
@@ -1177,6 +1361,171 @@ class Array(object):
                 not isinstance(dest, Array):
             raise TypeError('indices and dest need to be \
                     Array instances')
+        dest._evaluate_dependents()
         dest.dev[:len(indices.dev)] = take(
             self, indices, backend=self.backend
         ).dev
+
+
+class ArrayExpression(Array):
+    """An elementwise expression of Arrays and scalars that is evaluated
+    lazily.
+
+    The arithmetic and comparison operators of an Array return an
+    ArrayExpression.  Combining expressions builds up a tree of operations
+    which is only evaluated when the data of the result is needed, for
+    example when it is passed to a kernel or ``get`` is called.  The whole
+    tree is then computed by a single generated Elementwise kernel, so
+    ``a*b + c - d`` makes one pass over memory without any temporaries.  The
+    kernels are cached by the shape of the expression and the types of the
+    operands.
+
+    Modifying an operand with the in-place operators, ``fill``, item
+    assignment, methods like ``set``, ``set_data`` and ``resize`` or by
+    passing it to a kernel first evaluates the expressions that use it.
+    Writes to a view of an operand are not tracked.
+    """
+    def __init__(self, op, a, b):
+        if op not in _arithmetic_ops and op not in _comparison_ops:
+            raise ValueError('Unsupported operator %r.' % op)
+        for x in (a, b):
+            if not (isinstance(x, Array) or _is_scalar(x)):
+                raise TypeError(
+                    'Operand should be an Array or a scalar, got %s.' %
+                    type(x)
+                )
+        arrays = [x for x in (a, b) if isinstance(x, Array)]
+        if not arrays:
+            raise TypeError('At least one operand should be an Array.')
+        ary = arrays[0]
+        for x in arrays[1:]:
+            if x.backend != ary.backend:
+                raise TypeError(
+                    'Operands should have the same backend, got %s and %s.' %
+                    (ary.backend, x.backend)
+                )
+            if x.length != ary.length:
+                raise ValueError(
+                    'Operands have different lengths: %d and %d.' % (
+                        ary.length, x.length
+                    )
+                )
+        self.op = op
+        self.operands = (a, b)
+        self.compute_dtype = np.result_type(
+            *[x.dtype if isinstance(x, Array) else x for x in (a, b)]
+        )
+        if op in _comparison_ops:
+            dtype = np.dtype(np.int32)
+        elif op == '/' and not np.issubdtype(self.compute_dtype, np.inexact):
+            dtype = self.compute_dtype = np.dtype(np.float64)
+        else:
+            dtype = self.compute_dtype
+        self.backend = ary.backend
+        self.dtype = dtype
+        self.gptr_type = dtype_to_knowntype(dtype, address='global',
+                                            backend=self.backend)
+        self.minimum = 0
+        self.maximum = 0
+        self.length = ary.length
+        self._dependents = None
+        for x in arrays:
+            x._add_dependent(self)
+
+    def __getattr__(self, name):
+        # The data is only allocated when the expression is evaluated.
+        if name in ('dev', '_data', 'data', 'alloc'):
+            self.evaluate()
+            return object.__getattribute__(self, name)
+        raise AttributeError(name)
+
+    def __len__(self):
+        return self.length
+
+    @property
+    def is_evaluated(self):
+        return self.op is None
+
+    def _get_code(self, args, types):
+        # Returns the code of the expression and collects the arguments of
+        # the kernel and their types.
+        code = []
+        for x in self.operands:
+            if isinstance(x, ArrayExpression) and not x.is_evaluated:
+                code.append(x._get_code(args, types))
+            elif isinstance(x, Array):
+                for num, arg in enumerate(args):
+                    if arg is x:
+                        break
+                else:
+                    num = len(args)
+                    args.append(x)
+                    types.append(x.gptr_type)
+                code.append('a%d[i]' % num)
+            else:
+                code.append('a%d' % len(args))
+                args.append(self.compute_dtype.type(x))
+                types.append(dtype_to_knowntype(self.compute_dtype,
+                                                backend=self.backend))
+        if self.op == '/' and all(
+                isinstance(x, Array) and
+                not np.issubdtype(x.dtype, np.inexact)
+                for x in self.operands):
+            # Avoid an integer division.
+            code[0] = '1.0*' + code[0]
+        return '(%s %s %s)' % (code[0], self.op, code[1])
+
+    def evaluate(self, out=None):
+        """Compute the expression and return the result.
+
+        The result is stored in `out` if it is given, otherwise the
+        expression itself holds the result after this.
+        """
+        if out is None and self.is_evaluated:
+            return self
+        if out is not None:
+            if out.length != self.length:
+                raise ValueError(
+                    'Output should have length %d, got %d.' % (
+                        self.length, out.length
+                    )
+                )
+            if self.op not in _comparison_ops and \
+                    not np.can_cast(self.dtype, out.dtype, 'same_kind'):
+                raise TypeError(
+                    'Cannot store the result of type %s in an output of '
+                    'type %s.' % (self.dtype, out.dtype)
+                )
+            out._evaluate_dependents(exclude=self)
+        args, types = [], []
+        expr = self._get_code(args, types)
+        if out is None:
+            data = empty(self.length, self.dtype, backend=self.backend)
+        else:
+            data = out
+        e = expression_kernel(expr, self.backend, data.gptr_type,
+                              tuple(types))
+        # The operands are only read by the kernel, so their dependents need
+        # not be evaluated when they are passed to it.
+        arrays = [x for x in args if isinstance(x, Array)]
+        dependents = [x._dependents for x in arrays]
+        for x in arrays:
+            x._dependents = None
+        try:
+            e(data, *args)
+        finally:
+            for x, deps in zip(arrays, dependents):
+                x._dependents = deps
+        if out is not None:
+            return out
+        for x in arrays:
+            x._dependents.pop(id(self), None)
+        # The expressions that use this one compute it themselves or read
+        # the result, so they need not be evaluated.
+        self._set_data(data)
+        # As for ``wrap_array``, this is the numpy array on Cython.
+        self.data = data.data
+        # Release the operands as they are no longer needed.
+        self.op = None
+        self.operands = None
+        return self
@@ -174,3 +174,40 @@ def has_return(code):
     """Returns True of the node has a return statement.
     """
     return has_node(code, ast.Return)
+
+
+def get_array_access(code):
+    """Given an AST or code string return how the names that are indexed are
+    accessed.
+
+    Returns a dictionary mapping each name that is indexed to a tuple of two
+    booleans, ``(read, written)``.  An augmented assignment to an element
+    both reads and writes it.
+
+    Parameters
+    ----------
+
+    code: A code string or the result of an ast.parse.
+
+    """
+    tree = _get_tree(code)
+    read, written = set(), set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Subscript):
+            base = node.value
+            while isinstance(base, (ast.Subscript, ast.Attribute)):
+                base = base.value
+            if not isinstance(base, ast.Name):
+                continue
+            if isinstance(node.ctx, ast.Store):
+                written.add(base.id)
+            else:
+                read.add(base.id)
+        if isinstance(node, ast.AugAssign):
+            for n in ast.walk(node.target):
+                if isinstance(n, ast.Subscript) and \
+                   isinstance(n.value, ast.Name):
+                    read.add(n.value.id)
+    return dict(
+        (name, (name in read, name in written)) for name in read | written
+    )
@@ -18,6 +18,10 @@ class Config(object):
         self._use_local_memory = None
         self._wgs = None
         self._suppress_warnings = None
+        self._use_kernel_index = None
+        self._async_launch = None
+        self._use_memory_pool = None
+        self._index_type = None
 
     @property
     def suppress_warnings(self):
@@ -32,6 +36,69 @@ class Config(object):
     def _suppress_warnings_default(self):
         return False
 
+    @property
+    def use_kernel_index(self):
+        """Use the on-disk index of compiled Cython kernels to avoid
+        generating code for kernels that were compiled earlier.
+        """
+        if self._use_kernel_index is None:
+            self._use_kernel_index = self._use_kernel_index_default()
+        return self._use_kernel_index
+
+    @use_kernel_index.setter
+    def use_kernel_index(self, value):
+        self._use_kernel_index = value
+
+    def _use_kernel_index_default(self):
+        return True
+
+    @property
+    def async_launch(self):
+        """Do not wait for OpenCL/CUDA kernels to finish after each launch.
+        Synchronization happens when data is read from the device or when
+        ``compyle.parallel.synchronize`` is called.
+        """
+        if self._async_launch is None:
+            self._async_launch = self._async_launch_default()
+        return self._async_launch
+
+    @async_launch.setter
+    def async_launch(self, value):
+        self._async_launch = value
+
+    def _async_launch_default(self):
+        return False
+
+    @property
+    def use_memory_pool(self):
+        """Allocate the memory of arrays from a pool, see
+        ``compyle.memory_pool``.
+        """
+        if self._use_memory_pool is None:
+            self._use_memory_pool = self._use_memory_pool_default()
+        return self._use_memory_pool
+
+    @use_memory_pool.setter
+    def use_memory_pool(self, value):
+        self._use_memory_pool = value
+
+    def _use_memory_pool_default(self):
+        return True
+
+    @property
+    def index_type(self):
+        """The C type of the index of the generated kernels, one of 'int' or
+        'long'.  If this is None, 'int' is used unless the arrays are too
+        large for it, see ``compyle.parallel.get_index_type``.
+        """
+        return self._index_type
+
+    @index_type.setter
+    def index_type(self, value):
+        if value not in (None, 'int', 'long'):
+            raise ValueError("Invalid index type: {}".format(value))
+        self._index_type = value
+
     @property
     def use_openmp(self):
         if self._use_openmp is None:
@@ -125,6 +192,8 @@ class Config(object):
     @profile.setter
     def profile(self, value):
         self._profile = value
+        if self is _config:
+            _update_profiling()
 
     def _profile_default(self):
         return False
@@ -157,18 +226,28 @@ class Config(object):
 
 
 _config = None
+# Whether the current configuration is profiling.  This is kept up to date so
+# that ``compyle.profile`` can check it at no cost when profiling is off.
+_profiling = False
+
+
+def _update_profiling():
+    global _profiling
+    _profiling = _config is not None and bool(_config.profile)
 
 
 def get_config():
     global _config
     if _config is None:
         _config = Config()
+        _update_profiling()
     return _config
 
 
 def set_config(config):
     global _config
     _config = config
+    _update_profiling()
 
 
 @contextmanager
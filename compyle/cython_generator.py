@@ -14,6 +14,7 @@ except ImportError:
     from ordereddict import OrderedDict
 import inspect
 import logging
+import re
 from textwrap import dedent
 import types
 
@@ -26,6 +27,28 @@ from .utils import getsourcelines
 
 logger = logging.getLogger(__name__)
 
+_atomic_re = re.compile(r'atomic_(inc|dec|add|min|max)\s*\(')
+
+
+def _split_args(args):
+    """Split the arguments of a call at the top level commas."""
+    result = []
+    depth = 0
+    current = ''
+    for char in args:
+        if char in '([{':
+            depth += 1
+        elif char in ')]}':
+            depth -= 1
+        if char == ',' and depth == 0:
+            result.append(current.strip())
+            current = ''
+        else:
+            current += char
+    if current.strip():
+        result.append(current.strip())
+    return result
+
 
 def get_parallel_range(start, stop=None, step=1, **kwargs):
     config = get_config()
@@ -611,27 +634,37 @@ class CythonGenerator(object):
         stmt = '%s = <%s> (%s) %s' % (name, ctype, expr, cmmt)
         return stmt
 
-    def _handle_atomic_statement_inc(self, name, call, is_serial):
-        # FIXME: This won't handle casting to pointers
-        # using something like 'intp'
-        call_arg = call[11:-1].strip()
-        if self._config.use_openmp and not is_serial:
-            return['openmp.omp_set_lock(&cy_lock)',
-                   '%s = %s' % (name, call_arg),
-                   '%s += 1' % call_arg, 'openmp.omp_unset_lock(&cy_lock)']
-        else:
-            return ['%s = %s' % (name, call_arg), '%s += 1' % call_arg]
+    def _handle_atomic_statement(self, name, call, is_serial):
+        """Return the statements for a call to one of the atomic functions.
 
-    def _handle_atomic_statement_dec(self, name, call, is_serial):
-        # FIXME: This won't handle casting to pointers
-        # using something like 'intp'
-        call_arg = call[11:-1].strip()
+        `name` is the variable the old value is assigned to, it may be
+        empty.
+        """
+        func, _, rest = call.partition('(')
+        func = func.strip()
+        args = _split_args(rest[:rest.rindex(')')])
+        expected = 1 if func in ('atomic_inc', 'atomic_dec') else 2
+        if len(args) != expected:
+            raise CodeGenerationError(
+                '%s takes %d arguments, got: %s' % (func, expected, call)
+            )
+        var = args[0]
         if self._config.use_openmp and not is_serial:
-            return['openmp.omp_set_lock(&cy_lock)',
-                   '%s = %s' % (name, call_arg),
-                   '%s -= 1' % call_arg, 'openmp.omp_unset_lock(&cy_lock)']
+            call_args = ', '.join(['&' + var] + args[1:])
+            stmt = 'compyle_%s(%s)' % (func, call_args)
+            return ['%s = %s' % (name, stmt) if name else stmt]
+
+        stmts = ['%s = %s' % (name, var)] if name else []
+        if func == 'atomic_inc':
+            stmts.append('%s += 1' % var)
+        elif func == 'atomic_dec':
+            stmts.append('%s -= 1' % var)
+        elif func == 'atomic_add':
+            stmts.append('%s += %s' % (var, args[1]))
         else:
-            return ['%s = %s' % (name, call_arg), '%s -= 1' % call_arg]
+            op = func[len('atomic_'):]
+            stmts.append('%s = %s(%s, %s)' % (var, op, var, args[1]))
+        return stmts
 
     def _parse_function(self, obj, declarations=None, is_serial=False):
         c_code, py_code = self._get_method_wrapper(obj, indent=' ' * 4,
@@ -674,29 +707,22 @@ class CythonGenerator(object):
                 stmt = self._handle_cast_statement(name, call)
                 indent = line[:line.index(name)]
                 return '', indent + stmt + '\n'
-            elif words[1].startswith('atomic_inc') and \
+            elif _atomic_re.match(words[1]) and \
                     not line.strip().startswith('#'):
                 name = words[0]
-                call = words[1]
-                indent = line[:line.index(name)]
-                stmts = self._handle_atomic_statement_inc(
-                    name, call, is_serial)
-                result = ''
-                for stmt in stmts:
-                    result += indent + stmt + '\n'
-                return '', result + '\n'
-            elif words[1].startswith('atomic_dec') and \
-                    not line.strip().startswith('#'):
-                name = words[0]
-                call = words[1]
+                call = line[line.index('=') + 1:].strip()
                 indent = line[:line.index(name)]
-                stmts = self._handle_atomic_statement_dec(
-                    name, call, is_serial)
+                stmts = self._handle_atomic_statement(name, call, is_serial)
                 result = ''
                 for stmt in stmts:
                     result += indent + stmt + '\n'
                 return '', result + '\n'
             else:
                 return '', line
+        elif _atomic_re.match(line.strip()):
+            call = line.strip()
+            indent = line[:line.index(call)]
+            stmts = self._handle_atomic_statement('', call, is_serial)
+            return '', ''.join(indent + stmt + '\n' for stmt in stmts)
         else:
             return '', line
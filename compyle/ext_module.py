@@ -10,18 +10,22 @@ import io
 import logging
 import numpy
 import os
-from os.path import exists, expanduser, isdir, join
+from os.path import exists, expanduser, isdir, join, splitext
 import platform
+import re
 from pyximport import pyxbuild
 import shutil
 import sys
 import time
+from textwrap import dedent
 
 from Cython.Distutils import Extension
 
 # Package imports.
 from .config import get_config  # noqa: 402
 from .capture_stream import CaptureMultipleStreams  # noqa: 402
+from .profile import (add_build_time, build_phase, build_record,  # noqa: 402
+                      merge_build_record, update_build_record)
 
 
 logger = logging.getLogger(__name__)
@@ -63,6 +67,14 @@ def get_platform_dir():
     )
 
 
+def get_default_root():
+    """Return the default directory used to store generated sources and
+    extension modules.
+    """
+    plat_dir = get_platform_dir()
+    return expanduser(join('~', '.compyle', 'source', plat_dir))
+
+
 def get_ext_extension():
     """Return the system's file extension for Extension modules."""
     vars = get_config_vars()
@@ -75,6 +87,247 @@ def get_md5(data):
     return hashlib.md5(data.encode()).hexdigest()
 
 
+def load_extension(name, path):
+    """Import the extension module called `name` from the given path.
+    """
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class DeferredBuild(Exception):
+    """Raised by ``ExtModule.load`` when builds are deferred using
+    ``defer_builds`` and the module needs to be compiled.
+    """
+    pass
+
+
+# A list of ExtModule instances whose build has been deferred.
+_deferred_builds = None
+
+
+@contextmanager
+def defer_builds():
+    """A context manager inside which ``ExtModule.load`` does not compile any
+    modules. Instead, the modules to be built are collected in the list
+    returned by the context manager and a ``DeferredBuild`` exception is
+    raised.  The modules can later be built together using ``build_all``.
+    """
+    global _deferred_builds
+    orig = _deferred_builds
+    _deferred_builds = []
+    try:
+        yield _deferred_builds
+    finally:
+        _deferred_builds = orig
+
+
+# Bundled extension modules that have been loaded, keyed on their path.
+_bundle_modules = {}
+
+
+def _build_ext_module(kw):
+    kw = dict(kw)
+    use_openmp = kw.pop('use_openmp')
+    get_config().use_openmp = use_openmp
+    mod = ExtModule(**kw)
+    # The record is returned as the build may run in another process.
+    with build_record(name=mod.name, kind='ExtModule', backend='cython',
+                      store=False) as record:
+        record['source_hash'] = mod.hash
+        try:
+            mod.write_and_build()
+        except SystemExit:
+            return False, record
+    return True, record
+
+
+def build_all(ext_modules, n_jobs=None):
+    """Build the given extension modules concurrently.
+
+    The modules are built on a pool of `n_jobs` processes which defaults to
+    the number of CPUs.  Modules with the same source are only built once and
+    the usual locking ensures that no two processes build the same module.
+
+    The records of the builds, see ``compyle.profile.build_record``, are
+    merged into the records of the deferred builds of the modules.
+
+    Returns a list of booleans indicating which modules were built
+    successfully.
+    """
+    use_openmp = get_config().use_openmp
+    jobs = {}
+    for mod in ext_modules:
+        jobs[mod.ext_path] = dict(
+            src=mod.code, extension=mod.extension, root=mod.root,
+            verbose=mod.verbose, depends=mod.depends,
+            extra_inc_dirs=mod.extra_inc_dirs,
+            extra_compile_args=mod.extra_compile_args,
+            extra_link_args=mod.extra_link_args,
+            cython_inc_dirs=mod.cython_inc_dirs,
+            use_openmp=use_openmp
+        )
+    args = list(jobs.values())
+    if n_jobs is None:
+        n_jobs = os.cpu_count() or 1
+    n_jobs = max(1, min(n_jobs, len(args)))
+    if n_jobs == 1:
+        result = [_build_ext_module(kw) for kw in args]
+    else:
+        from multiprocessing import Pool
+        pool = Pool(n_jobs)
+        try:
+            result = pool.map(_build_ext_module, args, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    status = {}
+    for ext_path, (ok, record) in zip(jobs.keys(), result):
+        merge_build_record(record)
+        status[ext_path] = ok
+    return [status[mod.ext_path] for mod in ext_modules]
+
+
+# Matches the name of a function, class or variable defined by a top level
+# Cython statement.
+_def_re = re.compile(r'^(?:cp?def|def)\s[^(=:"]*?(\w+)\s*\(')
+_class_re = re.compile(r'^cdef\s+class\s+(\w+)')
+_var_re = re.compile(r'^cdef\s+[^(=:"]*?(\w+)\s*(?:=.*)?$')
+
+
+def split_source(src):
+    """Split Cython source into its top level statements.
+
+    Returns a list of `(key, code)` pairs where `code` is the statement along
+    with any indented lines that follow it and `key` is the name defined by
+    the statement or the code itself for statements like imports.
+    """
+    units = []
+    for line in src.splitlines():
+        if line and not line[0].isspace():
+            units.append([line])
+        elif units:
+            units[-1].append(line)
+    result = []
+    for lines in units:
+        code = '\n'.join(lines).rstrip()
+        first = lines[0]
+        match = (_class_re.match(first) or _def_re.match(first) or
+                 _var_re.match(first))
+        key = match.group(1) if match else code
+        result.append((key, code))
+    return result
+
+
+def _normalize(code):
+    # Only the relative indentation of the body of a statement matters.
+    first, _, rest = code.partition('\n')
+    return first + '\n' + dedent(rest)
+
+
+class SourceBundle(object):
+    """Merges the sources of several extension modules into one.
+
+    Top level statements that are repeated in the sources, like the imports
+    and helper functions, are only emitted once.  A source cannot be added if
+    it defines a name differently from the sources already in the bundle.
+    """
+    def __init__(self):
+        self.members = []
+        self.units = []
+        self._defs = {}
+
+    def _get_options(self, ext_module):
+        return (
+            ext_module.root, ext_module.extension, ext_module.depends,
+            ext_module.extra_inc_dirs, ext_module.extra_compile_args,
+            ext_module.extra_link_args, ext_module.cython_inc_dirs
+        )
+
+    def add(self, ext_module):
+        """Add the given ExtModule to the bundle, returns False if it conflicts
+        with the existing members.
+        """
+        if self.members and (self._get_options(ext_module) !=
+                             self._get_options(self.members[0])):
+            return False
+        units = split_source(ext_module.code)
+        for key, code in units:
+            old = self._defs.get(key)
+            if old is not None and old != _normalize(code):
+                return False
+        for key, code in units:
+            if key not in self._defs:
+                self._defs[key] = _normalize(code)
+                self.units.append(code)
+        self.members.append(ext_module)
+        return True
+
+    def get_code(self):
+        return '\n\n'.join(self.units) + '\n'
+
+    def get_ext_module(self):
+        """Return an ExtModule for the bundled source.
+        """
+        mod = self.members[0]
+        return ExtModule(
+            self.get_code(), extension=mod.extension, root=mod.root,
+            verbose=mod.verbose, depends=mod.depends,
+            extra_inc_dirs=mod.extra_inc_dirs,
+            extra_compile_args=mod.extra_compile_args,
+            extra_link_args=mod.extra_link_args,
+            cython_inc_dirs=mod.cython_inc_dirs
+        )
+
+
+def make_bundles(ext_modules):
+    """Group the given ExtModules into as few SourceBundles as possible.
+    """
+    bundles = []
+    seen = set()
+    for mod in ext_modules:
+        if mod.ext_path in seen:
+            continue
+        seen.add(mod.ext_path)
+        for bundle in bundles:
+            if bundle.add(mod):
+                break
+        else:
+            bundle = SourceBundle()
+            bundle.add(mod)
+            bundles.append(bundle)
+    return bundles
+
+
+def build_bundles(ext_modules, n_jobs=None):
+    """Build the given extension modules as a few bundled modules.
+
+    The sources are merged using ``make_bundles`` and each bundle is compiled
+    into a single extension module, the bundles themselves are built
+    concurrently using ``build_all``.  Once a bundle is built, loading any of
+    its member modules loads the bundle instead.
+
+    Returns a list of booleans indicating which modules were built
+    successfully.
+    """
+    bundles = make_bundles(ext_modules)
+    to_build = []
+    for bundle in bundles:
+        if len(bundle.members) == 1:
+            to_build.append(bundle.members[0])
+        else:
+            to_build.append(bundle.get_ext_module())
+    result = build_all(to_build, n_jobs=n_jobs)
+    status = {}
+    for bundle, mod, ok in zip(bundles, to_build, result):
+        for member in bundle.members:
+            if ok and member is not mod:
+                member.set_bundle(mod)
+            status[member.ext_path] = ok
+    return [status[mod.ext_path] for mod in ext_modules]
+
+
 def get_openmp_flags():
     """Return the OpenMP flags for the platform.
 
@@ -164,6 +417,7 @@ class ExtModule(object):
         self.src_path = join(self.root, base + '.' + self.extension)
         self.ext_path = join(self.root, base + get_ext_extension())
         self.lock_path = join(self.root, base + '.lock')
+        self.bundle_path = join(self.root, base + '.bundle')
 
     @contextmanager
     def _lock(self, timeout=90):
@@ -189,6 +443,7 @@ class ExtModule(object):
             time.sleep(0.1)
             if _is_timed_out():
                 break
+        update_build_record(lock_wait=time.time() - t1)
         try:
             yield
         finally:
@@ -201,8 +456,7 @@ class ExtModule(object):
 
     def _setup_root(self, root):
         if root is None:
-            plat_dir = get_platform_dir()
-            self.root = expanduser(join('~', '.compyle', 'source', plat_dir))
+            self.root = get_default_root()
         else:
             self.root = root
 
@@ -269,6 +523,7 @@ class ExtModule(object):
                 script_args = []
             else:
                 script_args = ['--verbose']
+            start = time.time()
             try:
                 with CaptureMultipleStreams() as stream:
                     old_lvl = logging.getLogger().level
@@ -294,10 +549,27 @@ class ExtModule(object):
                       "error messages above."
                 print(hline + "\n" + msg)
                 sys.exit(1)
+            self._record_build(start, time.time(), stream.get_output()[0])
             shutil.copy(mod, self.ext_path)
         else:
+            update_build_record(cache='hit', source_hash=self.hash)
             self._message("Precompiled code from:", self.src_path)
 
+    def _record_build(self, start, end, output):
+        # Cython writes the C++ source before it is compiled so its
+        # modification time splits the build into the two phases.
+        try:
+            cpp_mtime = os.stat(splitext(self.src_path)[0] + '.cpp').st_mtime
+        except OSError:
+            cpp_mtime = start
+        cpp_mtime = min(max(cpp_mtime, start), end)
+        add_build_time('cython', cpp_mtime - start)
+        add_build_time('c_compile', end - cpp_mtime)
+        commands = [line for line in output.splitlines()
+                    if ' -o ' in line and self.name in line]
+        update_build_record(cache='miss', source_hash=self.hash,
+                            commands=commands)
+
     def write_source(self):
         """Writes source without compiling. Used for testing"""
         if not exists(self.src_path):
@@ -311,18 +583,54 @@ class ExtModule(object):
                 self._write_source(self.src_path)
                 self.build()
         else:
+            update_build_record(cache='hit', source_hash=self.hash)
             self._message("Precompiled code from:", self.src_path)
 
+    def set_bundle(self, ext_module):
+        """Record that this module is built as part of the given bundled
+        module.
+        """
+        tmp = '%s.%d.tmp' % (self.bundle_path, os.getpid())
+        with io.open(tmp, 'w', encoding='utf-8') as f:
+            f.write(ext_module.name)
+        os.replace(tmp, self.bundle_path)
+
+    def _use_bundle(self):
+        with io.open(self.bundle_path, encoding='utf-8') as f:
+            name = f.read().strip()
+        ext_path = join(self.root, name + get_ext_extension())
+        if not exists(ext_path):
+            return False
+        self.name = name
+        self._setup_filenames()
+        return True
+
     def load(self):
         """Load the built extension module.
 
         Returns
         """
+        with build_record(name=self.name, kind='ExtModule', backend='cython'):
+            return self._load()
+
+    def _load(self):
+        bundled = (not exists(self.ext_path) and exists(self.bundle_path) and
+                   self._use_bundle())
+        if bundled:
+            update_build_record(cache='bundle', source_hash=self.hash)
+            mod = _bundle_modules.get(self.ext_path)
+            if mod is None:
+                with build_phase('load'):
+                    mod = load_extension(self.name, self.ext_path)
+                _bundle_modules[self.ext_path] = mod
+            return mod
+        if _deferred_builds is not None and not exists(self.ext_path):
+            update_build_record(cache='deferred', source_hash=self.hash)
+            _deferred_builds.append(self)
+            raise DeferredBuild(self.name)
         self.write_and_build()
-        spec = importlib.util.spec_from_file_location(self.name, self.ext_path)
-        module = importlib.util.module_from_spec(spec)
-        spec.loader.exec_module(module)
-        return module
+        with build_phase('load'):
+            return load_extension(self.name, self.ext_path)
 
     def _get_extra_args(self):
         ec, el = self.extra_compile_args, self.extra_link_args
@@ -7,14 +7,16 @@ import importlib
 import warnings
 import time
 from pytools import memoize
+from . import config
 from .config import get_config
 from .cython_generator import CythonGenerator
 from .transpiler import Transpiler, BUILTINS
 from .types import (dtype_to_ctype, get_declare_info,
                     dtype_to_knowntype, annotate, BITS, KnownType)
 from .extern import Extern
+from .memory_pool import Workspace
 from .utils import getsourcelines
-from .profile import profile
+from .profile import build_phase, build_record, profile
 
 from . import array
 from . import parallel
@@ -26,9 +28,10 @@ def memoize_kernel(key=lambda *args: args):
             f = args[0].func
             key_val = key(*args)
             if not hasattr(f, 'cached_kernel'):
-                setattr(f, 'cached_kernel', {key_val: method(*args)})
-            elif key_val not in f.cached_kernel:
-                f.cached_kernel[key_val] = method(*args)
+                setattr(f, 'cached_kernel', {})
+            if key_val not in f.cached_kernel:
+                with build_record(args[0]):
+                    f.cached_kernel[key_val] = method(*args)
             return f.cached_kernel[key_val]
         return wrapper
     return memoize_deco
@@ -49,10 +52,19 @@ def get_ctype_from_arg(arg, backend=None):
                 return 'int'
 
 
+def get_arg_ctypes(obj, args):
+    return [get_ctype_from_arg(arg, backend=obj.backend) for arg in args]
+
+
 def kernel_cache_key_args(obj, *args):
-    key = [get_ctype_from_arg(arg, backend=obj.backend) for arg in args]
+    key = get_arg_ctypes(obj, args)
     key.append(obj.func)
     key.append(obj.name)
+    key.append(obj.index_type)
+    # The kernels are cached on the function which may be used by
+    # reductions with different expressions.
+    for attr in ('reduce_expr', 'neutral', 'type'):
+        key.append(getattr(obj, attr, None))
     return tuple(key + list(parallel.get_common_cache_key(obj)))
 
 
@@ -62,6 +74,7 @@ def kernel_cache_key_kwargs(obj, **kwargs):
     key.append(obj.input_func)
     key.append(obj.output_func)
     key.append(obj.scan_expr)
+    key.append(obj.index_type)
     return tuple(key + list(parallel.get_common_cache_key(obj)))
 
 
@@ -155,6 +168,7 @@ class AnnotationHelper(ast.NodeVisitor):
             annotations = getattr(self.func, '__annotations__', {})
             return annotations.get('return', KnownType('double')).type
 
+    @build_phase('annotate')
     def annotate(self):
         if getattr(self.func, 'is_jit', False):
             src = dedent('\n'.join(getsourcelines(self.func)[0]))
@@ -238,9 +252,8 @@ class AnnotationHelper(ast.NodeVisitor):
             return self.visit_declare(node)
         if node.func.id == 'cast':
             return self.visit_cast(node)
-        if node.func.id == 'atomic_inc':
-            return self.visit(node.args[0])
-        if node.func.id == 'atomic_dec':
+        if node.func.id in ('atomic_inc', 'atomic_dec', 'atomic_add',
+                            'atomic_min', 'atomic_max'):
             return self.visit(node.args[0])
         if node.func.id == 'address':
             return self.visit_address(node)
@@ -316,16 +329,21 @@ class ElementwiseJIT(parallel.ElementwiseBase):
         self.cython_gen = CythonGenerator()
         self.source = '# Code jitted, call the function to generate the code.'
         self.all_source = self.source
+        self.index_type = parallel.get_index_type()
+        self._index_variants = {}
+        self.queue = None
         if backend == 'opencl':
             from .opencl import get_context, get_queue
             self.queue = get_queue()
+        if config._profiling:
+            parallel.get_traffic_info(self, self._get_traffic_funcs())
 
     def get_type_info_from_args(self, *args):
         type_info = {}
         arg_names = getargspec(self.func)
         if 'i' in arg_names:
             arg_names.remove('i')
-            type_info['i'] = 'int'
+            type_info['i'] = self.index_type
         for arg, name in zip(args, arg_names):
             arg_type = get_ctype_from_arg(arg, backend=self.backend)
             if not arg_type:
@@ -335,6 +353,14 @@ class ElementwiseJIT(parallel.ElementwiseBase):
 
     @memoize_kernel(key=kernel_cache_key_args)
     def _generate_kernel(self, *args):
+        self._index_key = self._get_index_key(*get_arg_ctypes(self, args))
+        c_func = self._load_from_index()
+        if c_func is not None:
+            return c_func
+        # The code generated for other argument types must not be compiled
+        # again with this kernel.
+        self.tp = Transpiler(backend=self.backend,
+                             incl_cluda=self.tp.incl_cluda)
         if self.func is not None:
             arg_types = self.get_type_info_from_args(*args)
             helper = AnnotationHelper(self.func, arg_types)
@@ -342,32 +368,12 @@ class ElementwiseJIT(parallel.ElementwiseBase):
             self.func = helper.func
         return self._generate(declarations=declarations)
 
-    def _massage_arg(self, x):
-        if isinstance(x, array.Array):
-            return x.dev
-        elif self.backend != 'cuda' or isinstance(x, np.ndarray):
-            return x
-        else:
-            return np.asarray(x)
-
-    @profile
-    def __call__(self, *args, **kw):
-        c_func = self._generate_kernel(*args)
-        c_args = [self._massage_arg(x) for x in args]
+    def _build(self):
+        # The kernels are generated when they are called.
+        pass
 
-        if self.backend == 'cython':
-            size = len(c_args[0])
-            c_args.insert(0, size)
-            c_func(*c_args, **kw)
-        elif self.backend == 'opencl':
-            c_func(*c_args, **kw)
-            self.queue.finish()
-        elif self.backend == 'cuda':
-            import pycuda.driver as drv
-            event = drv.Event()
-            c_func(*c_args, **kw)
-            event.record()
-            event.synchronize()
+    def _get_c_func(self, *args):
+        return parallel.get_index_variant(self, args)._generate_kernel(*args)
 
 
 class ReductionJIT(parallel.ReductionBase):
@@ -376,34 +382,37 @@ class ReductionJIT(parallel.ReductionBase):
         backend = array.get_backend(backend)
         self.tp = Transpiler(backend=backend)
         self.backend = backend
-        self.func = map_func
-        if map_func is not None:
-            self.name = 'reduce_' + map_func.__name__
-        else:
-            self.name = 'reduce'
         self.reduce_expr = reduce_expr
         self.dtype_out = dtype_out
-        self.type = dtype_to_ctype(dtype_out, backend)
-        if backend == 'cython':
-            # On Windows, INFINITY is not defined so we use INFTY which we
-            # internally define.
-            self.neutral = neutral.replace('INFINITY', 'INFTY')
-        else:
-            self.neutral = neutral
+        self._set_map_func(map_func)
+        self._set_output_type(neutral)
         self._config = get_config()
         self.cython_gen = CythonGenerator()
         self.source = '# Code jitted, call the function to generate the code.'
         self.all_source = self.source
+        self.index_type = parallel.get_index_type()
+        self._index_variants = {}
+        self.queue = None
+        self.workspace = Workspace()
         if backend == 'opencl':
             from .opencl import get_context, get_queue
             self.queue = get_queue()
+        if config._profiling:
+            parallel.get_traffic_info(self, self._get_traffic_funcs())
 
     def get_type_info_from_args(self, *args):
         type_info = {}
-        arg_names = getargspec(self.func)
+        if self.map_funcs is None:
+            arg_names = getargspec(self.func)
+        else:
+            # The arguments of all the map functions in order.
+            arg_names = []
+            for func in self._get_map_funcs():
+                arg_names.extend(x for x in getargspec(func)
+                                 if x not in arg_names)
         if 'i' in arg_names:
             arg_names.remove('i')
-            type_info['i'] = 'int'
+            type_info['i'] = self.index_type
         for arg, name in zip(args, arg_names):
             arg_type = get_ctype_from_arg(arg, backend=self.backend)
             if not arg_type:
@@ -413,7 +422,26 @@ class ReductionJIT(parallel.ReductionBase):
 
     @memoize_kernel(key=kernel_cache_key_args)
     def _generate_kernel(self, *args):
-        if self.func is not None:
+        self._index_key = self._get_index_key(*get_arg_ctypes(self, args))
+        c_func = self._load_from_index()
+        if c_func is not None:
+            return c_func
+        # The code generated for other argument types must not be compiled
+        # again with this kernel.
+        self.tp = Transpiler(backend=self.backend,
+                             incl_cluda=self.tp.incl_cluda)
+        if self.map_funcs is not None:
+            arg_types = self.get_type_info_from_args(*args)
+            declarations = {}
+            annotated = {}
+            for func in self._get_map_funcs():
+                helper = AnnotationHelper(func, {
+                    name: arg_types[name] for name in getargspec(func)
+                })
+                declarations.update(helper.annotate())
+                annotated[func] = helper.func
+            self.map_funcs = [annotated[func] for func in self.map_funcs]
+        elif self.func is not None:
             arg_types = self.get_type_info_from_args(*args)
             helper = AnnotationHelper(self.func, arg_types)
             declarations = helper.annotate()
@@ -422,32 +450,157 @@ class ReductionJIT(parallel.ReductionBase):
 
     def _massage_arg(self, x):
         if isinstance(x, array.Array):
+            if x._dependents:
+                x._evaluate_dependents()
             return x.dev
         elif self.backend != 'cuda' or isinstance(x, np.ndarray):
             return x
         else:
             return np.asarray(x)
 
+    def _build(self):
+        # The kernels are generated when they are called.
+        pass
+
+    def _get_c_func(self, *args):
+        return parallel.get_index_variant(self, args)._generate_kernel(*args)
+
     @profile
-    def __call__(self, *args, **kw):
-        c_func = self._generate_kernel(*args)
+    def __call__(self, *args, out=None, workspace=None, **kw):
+        parallel.record_traffic(self, self._get_traffic_funcs(), args)
+        c_func = self._get_c_func(*args)
         c_args = [self._massage_arg(x) for x in args]
 
         if self.backend == 'cython':
             size = len(c_args[0])
             c_args.insert(0, size)
-            return c_func(*c_args, **kw)
-        elif self.backend == 'opencl':
-            result = c_func(*c_args, **kw)
-            self.queue.finish()
-            return result.get()
-        elif self.backend == 'cuda':
-            import pycuda.driver as drv
-            event = drv.Event()
-            result = c_func(*c_args, **kw)
-            event.record()
-            event.synchronize()
-            return result.get()
+            with (workspace or self.workspace).use() as ws:
+                c_args.append(ws)
+                if out is not None:
+                    return self._store_result(c_func, c_args, out, **kw)
+                return self._get_result(c_func(*c_args, **kw))
+        if out is not None:
+            return self._store_result(c_func, c_args, out, **kw)
+        # Reading the result waits for the kernel to finish.
+        result = self._launch_gpu(c_func, c_args, **kw).get()
+        return self._get_result(result)
+
+
+class SegmentedReductionJIT(parallel.SegmentedReductionBase):
+    def __init__(self, reduce_expr, map_func=None, dtype_out=np.float64,
+                 neutral='0', backend=None):
+        backend = array.get_backend(backend)
+        self.tp = Transpiler(backend=backend)
+        self.backend = backend
+        if isinstance(map_func, (list, tuple)):
+            map_func = parallel.fuse_functions(map_func)
+        self.func = map_func
+        self.name = 'segmented_reduce_' + map_func.__name__
+        self.reduce_expr = reduce_expr
+        self.dtype_out = dtype_out
+        self.type = dtype_to_ctype(dtype_out, backend)
+        if backend == 'cython':
+            # On Windows, INFINITY is not defined so we use INFTY which we
+            # internally define.
+            self.neutral = neutral.replace('INFINITY', 'INFTY')
+        else:
+            self.neutral = neutral
+        self._config = get_config()
+        self.cython_gen = CythonGenerator()
+        self.source = '# Code jitted, call the function to generate the code.'
+        self.all_source = self.source
+        self.index_type = parallel.get_index_type()
+        self._index_variants = {}
+        self.queue = None
+
+    def get_type_info_from_args(self, *args):
+        type_info = {}
+        arg_names = getargspec(self.func)
+        if 'i' in arg_names:
+            arg_names.remove('i')
+            type_info['i'] = self.index_type
+        for arg, name in zip(args, arg_names):
+            arg_type = get_ctype_from_arg(arg, backend=self.backend)
+            if not arg_type:
+                arg_type = 'double'
+            type_info[name] = arg_type
+        return type_info
+
+    @memoize_kernel(key=kernel_cache_key_args)
+    def _generate_kernel(self, *args):
+        self._index_key = self._get_index_key(*get_arg_ctypes(self, args))
+        c_func = self._load_from_index()
+        if c_func is not None:
+            return c_func
+        # The code generated for other argument types must not be compiled
+        # again with this kernel.
+        self.tp = Transpiler(backend=self.backend,
+                             incl_cluda=self.tp.incl_cluda)
+        arg_types = self.get_type_info_from_args(*args)
+        helper = AnnotationHelper(self.func, arg_types)
+        declarations = helper.annotate()
+        self.func = helper.func
+        return self._generate(declarations=declarations)
+
+    def _build(self):
+        # The kernels are generated when they are called.
+        pass
+
+    def _get_c_func(self, *args):
+        return parallel.get_index_variant(self, args)._generate_kernel(*args)
+
+
+class HistogramJIT(parallel.HistogramBase):
+    def __init__(self, key_func, n_bins=None, backend=None):
+        backend = array.get_backend(backend)
+        self.tp = Transpiler(backend=backend)
+        self.backend = backend
+        self.func = key_func
+        self.name = 'histogram_' + key_func.__name__
+        self.n_bins = n_bins
+        self._config = get_config()
+        self.cython_gen = CythonGenerator()
+        self.queue = None
+        self.source = '# Code jitted, call the function to generate the code.'
+        self.all_source = self.source
+        self.index_type = parallel.get_index_type()
+        self._index_variants = {}
+
+    def get_type_info_from_args(self, *args):
+        type_info = {}
+        arg_names = getargspec(self.func)
+        if 'i' in arg_names:
+            arg_names.remove('i')
+            type_info['i'] = self.index_type
+        for arg, name in zip(args, arg_names):
+            arg_type = get_ctype_from_arg(arg, backend=self.backend)
+            if not arg_type:
+                arg_type = 'double'
+            type_info[name] = arg_type
+        return type_info
+
+    @memoize_kernel(key=kernel_cache_key_args)
+    def _generate_kernel(self, *args):
+        self._index_key = self._get_index_key(*get_arg_ctypes(self, args))
+        c_func = self._load_from_index()
+        if c_func is not None:
+            return c_func
+        # The code generated for other argument types must not be compiled
+        # again with this kernel.
+        self.tp = Transpiler(backend=self.backend,
+                             incl_cluda=self.tp.incl_cluda)
+        arg_types = self.get_type_info_from_args(*args)
+        helper = AnnotationHelper(self.func, arg_types)
+        declarations = helper.annotate()
+        self.func = helper.func
+        return self._generate(declarations=declarations)
+
+    def _build(self):
+        # The kernels are generated when they are called.
+        pass
+
+    def _get_c_func(self, *args):
+        return parallel.get_index_variant(self, args)._generate_kernel(*args)
 
 
 class ScanJIT(parallel.ScanBase):
@@ -477,16 +630,22 @@ class ScanJIT(parallel.ScanBase):
         self._config = get_config()
         self.source = '# Code jitted, call the function to generate the code.'
         self.all_source = self.source
+        self.index_type = parallel.get_index_type()
+        self._index_variants = {}
         self.cython_gen = CythonGenerator()
+        self.queue = None
+        self.workspace = Workspace()
         if backend == 'opencl':
             from .opencl import get_context, get_queue
             self.queue = get_queue()
         builtin_symbols = ['item', 'prev_item', 'last_item']
-        self.builtin_types = {'i': 'int', 'N': 'int'}
+        self.builtin_types = {'i': self.index_type, 'N': self.index_type}
         for sym in builtin_symbols:
             self.builtin_types[sym] = dtype_to_knowntype(
                 self.dtype, backend=backend
             )
+        if config._profiling:
+            parallel.get_traffic_info(self, self._get_traffic_funcs())
 
     def get_type_info_from_kwargs(self, func, **kwargs):
         type_info = {}
@@ -506,45 +665,74 @@ class ScanJIT(parallel.ScanBase):
 
     @memoize(key=kernel_cache_key_kwargs, use_kwargs=True)
     def _generate_kernel(self, **kwargs):
-        declarations = {}
-        if self.input_func is not None:
-            arg_types = self.get_type_info_from_kwargs(
-                self.input_func, **kwargs)
-            arg_types['return_'] = dtype_to_knowntype(
-                self.dtype, backend=self.backend
+        with build_record(self):
+            arg_ctypes = get_arg_ctypes(self, kwargs.values())
+            self._index_key = self._get_index_key(
+                *sorted(zip(kwargs.keys(), arg_ctypes))
             )
-            helper = AnnotationHelper(self.input_func, arg_types)
-            declarations.update(helper.annotate())
-            self.input_func = helper.func
-
-        if self.output_func is not None:
-            arg_types = self.get_type_info_from_kwargs(
-                self.output_func, **kwargs)
-            helper = AnnotationHelper(self.output_func, arg_types)
-            declarations.update(helper.annotate())
-            self.output_func = helper.func
-
-        if self.is_segment_func is not None:
-            arg_types = self.get_type_info_from_kwargs(
-                self.is_segment_func, **kwargs)
-            arg_types['return_'] = 'int'
-            helper = AnnotationHelper(self.is_segment_func, arg_types)
-            declarations.update(helper.annotate())
-            self.is_segment_func = helper.func
-
-        return self._generate(declarations=declarations)
+            c_func = self._load_from_index()
+            if c_func is not None:
+                return c_func
+            # The code generated for other argument types must not be compiled
+            # again with this kernel.
+            self.tp = Transpiler(backend=self.backend,
+                                 incl_cluda=self.tp.incl_cluda)
+            declarations = {}
+            if self.input_func is not None:
+                arg_types = self.get_type_info_from_kwargs(
+                    self.input_func, **kwargs)
+                arg_types['return_'] = dtype_to_knowntype(
+                    self.dtype, backend=self.backend
+                )
+                helper = AnnotationHelper(self.input_func, arg_types)
+                declarations.update(helper.annotate())
+                self.input_func = helper.func
+
+            if self.output_func is not None:
+                arg_types = self.get_type_info_from_kwargs(
+                    self.output_func, **kwargs)
+                helper = AnnotationHelper(self.output_func, arg_types)
+                declarations.update(helper.annotate())
+                self.output_func = helper.func
+
+            if self.is_segment_func is not None:
+                arg_types = self.get_type_info_from_kwargs(
+                    self.is_segment_func, **kwargs)
+                arg_types['return_'] = 'int'
+                helper = AnnotationHelper(self.is_segment_func, arg_types)
+                declarations.update(helper.annotate())
+                self.is_segment_func = helper.func
+
+            return self._generate(declarations=declarations)
 
     def _massage_arg(self, x):
         if isinstance(x, array.Array):
+            if x._dependents:
+                x._evaluate_dependents()
             return x.dev
         elif self.backend != 'cuda' or isinstance(x, np.ndarray):
             return x
         else:
             return np.asarray(x)
 
+    def _build(self):
+        # The kernels are generated when they are called.
+        self.builtin_types = dict(
+            self.builtin_types, i=self.index_type, N=self.index_type
+        )
+
+    def _get_c_func(self, **kwargs):
+        variant = parallel.get_index_variant(self, kwargs.values())
+        return variant._generate_kernel(**kwargs)
+
     @profile
-    def __call__(self, **kwargs):
-        c_func = self._generate_kernel(**kwargs)
+    def __call__(self, async_launch=None, aggregate=None, workspace=None,
+                 **kwargs):
+        parallel.record_traffic(
+            self, self._get_traffic_funcs(), list(kwargs.values()),
+            names=list(kwargs.keys())
+        )
+        c_func = self._get_c_func(**kwargs)
         c_args_dict = {k: self._massage_arg(x) for k, x in kwargs.items()}
         if self._get_backend_key() in self.output_func.arg_keys:
             output_arg_keys = self.output_func.arg_keys[
@@ -557,13 +745,16 @@ class ScanJIT(parallel.ScanBase):
         if self.backend == 'cython':
             size = len(c_args_dict[output_arg_keys[1]])
             c_args_dict['SIZE'] = size
-            c_func(*[c_args_dict[k] for k in output_arg_keys])
-        elif self.backend == 'opencl':
-            c_func(*[c_args_dict[k] for k in output_arg_keys])
-            self.queue.finish()
-        elif self.backend == 'cuda':
-            import pycuda.driver as drv
-            event = drv.Event()
-            c_func(*[c_args_dict[k] for k in output_arg_keys])
-            event.record()
-            event.synchronize()
+            with (workspace or self.workspace).use() as ws:
+                total = c_func(*[c_args_dict[k] for k in output_arg_keys],
+                               ws)
+            if aggregate is not None:
+                self._massage_arg(aggregate)[0] = total
+        else:
+            c_args_dict['scan_total'] = self._get_scan_total(aggregate)
+            first = parallel.start_device_timing(self)
+            event = c_func(*[c_args_dict[k] for k in output_arg_keys])
+            parallel.record_device_timing(self, event, first)
+            return parallel.finish_launch(
+                self.backend, self.queue, async_launch
+            )
@@ -0,0 +1,224 @@
+"""A persistent on-disk index of generated Cython kernels.
+
+The ``ExtModule`` only finds a previously compiled extension module after the
+complete source has been generated, which requires transpiling the user code
+and rendering the templates each time a kernel is created.  This module maps a
+cheap key computed from the source of the user functions, the configuration
+and the compyle version directly to the compiled extension module so that a
+fresh process can import the module without generating any code.
+
+Each entry also records the module level functions, constants and externs
+that the user functions depend on.  An entry is only used if all of these are
+unchanged.
+"""
+
+import hashlib
+import importlib
+import io
+import json
+import logging
+import os
+from os.path import exists, isdir, join
+import types
+from textwrap import dedent
+
+from .ast_utils import get_unknown_names_and_calls
+from .config import get_config
+from .ext_module import get_default_root, load_extension
+from .extern import Extern
+from .utils import getsource
+
+logger = logging.getLogger(__name__)
+
+
+def _md5(data):
+    return hashlib.md5(data.encode()).hexdigest()
+
+
+def fingerprint(obj, backend='cython'):
+    """Return a string identifying the state of a module level object used by
+    a kernel or None if the object does not affect the generated code.
+    """
+    if isinstance(obj, Extern):
+        code = obj.code(backend)
+        return _md5(code if code else '')
+    elif isinstance(obj, types.FunctionType):
+        try:
+            src = getsource(obj)
+        except (OSError, TypeError):
+            return None
+        if not getattr(obj, 'is_jit', False):
+            src += repr(sorted(getattr(obj, '__annotations__', {}).items()))
+        return _md5(src)
+    elif isinstance(obj, (bool, int, float, str)):
+        return repr(obj)
+    else:
+        return None
+
+
+def get_dependencies(funcs, backend='cython'):
+    """Return a list of ``[module, name, fingerprint]`` for all the module
+    level objects that the given functions (transitively) depend on.
+    """
+    deps = []
+    seen = set()
+    todo = list(funcs)
+    while todo:
+        func = todo.pop()
+        if func in seen:
+            continue
+        seen.add(func)
+        src = dedent(getsource(func))
+        names, calls = get_unknown_names_and_calls(src)
+        mod = importlib.import_module(func.__module__)
+        for name in sorted(names | set(calls)):
+            if name == func.__name__ or not hasattr(mod, name):
+                continue
+            value = getattr(mod, name)
+            fp = fingerprint(value, backend)
+            if fp is None:
+                continue
+            deps.append([func.__module__, name, fp])
+            if isinstance(value, types.FunctionType):
+                todo.append(value)
+    return deps
+
+
+def _dependencies_changed(deps, backend):
+    for modname, name, fp in deps:
+        try:
+            mod = importlib.import_module(modname)
+        except ImportError:
+            return True
+        if not hasattr(mod, name):
+            return True
+        if fingerprint(getattr(mod, name), backend) != fp:
+            return True
+    return False
+
+
+class KernelIndex(object):
+    """Maps kernel keys to previously compiled extension modules.
+
+    Every entry is stored as a small JSON file inside the ``index``
+    sub-directory of the root used by ``ExtModule``.
+    """
+    def __init__(self, root=None):
+        if root is None:
+            root = get_default_root()
+        self.root = join(root, 'index')
+        if not isdir(self.root):
+            try:
+                os.makedirs(self.root)
+            except OSError:
+                # Created at the same time by another process.
+                pass
+
+    def get_key(self, kind, funcs, extra=(), backend='cython', config=None):
+        """Return a key for a kernel.
+
+        Parameters
+        ----------
+
+        kind: str: the kind of kernel, e.g. 'elementwise'.
+        funcs: list: the user functions used to generate the kernel.
+        extra: sequence: any other data that affects the generated code, this
+            must have a stable ``repr``.
+        backend: str: the backend used.
+        config: Config: the configuration to use, defaults to the current one.
+        """
+        from . import __version__
+        cfg = get_config() if config is None else config
+        data = [
+            __version__, kind, backend, bool(cfg.use_openmp),
+            bool(cfg.use_double), tuple(cfg.omp_schedule)
+        ]
+        for func in funcs:
+            if func is None:
+                data.append(None)
+            else:
+                data.append((
+                    func.__module__, func.__name__,
+                    fingerprint(func, backend),
+                    getattr(func, 'is_serial', False)
+                ))
+        data.extend(extra)
+        return _md5(repr(data))
+
+    def _get_path(self, key):
+        return join(self.root, key + '.json')
+
+    def get(self, key, backend='cython'):
+        """Return the entry for the key if it exists and is still valid or
+        None.
+        """
+        path = self._get_path(key)
+        if not exists(path):
+            return None
+        try:
+            with io.open(path, encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not exists(entry['ext_path']):
+            return None
+        if _dependencies_changed(entry['depends'], backend):
+            return None
+        return entry
+
+    def load(self, entry):
+        """Import the extension module for the given entry.
+        """
+        logger.info('Loading indexed kernel from: %s', entry['ext_path'])
+        return load_extension(entry['name'], entry['ext_path'])
+
+    def put(self, key, funcs, ext_module, backend='cython', **data):
+        """Add an entry for the key.
+
+        Parameters
+        ----------
+
+        key: str: the key obtained from ``get_key``.
+        funcs: list: the user functions used to generate the kernel.
+        ext_module: ExtModule: the extension module that was built.
+        backend: str: the backend used.
+        data: any other JSON serializable data to store with the entry.
+        """
+        entry = dict(
+            name=ext_module.name, ext_path=ext_module.ext_path,
+            src_path=ext_module.src_path,
+            depends=get_dependencies([f for f in funcs if f is not None],
+                                     backend),
+        )
+        entry.update(data)
+        path = self._get_path(key)
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with io.open(tmp, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(entry))
+        os.replace(tmp, path)
+
+    def clear(self):
+        """Remove all the entries in the index.
+        """
+        for fname in os.listdir(self.root):
+            if fname.endswith('.json'):
+                os.remove(join(self.root, fname))
+
+
+_kernel_index = None
+
+
+def get_kernel_index():
+    """Return the kernel index or None if it is disabled in the config.
+    """
+    global _kernel_index
+    if not get_config().use_kernel_index:
+        return None
+    if _kernel_index is None:
+        _kernel_index = KernelIndex()
+    return _kernel_index
+
+
+def set_kernel_index(index):
+    global _kernel_index
+    _kernel_index = index
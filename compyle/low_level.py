@@ -14,7 +14,8 @@ from .array import Array, get_backend
 from .transpiler import Transpiler
 from .types import KnownType, ctype_to_dtype
 from .extern import Extern
-from .profile import profile
+from .parallel import finish_launch, record_device_timing
+from .profile import build_record, profile
 
 
 LID_0 = LDIM_0 = GDIM_0 = GID_0 = 0
@@ -139,6 +140,7 @@ class Kernel(object):
         elif backend == 'cuda':
             from .cuda import set_context
             set_context()
+            self.queue = None
         self.tp = Transpiler(backend=backend)
         self.backend = backend
         self.name = func.__name__
@@ -147,7 +149,8 @@ class Kernel(object):
         self._config = get_config()
         self._use_double = self._config.use_double
         self._func_info = self._get_func_info()
-        self._generate()
+        with build_record(self):
+            self._generate()
 
     def _to_float(self, s):
         return re.sub(r'\bdouble\b', 'float', s)
@@ -212,6 +215,8 @@ class Kernel(object):
 
     def _massage_arg(self, x, type_info, workgroup_size):
         if isinstance(x, Array):
+            if x._dependents:
+                x._evaluate_dependents()
             if self.backend == 'opencl':
                 return x.dev.data
             elif self.backend == 'cuda':
@@ -243,6 +248,7 @@ class Kernel(object):
 
     @profile
     def __call__(self, *args, **kw):
+        async_launch = kw.pop('async_launch', None)
         size = args[0].data.shape
         gs = kw.pop('global_size', size)
         n = np.prod(gs)
@@ -257,18 +263,15 @@ class Kernel(object):
         if self.backend == 'opencl':
             prepend = [self.queue, gs, ls]
             c_args = prepend + c_args
-            self.knl(*c_args)
-            self.queue.finish()
+            event = self.knl(*c_args)
+            record_device_timing(self, event)
         elif self.backend == 'cuda':
-            import pycuda.driver as drv
             shared_mem_size = int(self._get_local_size(args, ls[0]))
             num_blocks = int((n + ls[0] - 1) / ls[0])
             num_tpb = int(ls[0])
-            event = drv.Event()
             self.knl(*c_args, block=(num_tpb, 1, 1), grid=(num_blocks, 1),
                      shared=shared_mem_size)
-            event.record()
-            event.synchronize()
+        return finish_launch(self.backend, self.queue, async_launch)
 
 
 class _prange(Extern):
@@ -329,6 +332,30 @@ class _atomic_dec(Extern):
         pass
 
 
+class _atomic_add(Extern):
+    def code(self, backend):
+        return ''
+
+    def __call__(self, *args, **kw):
+        pass
+
+
+class _atomic_min(Extern):
+    def code(self, backend):
+        return ''
+
+    def __call__(self, *args, **kw):
+        pass
+
+
+class _atomic_max(Extern):
+    def code(self, backend):
+        return ''
+
+    def __call__(self, *args, **kw):
+        pass
+
+
 class _cast(Extern):
     def code(self, backend):
         return ''
@@ -343,6 +370,9 @@ nogil = _nogil()
 address = _address()
 atomic_inc = _atomic_inc()
 atomic_dec = _atomic_dec()
+atomic_add = _atomic_add()
+atomic_min = _atomic_min()
+atomic_max = _atomic_max()
 cast = _cast()
 
 
@@ -353,7 +383,8 @@ class Cython(object):
         self.name = func.__name__
         self.func = func
         self.source = ''  # The generated source.
-        self._generate()
+        with build_record(self, backend='cython'):
+            self._generate()
 
     def _generate(self):
         self.tp.add(self.func)
@@ -363,6 +394,8 @@ class Cython(object):
 
     def _massage_arg(self, x):
         if isinstance(x, Array):
+            if x._dependents:
+                x._evaluate_dependents()
             return x.data
         else:
             return x
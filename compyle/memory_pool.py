@@ -0,0 +1,268 @@
+"""Pooled allocation of the memory used by ``compyle.array``.
+
+Creating temporary arrays allocates fresh memory each time which is slow for
+large arrays and fragments the memory.  A memory pool holds on to the memory
+of arrays that are no longer used and hands it out again for later
+allocations of a similar size.  Allocations are binned by size so that a
+block is at most 25% larger than requested.
+
+On the OpenCL and CUDA backends the pools of PyOpenCL and PyCUDA are used.
+On the Cython backend, ``NumpyPool`` pools NumPy buffers.
+"""
+
+from contextlib import contextmanager
+import threading
+import weakref
+
+import numpy as np
+from pytools import memoize
+
+from .config import get_config
+
+
+def bin_size(nbytes):
+    """Return the size of the bin that an allocation of `nbytes` falls in.
+
+    The bins are spaced such that there are four bins between consecutive
+    powers of two.
+    """
+    if nbytes <= 4:
+        return max(nbytes, 1)
+    exp = nbytes.bit_length() - 3
+    step = 1 << exp
+    return ((nbytes + step - 1) // step) * step
+
+
+class _BlockOwner(object):
+    """Exposes the first `nbytes` of a block of the pool as an array.
+
+    The arrays handed out by the pool are created from an instance of this
+    class, all their views refer to it through their ``base`` and so it is
+    only freed once no array uses the memory.  The block is then returned to
+    the pool by a ``weakref.finalize``.
+    """
+    def __init__(self, block, nbytes):
+        self.block = block
+        self.__array_interface__ = dict(
+            shape=(nbytes,), typestr='|u1', version=3,
+            data=(block.ctypes.data, False)
+        )
+
+
+class NumpyPool(object):
+    """A pool of NumPy buffers for the Cython backend.
+
+    Every block of memory is a NumPy array of bytes that is owned by the pool.
+    The arrays handed out use the memory of a block which is returned to the
+    pool once the array and all its views are freed.
+
+    Parameters
+    ----------
+
+    min_bytes: int: allocations smaller than this are not pooled as NumPy is
+        fast enough for these.
+    """
+    def __init__(self, min_bytes=1 << 16):
+        self.min_bytes = min_bytes
+        self.hits = 0
+        self.misses = 0
+        # The free blocks of every bin.
+        self._bins = {}
+        self._active_blocks = 0
+        self._active_bytes = 0
+
+    def _get_block(self, size):
+        blocks = self._bins.get(size)
+        if blocks:
+            self.hits += 1
+            return blocks.pop()
+        self.misses += 1
+        return np.empty(size, dtype=np.uint8)
+
+    def _release(self, block):
+        self._active_blocks -= 1
+        self._active_bytes -= block.nbytes
+        self._bins.setdefault(block.nbytes, []).append(block)
+
+    def empty(self, n, dtype):
+        """Return an uninitialized array of `n` elements of the given type.
+        """
+        dtype = np.dtype(dtype)
+        nbytes = n*dtype.itemsize
+        if nbytes < self.min_bytes:
+            return np.empty(n, dtype=dtype)
+        block = self._get_block(bin_size(nbytes))
+        self._active_blocks += 1
+        self._active_bytes += block.nbytes
+        owner = _BlockOwner(block, nbytes)
+        weakref.finalize(owner, self._release, block)
+        return np.asarray(owner).view(dtype)
+
+    def get_stats(self):
+        """Return a dictionary with the number of blocks and bytes in use
+        (active) and held by the pool for reuse (held) along with the number
+        of allocations that reused memory (hits) or not (misses).
+        """
+        held = [block for blocks in self._bins.values() for block in blocks]
+        return dict(
+            active_blocks=self._active_blocks,
+            active_bytes=self._active_bytes, held_blocks=len(held),
+            held_bytes=sum(block.nbytes for block in held), hits=self.hits,
+            misses=self.misses
+        )
+
+    def trim(self):
+        """Release all the memory held by the pool that is not in use.
+        """
+        self._bins.clear()
+
+
+_workspaces = weakref.WeakSet()
+
+
+class Workspace(object):
+    """Scratch memory that is reused by the calls of a kernel.
+
+    The Cython reductions and scans keep their per-thread partial results and
+    other temporary data in a workspace instead of allocating memory on every
+    call.  The workspace only grows when a call needs more memory than any
+    earlier call, for example when the array or the number of threads grows.
+
+    A workspace is only used by one call at a time, see ``use``, so kernels
+    sharing it may be called from several Python threads.
+    """
+    def __init__(self):
+        self.data = np.empty(0, dtype=np.uint8)
+        self.grows = 0
+        self._lock = threading.Lock()
+        _workspaces.add(self)
+
+    @contextmanager
+    def use(self):
+        """Context manager giving the workspace for a call.
+
+        If the workspace is being used by another call, for example from
+        another thread, a new private workspace is given instead of waiting.
+        """
+        if not self._lock.acquire(blocking=False):
+            yield Workspace()
+            return
+        try:
+            yield self
+        finally:
+            self._lock.release()
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes
+
+    def get(self, nbytes):
+        """Return a byte array of at least `nbytes` (and at least 1) bytes.
+        """
+        if nbytes > self.data.nbytes or self.data.nbytes == 0:
+            self.data = np.empty(bin_size(max(nbytes, 1)), dtype=np.uint8)
+            self.grows += 1
+        return self.data
+
+    def release(self):
+        """Release the memory of the workspace.
+        """
+        self.data = np.empty(0, dtype=np.uint8)
+
+    def get_stats(self):
+        return dict(nbytes=self.nbytes, grows=self.grows)
+
+
+def get_workspace_stats():
+    """Return the number of live workspaces and the bytes they hold.
+    """
+    workspaces = list(_workspaces)
+    return dict(workspaces=len(workspaces),
+                nbytes=sum(w.nbytes for w in workspaces))
+
+
+class DevicePool(object):
+    """Wraps the memory pools of PyOpenCL and PyCUDA with the same interface
+    as ``NumpyPool``.
+    """
+    def __init__(self, backend, queue=None):
+        self.backend = backend
+        self.queue = queue
+        if backend == 'opencl':
+            import pyopencl.tools as cl_tools
+            self.pool = cl_tools.MemoryPool(
+                cl_tools.ImmediateAllocator(queue)
+            )
+            self.allocator = self.pool
+        elif backend == 'cuda':
+            import pycuda.tools as cu_tools
+            self.pool = cu_tools.DeviceMemoryPool()
+            self.allocator = self.pool.allocate
+
+    def empty(self, n, dtype):
+        if self.backend == 'opencl':
+            import pyopencl.array as gpuarray
+            return gpuarray.empty(self.queue, n, dtype,
+                                  allocator=self.allocator)
+        else:
+            import pycuda.gpuarray as gpuarray
+            return gpuarray.empty(n, dtype, allocator=self.allocator)
+
+    def get_stats(self):
+        pool = self.pool
+        return dict(
+            active_blocks=pool.active_blocks,
+            active_bytes=getattr(pool, 'active_bytes', None),
+            held_blocks=pool.held_blocks,
+            held_bytes=getattr(pool, 'managed_bytes', None),
+            hits=None, misses=None
+        )
+
+    def trim(self):
+        self.pool.free_held()
+
+
+@memoize(key=lambda queue: queue)
+def get_cl_memory_pool(queue):
+    """Return the memory pool for the given OpenCL command queue.
+    """
+    return DevicePool('opencl', queue)
+
+
+_pools = {}
+
+
+def get_memory_pool(backend='cython'):
+    """Return the memory pool for the backend.
+    """
+    if backend == 'opencl':
+        from .opencl import get_queue
+        return get_cl_memory_pool(get_queue())
+    pool = _pools.get(backend)
+    if pool is None:
+        if backend == 'cuda':
+            pool = DevicePool('cuda')
+        else:
+            pool = NumpyPool()
+        _pools[backend] = pool
+    return pool
+
+
+def get_allocator(backend):
+    """Return the allocator to pass to PyOpenCL/PyCUDA array constructors or
+    None if memory pooling is disabled with ``get_config().use_memory_pool``.
+    """
+    if not get_config().use_memory_pool:
+        return None
+    return get_memory_pool(backend).allocator
+
+
+def get_memory_pool_stats(backend='cython'):
+    return get_memory_pool(backend).get_stats()
+
+
+def trim_memory_pool(backend='cython'):
+    """Release the memory held by the pool of the backend that is not used
+    by any array.
+    """
+    get_memory_pool(backend).trim()
@@ -41,6 +41,14 @@ def set_queue(q):
     _queue = q
 
 
+def has_profiling(queue):
+    """Return True if the events of the queue have profiling information.
+    """
+    return bool(
+        queue.properties & cl.command_queue_properties.PROFILING_ENABLE
+    )
+
+
 class SimpleKernel(object):
     """ElementwiseKernel substitute that supports a custom work group size.
     """
@@ -6,17 +6,34 @@ once and have it run on different execution backends.
 
 """
 
+import ast
+import copy
 from functools import wraps
-from textwrap import wrap
+import inspect
+import re
+import sys
+from textwrap import dedent, wrap
+from time import perf_counter_ns
+import types
 
 from mako.template import Template
 import numpy as np
 
-from .config import get_config
-from .profile import profile
+from .ast_utils import get_array_access, has_return
+from . import config
+from .config import get_config, set_config
+from .profile import (build_phase, build_record, exclude_from_profile,
+                      profile, profile_ctx, record_device_event,
+                      record_throughput, update_build_record)
 from .cython_generator import get_parallel_range, CythonGenerator
+from .kernel_index import get_kernel_index
+from .memory_pool import Workspace
+from .ext_module import (DeferredBuild, build_all, build_bundles, get_md5,
+                         defer_builds)
+from .translator import CConverter
 from .transpiler import Transpiler, convert_to_float_if_needed
-from .types import dtype_to_ctype
+from .types import KnownType, ctype_to_dtype, dtype_to_ctype
+from .utils import getsource
 
 from . import array
 
@@ -25,7 +42,7 @@ elementwise_cy_template = '''
 from cython.parallel import parallel, prange
 
 cdef c_${name}(${c_arg_sig}):
-    cdef int i
+    cdef ${index_type} i
 %if openmp:
     with nogil, parallel():
         for i in ${get_parallel_range("SIZE")}:
@@ -39,17 +56,19 @@ cpdef py_${name}(${py_arg_sig}):
     c_${name}(${py_args})
 '''
 
-reduction_cy_template = '''
-from cython.parallel import parallel, prange, threadid
-from libc.stdlib cimport abort, malloc, free
-from libc.math cimport INFINITY
-cimport openmp
-
-cdef double INFTY = float('inf')
-
+# Helper functions shared by the reduction and scan templates, these are kept
+# identical so that they are only emitted once when sources are bundled.
+thread_helpers_cy_template = '''
 cpdef int get_number_of_threads():
 % if openmp:
     cdef int i, n
+    # A nested parallel region only has one thread.
+    if openmp.omp_in_parallel():
+        return 1
+    # Without dynamic adjustment a parallel region uses the maximum number
+    # of threads so there is no need to start one to count the threads.
+    if not openmp.omp_get_dynamic():
+        return openmp.omp_get_max_threads()
     with nogil, parallel():
         for i in prange(1):
             n = openmp.omp_get_num_threads()
@@ -60,25 +79,36 @@ cpdef int get_number_of_threads():
 
 cdef int gcd(int a, int b):
     while b != 0:
-        a, b = b, a%b
+        a, b = b, a % b
     return a
 
 cdef int get_stride(int sz, int itemsize):
-    return sz//gcd(sz, itemsize)
+    return sz // gcd(sz, itemsize)
 
+cdef size_t align64(size_t nbytes):
+    return (nbytes + 63) & ~(<size_t>63)
+'''
 
-cdef ${type} c_${name}(${c_arg_sig}):
-    cdef int i, n_thread, tid, scan_stride, sz
+reduction_cy_template = '''
+from cython.parallel import parallel, prange, threadid
+from libc.stdlib cimport abort, malloc, free
+from libc.math cimport INFINITY
+cimport openmp
+
+cdef double INFTY = float('inf')
+''' + thread_helpers_cy_template + '''
+
+cdef ${type} c_${name}(${c_arg_sig}, char* workspace, int n_thread):
+    cdef ${index_type} i
+    cdef int tid, scan_stride, sz
     cdef ${type} a, b
-    n_thread = get_number_of_threads()
     sz = sizeof(${type})
 
     # This striding is to do 64 bit alignment to prevent false sharing.
     scan_stride = get_stride(64, sz)
-    cdef ${type}* buffer
-    buffer = <${type}*>malloc(n_thread*scan_stride*sz)
-    if buffer == NULL:
-        raise MemoryError("Unable to allocate memory for reduction")
+    cdef ${type}* buffer = <${type}*>workspace
+    for tid in range(n_thread):
+        buffer[tid*scan_stride] = ${neutral}
 
 %if openmp:
     with nogil, parallel():
@@ -86,7 +116,6 @@ cdef ${type} c_${name}(${c_arg_sig}):
     if 1:
 % endif
         tid = threadid()
-        buffer[tid*scan_stride] = ${neutral}
 %if openmp:
         for i in ${get_parallel_range("SIZE")}:
 %else:
@@ -101,97 +130,177 @@ cdef ${type} c_${name}(${c_arg_sig}):
         b = buffer[i*scan_stride]
         a = ${reduce_expr}
 
-    free(buffer)
     return a
 
 
-cpdef py_${name}(${py_arg_sig}):
-    return c_${name}(${py_args})
+cpdef py_${name}(${py_arg_sig}, workspace):
+    cdef int n_thread = get_number_of_threads()
+    cdef size_t sz = sizeof(${type})
+    cdef unsigned char[:] ws = workspace.get(
+        n_thread*get_stride(64, sz)*sz
+    )
+    return c_${name}(${py_args}, <char*>&ws[0], n_thread)
+'''
+
+# The helpers for a reduction to a struct of several values.  Each field is
+# reduced with its own expression in which ``a`` and ``b`` are the values of
+# the field and ``a_<field>``, ``b_<field>`` those of any field.
+struct_reduction_cy_template = '''
+cdef struct ${type}:
+% for field, ctype in fields:
+    ${ctype} ${field}
+% endfor
+
+
+cdef inline ${type} ${name}_neutral()${gil}:
+    cdef ${type} r
+% for field, value in neutral:
+    r.${field} = ${value}
+% endfor
+    return r
+
+
+cdef inline ${type} ${name}_map(${map_sig})${gil}:
+    cdef ${type} r
+% for field, expr in map_exprs:
+    r.${field} = ${expr}
+% endfor
+    return r
+
+
+cdef inline ${type} ${name}_reduce(${type} sa, ${type} sb)${gil}:
+    cdef ${type} r
+% for field, ctype in fields:
+    cdef ${ctype} a_${field} = sa.${field}
+    cdef ${ctype} b_${field} = sb.${field}
+% endfor
+% for field, expr in reduce_exprs:
+    r.${field} = ${expr}
+% endfor
+    return r
+'''
+
+struct_reduction_gpu_template = '''
+${c_decl}
+
+WITHIN_KERNEL ${type} ${name}_neutral()
+{
+    ${type} r;
+% for field, value in neutral:
+    r.${field} = ${value};
+% endfor
+    return r;
+}
+
+WITHIN_KERNEL ${type} ${name}_map(${map_sig})
+{
+    ${type} r;
+% for field, expr in map_exprs:
+    r.${field} = ${expr};
+% endfor
+    return r;
+}
+
+WITHIN_KERNEL ${type} ${name}_reduce(${type} sa, ${type} sb)
+{
+    ${type} r;
+% for field, ctype in fields:
+    ${ctype} a_${field} = sa.${field};
+    ${ctype} b_${field} = sb.${field};
+% endfor
+% for field, expr in reduce_exprs:
+    r.${field} = ${expr};
+% endfor
+    return r;
+}
+'''
+
+# PyCUDA reduces in volatile shared memory which needs an assignment operator
+# for the struct.
+struct_volatile_assign_cuda_template = '''
+    __device__ ${type} volatile &operator=(${type} const &src) volatile
+    {
+% for field, ctype in fields:
+        this->${field} = src.${field};
+% endfor
+        return *this;
+    }
 '''
 
 scan_cy_template = '''
-from cython.parallel import parallel, prange, threadid
+from cython.parallel import parallel, prange
 from libc.stdlib cimport abort, malloc, free
 cimport openmp
 cimport numpy as np
-cpdef int get_number_of_threads():
-    % if openmp:
-        cdef int i, n
-        with nogil, parallel():
-            for i in prange(1):
-                n = openmp.omp_get_num_threads()
-        return n
-    % else:
-        return 1
-    % endif
-
-cdef int gcd(int a, int b):
-    while b != 0:
-        a, b = b, a % b
-    return a
+''' + thread_helpers_cy_template + '''
 
-cdef int get_stride(int sz, int itemsize):
-    return sz // gcd(sz, itemsize)
+# The workspace holds the per-thread carries followed by the flags of the
+# segments and the output of the input expression if these are needed.
+cdef size_t ${name}_workspace_size(long SIZE, int n_thread):
+    cdef size_t sz = sizeof(${type})
+    cdef size_t nbytes = align64(n_thread * get_stride(64, sz) * sz)
+    % if use_segment:
+    nbytes += align64(n_thread * get_stride(64, sz) * sizeof(int))
+    nbytes += align64(SIZE * sizeof(int))
+    % endif
+    % if complex_map:
+    nbytes += align64(SIZE * sz)
+    % endif
+    return nbytes
 
 
-cdef void c_${name}(${c_arg_sig}):
-    cdef int i, n_thread, tid, scan_stride, sz, N
+cdef ${type} c_${name}(${c_arg_sig}, char* workspace, int n_thread):
+    cdef ${index_type} i, N
+    cdef int tid, scan_stride, sz
 
     N = SIZE
-    n_thread = get_number_of_threads()
     sz = sizeof(${type})
 
     # This striding is to do 64 bit alignment to prevent false sharing.
     scan_stride = get_stride(64, sz)
 
     cdef ${type}* buffer
-    buffer = <${type}*> malloc(n_thread * scan_stride * sz)
-
-    if buffer == NULL:
-        raise MemoryError("Unable to allocate memory for scan.")
+    buffer = <${type}*> workspace
+    workspace += align64(n_thread * scan_stride * sz)
 
     % if use_segment:
     cdef int* scan_seg_flags
     cdef int* chunk_new_segment
-    scan_seg_flags = <int*> malloc(SIZE * sizeof(int))
-    chunk_new_segment = <int*> malloc(n_thread * scan_stride * sizeof(int))
-
-    if scan_seg_flags == NULL or chunk_new_segment == NULL:
-        raise MemoryError("Unable to allocate memory for segmented scan")
+    chunk_new_segment = <int*> workspace
+    workspace += align64(n_thread * scan_stride * sizeof(int))
+    scan_seg_flags = <int*> workspace
+    workspace += align64(SIZE * sizeof(int))
     % endif
 
     % if complex_map:
     cdef ${type}* map_output
-    map_output = <${type}*> malloc(SIZE * sz)
-
-    if map_output == NULL:
-        raise MemoryError("Unable to allocate memory for scan. (Recommended:
-        Set complex_map=False.)")
+    map_output = <${type}*> workspace
     % endif
 
 
-    cdef int buffer_idx, start, end, has_segment
+    cdef ${index_type} start, end
+    cdef int buffer_idx, has_segment
     cdef ${type} a, b, temp
     # This chunksize would divide input data equally
     # between threads
     % if not calc_last_item:
     # A chunk of 1 MB per thread
-    cdef int chunksize = 1048576 // sz
+    cdef ${index_type} chunksize = 1048576 // sz
     % else:
     # Process all data together. Only then can we get
     # the last item immediately
-    cdef int chunksize = (SIZE + n_thread - 1) // n_thread
+    cdef ${index_type} chunksize = (SIZE + n_thread - 1) // n_thread
     % endif
 
-    cdef int offset = 0
+    cdef ${index_type} offset = 0
     cdef ${type} global_carry = ${neutral}
     cdef ${type} last_item
     cdef ${type} carry, item, prev_item
 
     while offset < SIZE:
         # Pass 1
-        with nogil, parallel():
-            tid = threadid()
+        for tid in prange(n_thread, nogil=True, schedule='static',
+                          chunksize=1):
             buffer_idx = tid * scan_stride
 
             start = offset + tid * chunksize
@@ -276,8 +385,8 @@ cdef void c_${name}(${c_arg_sig}):
         global_carry = last_item
 
         # Pass 3: Output
-        with nogil, parallel():
-            tid = threadid()
+        for tid in prange(n_thread, nogil=True, schedule='static',
+                          chunksize=1):
             buffer_idx = tid * scan_stride
             carry = buffer[buffer_idx]
 
@@ -311,20 +420,15 @@ cdef void c_${name}(${c_arg_sig}):
                 ${output_expr}
         offset += chunksize * n_thread
 
-    # Clean up
-    free(buffer)
-
-    % if use_segment:
-    free(scan_seg_flags)
-    free(chunk_new_segment)
-    % endif
-
-    % if complex_map:
-    free(map_output)
-    % endif
+    # The last item of the inclusive scan.
+    return global_carry
 
-cpdef py_${name}(${py_arg_sig}):
-    return c_${name}(${py_args})
+cpdef py_${name}(${py_arg_sig}, workspace):
+    cdef int n_thread = get_number_of_threads()
+    cdef unsigned char[:] ws = workspace.get(
+        ${name}_workspace_size(SIZE, n_thread)
+    )
+    return c_${name}(${py_args}, <char*>&ws[0], n_thread)
 '''
 
 scan_cy_single_thread_template = '''
@@ -333,8 +437,9 @@ from libc.stdlib cimport abort, malloc, free
 cimport openmp
 cimport numpy as np
 
-cdef void c_${name}(${c_arg_sig}):
-    cdef int i, N, across_seg_boundary
+cdef ${type} c_${name}(${c_arg_sig}):
+    cdef ${index_type} i, N
+    cdef int across_seg_boundary
     cdef ${type} a, b, item
     N = SIZE
 
@@ -370,10 +475,303 @@ cdef void c_${name}(${c_arg_sig}):
         # Output
         ${output_expr}
 
-cpdef py_${name}(${py_arg_sig}):
+    # The last item of the inclusive scan.
+    return a
+
+cpdef py_${name}(${py_arg_sig}, workspace):
+    # The serial scan does not need a workspace.
     return c_${name}(${py_args})
 '''
 
+# Every thread counts the keys of a contiguous chunk of the input in its own
+# bins.  The bins are then merged, the bins of each thread are replaced by
+# the number of keys counted by the threads before it so that adding these
+# to the rank of an element within its thread gives the rank within its bin.
+# The keys are saved in the first pass so that the ranks can be offset
+# without evaluating the key function again.  The chunks are handed out with
+# a static prange so that all of them are counted even if the parallel region
+# has fewer threads than ``get_number_of_threads`` returns.  Keys outside the
+# bins are counted in the first or last bin.
+histogram_cy_template = '''
+from cython.parallel import parallel, prange
+from libc.stdlib cimport abort, malloc, free
+from libc.string cimport memset
+cimport openmp
+''' + thread_helpers_cy_template + '''
+
+<%
+    thread_range = get_parallel_range('n_thread', nogil=True,
+                                      schedule='static', chunksize=1)
+%>
+cdef void c_${name}(${c_arg_sig}):
+    cdef ${index_type} i, start, end, chunksize
+    cdef int b, t, hist_key, tid, n_thread, total, count
+    cdef int* hist_bins
+    cdef int* my_bins
+    cdef int* hist_keys = NULL
+    n_thread = get_number_of_threads()
+    hist_bins = <int*>malloc(n_thread*n_bins*sizeof(int))
+    if hist_bins == NULL:
+        raise MemoryError("Unable to allocate memory for histogram")
+    memset(hist_bins, 0, n_thread*n_bins*sizeof(int))
+    if use_ranks and n_thread > 1:
+        hist_keys = <int*>malloc(SIZE*sizeof(int))
+        if hist_keys == NULL:
+            free(hist_bins)
+            raise MemoryError("Unable to allocate memory for histogram")
+    chunksize = (SIZE + n_thread - 1) // n_thread
+
+%if openmp:
+    for tid in ${thread_range}:
+%else:
+    for tid in range(n_thread):
+%endif
+        my_bins = hist_bins + tid*n_bins
+        start = tid*chunksize
+        end = min(start + chunksize, SIZE)
+        for i in range(start, end):
+            hist_key = min(max(${key_expr}, 0), n_bins - 1)
+            if use_ranks:
+                hist_ranks[i] = my_bins[hist_key]
+            if hist_keys != NULL:
+                hist_keys[i] = hist_key
+            my_bins[hist_key] += 1
+
+%if openmp:
+    for b in ${get_parallel_range("n_bins", nogil=True)}:
+%else:
+    for b in range(n_bins):
+%endif
+        total = 0
+        for t in range(n_thread):
+            count = hist_bins[t*n_bins + b]
+            hist_bins[t*n_bins + b] = total
+            total = total + count
+        hist_counts[b] = total
+
+    if use_ranks and n_thread > 1:
+%if openmp:
+        for tid in ${thread_range}:
+%else:
+        for tid in range(n_thread):
+%endif
+            my_bins = hist_bins + tid*n_bins
+            start = tid*chunksize
+            end = min(start + chunksize, SIZE)
+            for i in range(start, end):
+                hist_ranks[i] += my_bins[hist_keys[i]]
+
+    free(hist_keys)
+    free(hist_bins)
+
+
+cpdef py_${name}(${py_arg_sig}):
+    c_${name}(${py_args})
+'''
+
+# The OpenCL/CUDA kernels count in work group local bins which are added to
+# the global counts at the end.  The value returned by the atomic add is the
+# number of keys in the bin counted by the groups that were done earlier which
+# is the offset of the ranks of the group.  The keys are saved in
+# ``hist_keys`` to add these offsets to the ranks.  The ``_global`` kernel is
+# used when the bins do not fit in local memory.
+histogram_gpu_template = '''
+<% atomic_add = 'atomic_add' if backend == 'opencl' else 'atomicAdd' %>
+KERNEL void ${name}(${c_arg_sig}
+% if backend == 'opencl':
+    , LOCAL_MEM int *hist_bins
+% endif
+)
+{
+% if backend == 'cuda':
+    extern __shared__ int hist_bins[];
+% endif
+    ${index_type} i;
+    int b, hist_key;
+    int lid = LID_0;
+    int lsize = LDIM_0;
+    int stride = GDIM_0*LDIM_0;
+
+    for (b = lid; b < n_bins; b += lsize) {
+        hist_bins[b] = 0;
+    }
+    local_barrier();
+
+    for (i = GID_0*LDIM_0 + lid; i < SIZE; i += stride) {
+        hist_key = min(max(${key_expr}, 0), n_bins - 1);
+% if backend == 'opencl':
+        b = atomic_inc(&hist_bins[hist_key]);
+% else:
+        b = atomicAdd(&hist_bins[hist_key], 1);
+% endif
+        if (use_ranks) {
+            hist_ranks[i] = b;
+            hist_keys[i] = hist_key;
+        }
+    }
+    local_barrier();
+
+    for (b = lid; b < n_bins; b += lsize) {
+        if (hist_bins[b] > 0) {
+            hist_bins[b] = ${atomic_add}(&hist_counts[b], hist_bins[b]);
+        }
+    }
+
+    if (use_ranks) {
+        local_barrier();
+        for (i = GID_0*LDIM_0 + lid; i < SIZE; i += stride) {
+            hist_ranks[i] += hist_bins[hist_keys[i]];
+        }
+    }
+}
+
+KERNEL void ${name}_global(${c_arg_sig})
+{
+    ${index_type} i;
+    int hist_key, rank;
+    int stride = GDIM_0*LDIM_0;
+    for (i = GID_0*LDIM_0 + LID_0; i < SIZE; i += stride) {
+        hist_key = min(max(${key_expr}, 0), n_bins - 1);
+% if backend == 'opencl':
+        rank = atomic_inc(&hist_counts[hist_key]);
+% else:
+        rank = atomicAdd(&hist_counts[hist_key], 1);
+% endif
+        if (use_ranks) hist_ranks[i] = rank;
+    }
+}
+'''
+
+
+# Every thread reduces a contiguous chunk of the elements so the work is
+# balanced whatever the lengths of the segments.  The segments that lie
+# within a chunk are written directly.  The two segments at the ends of a
+# chunk may be shared with other threads, their partial results are combined
+# in order at the end.
+segmented_reduction_cy_template = '''
+from cython.parallel import parallel, prange
+from libc.stdlib cimport abort, malloc, free
+from libc.math cimport INFINITY
+cimport openmp
+
+cdef double INFTY = float('inf')
+''' + thread_helpers_cy_template + '''
+
+<%
+    thread_range = get_parallel_range('n_thread', nogil=True,
+                                      schedule='static', chunksize=1)
+%>
+cdef void c_${name}(${c_arg_sig}):
+    cdef ${index_type} i, s, lo, hi, mid, start, end, chunksize
+    cdef int t, tid, n_thread
+    cdef ${type} a, b, acc
+    cdef ${index_type}* part_seg
+    cdef ${type}* part_val
+    n_thread = get_number_of_threads()
+    part_seg = <${index_type}*>malloc(2*n_thread*sizeof(${index_type}))
+    part_val = <${type}*>malloc(2*n_thread*sizeof(${type}))
+    if part_seg == NULL or part_val == NULL:
+        raise MemoryError("Unable to allocate memory for segmented reduction")
+    chunksize = (SIZE + n_thread - 1) // n_thread
+
+%if openmp:
+    for s in ${get_parallel_range("n_segments", nogil=True)}:
+%else:
+    for s in range(n_segments):
+%endif
+        seg_out[s] = ${neutral}
+
+%if openmp:
+    for tid in ${thread_range}:
+%else:
+    for tid in range(n_thread):
+%endif
+        part_seg[2*tid] = -1
+        part_seg[2*tid + 1] = -1
+        start = tid*chunksize
+        end = min(start + chunksize, SIZE)
+        if start < end and n_segments > 0:
+            # Find the segment containing the first element.
+            lo = 0
+            hi = n_segments
+            while hi - lo > 1:
+                mid = (lo + hi) // 2
+                if seg_offsets[mid] <= start:
+                    lo = mid
+                else:
+                    hi = mid
+            s = lo
+            acc = ${neutral}
+            for i in range(start, end):
+                if i == seg_offsets[s + 1]:
+                    if seg_offsets[s] < start:
+                        part_seg[2*tid] = s
+                        part_val[2*tid] = acc
+                    else:
+                        seg_out[s] = acc
+                    # Skip any empty segments.
+                    s = s + 1
+                    while seg_offsets[s + 1] <= i:
+                        s = s + 1
+                    acc = ${neutral}
+                a = acc
+                b = ${map_expr}
+                acc = ${reduce_expr}
+            if seg_offsets[s] < start:
+                part_seg[2*tid] = s
+                part_val[2*tid] = acc
+            elif seg_offsets[s + 1] > end:
+                part_seg[2*tid + 1] = s
+                part_val[2*tid + 1] = acc
+            else:
+                seg_out[s] = acc
+
+    for t in range(2*n_thread):
+        s = part_seg[t]
+        if s >= 0:
+            a = seg_out[s]
+            b = part_val[t]
+            seg_out[s] = ${reduce_expr}
+
+    free(part_seg)
+    free(part_val)
+
+
+cpdef py_${name}(${py_arg_sig}):
+    c_${name}(${py_args})
+'''
+
+# Each work item reduces a whole segment.
+segmented_reduction_gpu_template = '''
+KERNEL void ${name}(${c_arg_sig})
+{
+    ${index_type} i, s;
+    ${index_type} stride = GDIM_0*LDIM_0;
+    ${type} a, b;
+    for (s = GID_0*LDIM_0 + LID_0; s < n_segments; s += stride) {
+        a = ${neutral};
+        for (i = seg_offsets[s]; i < seg_offsets[s + 1]; i++) {
+            b = ${map_expr};
+            a = ${reduce_expr};
+        }
+        seg_out[s] = a;
+    }
+}
+'''
+
+
+class TimedTemplate(Template):
+    """A mako template whose compilation and rendering are timed as the
+    'render' phase of the kernel being built, see ``profile.build_phase``.
+    """
+    def __init__(self, *args, **kw):
+        with build_phase('render'):
+            super(TimedTemplate, self).__init__(*args, **kw)
+
+    def render(self, *args, **kw):
+        with build_phase('render'):
+            return super(TimedTemplate, self).render(*args, **kw)
+
 
 def drop_duplicates(arr):
     result = []
@@ -397,10 +795,285 @@ def serial(func=None, **kw):
         return wrapper(func)
 
 
+def finish_launch(backend, queue=None, async_launch=None):
+    """Complete a kernel launch on the given backend.
+
+    By default this waits for the launched kernel to finish.  If
+    `async_launch` is True, or it is None and ``get_config().async_launch``
+    is set, an event for the launch is returned instead without waiting.  The
+    event is a ``pyopencl.Event`` on OpenCL and a ``pycuda.driver.Event`` on
+    CUDA.  Launches on the Cython backend are always synchronous.
+    """
+    if backend == 'cython':
+        return None
+    if async_launch is None:
+        async_launch = get_config().async_launch
+    if backend == 'opencl':
+        if async_launch:
+            import pyopencl as cl
+            return cl.enqueue_marker(queue)
+        queue.finish()
+    elif backend == 'cuda':
+        import pycuda.driver as drv
+        event = drv.Event()
+        event.record()
+        if async_launch:
+            return event
+        event.synchronize()
+
+
+def get_profiling_queue(obj):
+    """Return the OpenCL queue of `obj` if the device timings of its launches
+    are to be recorded and None otherwise.
+
+    The timings are recorded when profiling is enabled and the queue was
+    created with profiling enabled, see ``compyle.opencl.get_queue``.
+    """
+    if obj.backend != 'opencl' or not get_config().profile:
+        return None
+    from .opencl import get_queue, has_profiling
+    queue = obj.queue or get_queue()
+    return queue if has_profiling(queue) else None
+
+
+def start_device_timing(obj):
+    """Return a marker enqueued before a launch of several kernels by `obj`
+    whose device timing is to be recorded, see ``record_device_timing``.
+    Returns None if the timing is not recorded.
+    """
+    queue = get_profiling_queue(obj)
+    if queue is None:
+        return None
+    import pyopencl as cl
+    return cl.enqueue_marker(queue)
+
+
+def record_device_timing(obj, event, first=None):
+    """Record the device timing of a launch by `obj` given the OpenCL event
+    of its (last) kernel.  `first` is the marker from
+    ``start_device_timing`` for launches of several kernels.
+    """
+    if event is None:
+        return
+    if first is not None:
+        record_device_event(obj.name, event, first)
+    elif get_profiling_queue(obj) is not None:
+        record_device_event(obj.name, event)
+
+
+def get_array_access_counts(funcs):
+    """Return the number of times each element of the arrays indexed in the
+    given functions is moved, 1 if it is read or written and 2 if both.
+    """
+    read, written = set(), set()
+    for func in funcs:
+        if func is None:
+            continue
+        try:
+            access = get_array_access(dedent(getsource(func)))
+        except (OSError, TypeError, SyntaxError):
+            continue
+        for name, (r, w) in access.items():
+            if r:
+                read.add(name)
+            if w:
+                written.add(name)
+    return dict(
+        (name, (name in read) + (name in written)) for name in read | written
+    )
+
+
+def get_traffic_info(obj, funcs):
+    """Return the names of the arguments after the index of the first of the
+    `funcs` of `obj` and the access counts of the arrays of the `funcs`, see
+    ``get_array_access_counts``.
+
+    These are computed once and cached on `obj`.  The kernels do this when
+    they are built with profiling enabled so the calls need not parse the
+    functions.
+    """
+    info = getattr(obj, '_traffic_info', None)
+    if info is None:
+        func = funcs[0] if funcs else None
+        names = inspect.getfullargspec(func).args[1:] if func else []
+        info = obj._traffic_info = (names, get_array_access_counts(funcs))
+    return info
+
+
+def record_traffic(obj, funcs, args, names=None, size=None):
+    """Record the elements processed and the bytes moved by a launch of `obj`
+    when profiling is enabled, see ``profile.record_throughput``.
+
+    The `args` are named by `names` or else by the arguments of the first of
+    the `funcs` after the index.  The bytes moved by every array are
+    estimated from how the `funcs` index it.  The time taken is not counted
+    in the profiled call that launches the kernel.
+    """
+    if not config._profiling:
+        return
+    start = perf_counter_ns()
+    arg_names, counts = get_traffic_info(obj, funcs)
+    if names is None:
+        names = arg_names
+    names = list(names) + [None]*(len(args) - len(names))
+    record_throughput(obj.name, list(zip(names, args)), counts, size=size,
+                      backend=obj.backend)
+    exclude_from_profile(perf_counter_ns() - start)
+
+
+@profile(category='sync')
+def synchronize(backend=None):
+    """Wait for all the kernels launched on the given backend to finish.
+    """
+    backend = array.get_backend(backend)
+    if backend == 'opencl':
+        from .opencl import get_queue
+        get_queue().finish()
+    elif backend == 'cuda':
+        import pycuda.driver as drv
+        drv.Context.synchronize()
+
+
 def get_common_cache_key(obj):
     return obj.backend, obj._config.use_openmp, obj._config.use_double
 
 
+INT_MAX = np.iinfo(np.int32).max
+
+
+def get_index_type(size=0):
+    """Return the C type of the index of the kernels used for arrays of `size`
+    elements.
+
+    This is ``get_config().index_type`` if it is set.  Otherwise it is 'int'
+    unless `size` does not fit in an int in which case it is 'long'.
+    """
+    index_type = get_config().index_type
+    if index_type is None:
+        index_type = 'int' if size <= INT_MAX else 'long'
+    return index_type
+
+
+def get_index_dtype(size=0):
+    """Return the dtype of the index arrays for arrays of `size` elements,
+    see ``get_index_type``.
+    """
+    return ctype_to_dtype(get_index_type(size))
+
+
+def get_size(args):
+    """Return the length of the largest array in `args`.
+    """
+    return max([len(x) for x in args if isinstance(x, (array.Array,
+                                                       np.ndarray))] or [0])
+
+
+def with_index_type(func, index_type, names=('i',)):
+    """Return `func` with the arguments in `names` annotated with the given
+    index type.
+
+    Only arguments annotated as 'int' are changed and a copy of the function
+    is returned if any are, otherwise `func` itself is returned.
+    """
+    annotations = getattr(func, '__annotations__', None) or {}
+
+    def _is_int(name):
+        ann = annotations.get(name)
+        return isinstance(ann, KnownType) and ann.type == 'int'
+
+    names = [name for name in names if _is_int(name)]
+    if index_type == 'int' or not names:
+        return func
+    new_func = types.FunctionType(
+        func.__code__, func.__globals__, func.__name__, func.__defaults__,
+        func.__closure__
+    )
+    new_func.__dict__.update(func.__dict__)
+    new_func.__annotations__ = dict(annotations)
+    for name in names:
+        new_func.__annotations__[name] = KnownType(index_type)
+    return new_func
+
+
+def get_index_variant(obj, args):
+    """Return the kernel object to launch with the given arguments.
+
+    This is `obj` itself if its index type is the one needed for the
+    arguments, see ``get_index_type``.  Otherwise a copy of `obj` for the
+    other index type is made and cached, so the kernels for both index types
+    are generated at most once.
+    """
+    index_type = get_index_type(get_size(args))
+    if index_type == obj.index_type:
+        return obj
+    variant = obj._index_variants.get(index_type)
+    if variant is None:
+        variant = copy.copy(obj)
+        variant.index_type = index_type
+        # The code is generated with the configuration of the kernel.
+        orig_config = get_config()
+        set_config(obj._config)
+        try:
+            variant.tp = Transpiler(backend=obj.backend,
+                                    incl_cluda=obj.tp.incl_cluda)
+            variant._build()
+        finally:
+            set_config(orig_config)
+        obj._index_variants[index_type] = variant
+    return variant
+
+
+def get_index_key(obj, kind, funcs, *extra):
+    """Return the key used to lookup the kernel in the on-disk kernel index or
+    None if the index is not used.
+    """
+    index = get_kernel_index()
+    if index is None or obj.backend != 'cython':
+        return None
+    extra = extra + (obj.index_type,)
+    return index.get_key(kind, funcs, extra=extra, backend=obj.backend,
+                         config=obj._config)
+
+
+def load_from_index(obj):
+    """Load the kernel for the given object from the kernel index.
+
+    Returns the Python wrapper function of the kernel or None if the kernel is
+    not in the index.  The ``source``, ``all_source`` attributes of the object
+    are also setup.
+    """
+    index = get_kernel_index()
+    key = getattr(obj, '_index_key', None)
+    if index is None or key is None:
+        return None
+    entry = index.get(key, backend=obj.backend)
+    if entry is None:
+        return None
+    with build_phase('load'):
+        obj.tp.mod = index.load(entry)
+    obj.source = entry['source']
+    try:
+        with open(entry['src_path']) as f:
+            obj.all_source = f.read()
+    except OSError:
+        obj.all_source = obj.source
+    obj._index_entry = entry
+    # The module is named after the hash of its source, see ExtModule.
+    update_build_record(cache='index', source_hash=entry['name'][2:])
+    return getattr(obj.tp.mod, entry['func_name'])
+
+
+def add_to_index(obj, funcs, func_name, **data):
+    """Add the kernel just compiled for the object to the kernel index.
+    """
+    index = get_kernel_index()
+    key = getattr(obj, '_index_key', None)
+    if index is None or key is None:
+        return
+    index.put(key, funcs, obj.tp.ext_module, backend=obj.backend,
+              func_name=func_name, source=obj.source, **data)
+
+
 class ElementwiseBase(object):
     def __init__(self, func, backend=None):
         backend = array.get_backend(backend)
@@ -415,9 +1088,32 @@ class ElementwiseBase(object):
         self.source = '# Source not yet generated.'
         # This is all the source code used for the elementwise.
         self.all_source = '# Source not yet generated.'
-        self.c_func = self._generate()
+        self.index_type = get_index_type()
+        self._index_variants = {}
+        self._build()
+
+    def _build(self):
+        with build_record(self):
+            self._index_key = self._get_index_key()
+            self.c_func = self._load_from_index()
+            if self.c_func is None:
+                self.c_func = self._generate()
+        if config._profiling:
+            get_traffic_info(self, self._get_traffic_funcs())
+
+    def _get_traffic_funcs(self):
+        return [self.func]
+
+    def _get_index_key(self, *extra):
+        return get_index_key(
+            self, 'elementwise', [self.func], elementwise_cy_template, *extra
+        )
+
+    def _load_from_index(self):
+        return load_from_index(self)
 
     def _generate(self, declarations=None):
+        self.func = with_index_type(self.func, self.index_type)
         self.tp.add(self.func, declarations=declarations)
         if self.backend == 'cython':
             # FIXME: Handle the name of the kernel correctly
@@ -425,13 +1121,14 @@ class ElementwiseBase(object):
             py_defn = ['long SIZE'] + py_data[0][1:]
             c_defn = ['long SIZE'] + c_data[0][1:]
             py_args = ['SIZE'] + py_data[1][1:]
-            template = Template(text=elementwise_cy_template)
+            template = TimedTemplate(text=elementwise_cy_template)
             src = template.render(
                 name=self.name[7:],
                 c_arg_sig=', '.join(c_defn),
                 c_args=', '.join(c_data[1]),
                 py_arg_sig=', '.join(py_defn),
                 py_args=', '.join(py_args),
+                index_type=self.index_type,
                 openmp=self._config.use_openmp and not getattr(
                     self.func, 'is_serial', False),
                 get_parallel_range=get_parallel_range
@@ -442,7 +1139,9 @@ class ElementwiseBase(object):
             self.tp.compile()
             # All the source code for the elementwise
             self.all_source = self.tp.source
-            return getattr(self.tp.mod, 'py_' + self.name[7:])
+            func_name = 'py_' + self.name[7:]
+            add_to_index(self, [self.func], func_name)
+            return getattr(self.tp.mod, func_name)
         elif self.backend == 'opencl':
             py_data, c_data = self.cython_gen.get_func_signature(self.func)
             self._correct_opencl_address_space(c_data)
@@ -459,7 +1158,7 @@ class ElementwiseBase(object):
             )
             arguments = convert_to_float_if_needed(', '.join(c_data[0][1:]))
             preamble = convert_to_float_if_needed(self.tp.get_code())
-            cluda_preamble = Template(text=CLUDA_PREAMBLE).render(
+            cluda_preamble = TimedTemplate(text=CLUDA_PREAMBLE).render(
                 double_support=True
             )
             knl = ElementwiseKernel(
@@ -489,7 +1188,7 @@ class ElementwiseBase(object):
             )
             arguments = convert_to_float_if_needed(', '.join(c_data[0][1:]))
             preamble = convert_to_float_if_needed(self.tp.get_code())
-            cluda_preamble = Template(text=CLUDA_PREAMBLE).render(
+            cluda_preamble = TimedTemplate(text=CLUDA_PREAMBLE).render(
                 double_support=True
             )
             knl = ElementwiseKernel(
@@ -530,28 +1229,106 @@ class ElementwiseBase(object):
 
     def _massage_arg(self, x):
         if isinstance(x, array.Array):
+            if x._dependents:
+                x._evaluate_dependents()
             return x.dev
         elif self.backend != 'cuda' or isinstance(x, np.ndarray):
             return x
         else:
             return np.asarray(x)
 
-    @profile
-    def __call__(self, *args, **kw):
+    def _get_c_func(self, *args):
+        return get_index_variant(self, args).c_func
+
+    def _get_c_args(self, args):
         c_args = [self._massage_arg(x) for x in args]
         if self.backend == 'cython':
             size = len(c_args[0])
             c_args.insert(0, size)
-            self.c_func(*c_args, **kw)
-        elif self.backend == 'opencl':
-            self.c_func(*c_args, **kw)
-            self.queue.finish()
-        elif self.backend == 'cuda':
-            import pycuda.driver as drv
-            event = drv.Event()
-            self.c_func(*c_args, **kw)
-            event.record()
-            event.synchronize()
+        return c_args
+
+    def _launch(self, c_func, c_args, kw, async_launch=None):
+        event = c_func(*c_args, **kw)
+        if self.backend == 'opencl':
+            record_device_timing(self, event)
+        return finish_launch(self.backend, self.queue, async_launch)
+
+    @profile
+    def __call__(self, *args, **kw):
+        """Launch the kernel.
+
+        Pass `async_launch=True` to not wait for an OpenCL/CUDA kernel to
+        finish, the event for the launch is returned in this case.  This
+        defaults to ``get_config().async_launch``.
+        """
+        async_launch = kw.pop('async_launch', None)
+        record_traffic(self, self._get_traffic_funcs(), args)
+        return self._launch(
+            self._get_c_func(*args), self._get_c_args(args), kw, async_launch
+        )
+
+    def bind(self, *args, **kw):
+        """Return a callable that launches the kernel with the given
+        arguments, see ``BoundCall``.
+        """
+        return BoundCall(self, args, kw)
+
+
+class BoundCall(object):
+    """A kernel launch whose arguments are prepared in advance.
+
+    The kernel, the arguments passed to the generated code and the size are
+    only computed when the call is created.  Calling it simply launches the
+    kernel again which avoids most of the Python overhead of a normal call.
+    The arguments are prepared again only if any of the arrays passed in is
+    reallocated, for example by ``Array.resize``.  Note that the values of
+    scalar arguments are fixed when the call is created.
+
+    The calls are profiled only if ``get_config().profile`` is set when the
+    call is created.
+
+    Example
+    -------
+
+    >>> e = Elementwise(axpb)
+    >>> step = e.bind(x, y, a, b)
+    >>> for i in range(1000):
+    ...     step()
+    """
+    def __init__(self, kernel, args, kw):
+        self.kernel = kernel
+        self.args = args
+        self.kw = dict(kw)
+        self.async_launch = self.kw.pop('async_launch', None)
+        self.name = kernel.name
+        self._arrays = [x for x in args if isinstance(x, array.Array)]
+        self._profile = get_config().profile
+        self._prepare()
+
+    def _prepare(self):
+        self._devs = [x.dev for x in self._arrays]
+        self.c_func = self.kernel._get_c_func(*self.args)
+        self.c_args = self.kernel._get_c_args(self.args)
+
+    def _call(self):
+        for x, dev in zip(self._arrays, self._devs):
+            if x._dependents:
+                x._evaluate_dependents()
+            if x.dev is not dev:
+                self._prepare()
+                break
+        return self.kernel._launch(
+            self.c_func, self.c_args, self.kw, self.async_launch
+        )
+
+    def __call__(self):
+        if self._profile:
+            record_traffic(self.kernel, self.kernel._get_traffic_funcs(),
+                           self.args)
+            with profile_ctx(self.name):
+                return self._call()
+        else:
+            return self._call()
 
 
 class Elementwise(object):
@@ -563,59 +1340,1001 @@ class Elementwise(object):
     def _setup(self):
         func = self._func
         backend = array.get_backend(self._backend)
-        if getattr(func, '__annotations__',
-                   None) and not hasattr(func, 'is_jit'):
-            self.elementwise = ElementwiseBase(func, backend=backend)
+        if getattr(func, '__annotations__',
+                   None) and not hasattr(func, 'is_jit'):
+            self.elementwise = ElementwiseBase(func, backend=backend)
+        else:
+            from .jit import ElementwiseJIT
+            self.elementwise = ElementwiseJIT(func, backend=backend)
+
+    def __getattr__(self, name):
+        return getattr(self.elementwise, name)
+
+    def __dir__(self):
+        return sorted(dir(self.elementwise) + ['elementwise'])
+
+    def __call__(self, *args, **kwargs):
+        if self.elementwise is None:
+            self._setup()
+        return self.elementwise(*args, **kwargs)
+
+    def bind(self, *args, **kwargs):
+        if self.elementwise is None:
+            self._setup()
+        return self.elementwise.bind(*args, **kwargs)
+
+    def set_backend(self, backend=None):
+        self._backend = backend
+        self.elementwise = None
+
+
+def elementwise(func=None, backend=None):
+    def _wrapper(function):
+        return wraps(function)(Elementwise(function, backend=backend))
+
+    if func is None:
+        return _wrapper
+    else:
+        return _wrapper(func)
+
+
+def fuse_functions(funcs, name=None):
+    """Return a single elementwise function that calls the given functions in
+    turn for each index.
+
+    The arguments of the fused function are the union of the arguments of the
+    given functions in the order in which they first appear, arguments with
+    the same name are shared.  The type annotations are also merged and an
+    argument must have the same type in all the functions that use it.  If
+    the last function returns a value, the fused function returns it, which
+    allows the fused function to be used as the `map_func` of a Reduction.
+
+    Parameters
+    ----------
+
+    funcs: list: elementwise functions taking the index `i` as the first
+        argument.
+    name: str: name of the fused function, defaults to the names of the
+        functions joined with an underscore.
+    """
+    funcs = list(funcs)
+    if not funcs:
+        raise ValueError('Need at least one function to fuse.')
+    names = [f.__name__ for f in funcs]
+    if len(set(names)) != len(set(funcs)):
+        raise ValueError(
+            'Functions to be fused must have unique names: %s' % names
+        )
+    if name is None:
+        name = 'fused_' + '_'.join(names)
+
+    args = ['i']
+    annotations = {}
+    is_jit = False
+    calls = []
+    for f in funcs:
+        f_args = inspect.getfullargspec(f).args
+        if not f_args or f_args[0] != 'i':
+            raise ValueError(
+                'The first argument of %s should be "i".' % f.__name__
+            )
+        f_annotations = getattr(f, '__annotations__', {})
+        for arg in f_args:
+            if arg not in args:
+                args.append(arg)
+            if arg not in f_annotations:
+                is_jit = True
+                continue
+            arg_type = f_annotations[arg]
+            if annotations.setdefault(arg, arg_type) != arg_type:
+                raise ValueError(
+                    'Argument "%s" of %s has type %s but %s elsewhere.' % (
+                        arg, f.__name__, arg_type, annotations[arg]
+                    )
+                )
+        calls.append('    {func}({args})'.format(
+            func=f.__name__, args=', '.join(f_args)
+        ))
+
+    last = funcs[-1]
+    if has_return(dedent(getsource(last))):
+        calls[-1] = '    return' + calls[-1][3:]
+        if 'return' in getattr(last, '__annotations__', {}):
+            annotations['return'] = last.__annotations__['return']
+
+    src = 'def {name}({args}):\n{body}\n'.format(
+        name=name, args=', '.join(args), body='\n'.join(calls)
+    )
+    # The transpiler looks up the called functions in the module of the
+    # function, so the fused function is defined in a module of its own.
+    modname = 'compyle_fused_%s' % get_md5(src)
+    mod = types.ModuleType(modname)
+    for f in funcs:
+        setattr(mod, f.__name__, f)
+    exec(compile(src, '<%s>' % modname, 'exec'), mod.__dict__)
+    sys.modules[modname] = mod
+    func = getattr(mod, name)
+    func.source = src
+    func.is_jit = is_jit
+    if not is_jit:
+        func.__annotations__ = annotations
+    if any(getattr(f, 'is_serial', False) for f in funcs):
+        func.is_serial = True
+    return func
+
+
+def fuse(funcs, backend=None, name=None):
+    """Fuse the given elementwise functions into one Elementwise kernel.
+
+    The kernel runs a single loop which calls each function in turn for each
+    index, so arrays used by several functions are only streamed through
+    memory once.  See ``fuse_functions`` for how the arguments are combined.
+
+    Example
+    -------
+
+    >>> step = fuse([update_velocity, update_position, reset_force])
+    >>> step(v, x, f, dt)
+    """
+    return Elementwise(fuse_functions(funcs, name=name), backend=backend)
+
+
+def get_struct_dtype(dtype_out):
+    """Return the structured dtype of the result of a reduction to several
+    values or None for a reduction to a single value.
+
+    A tuple of dtypes is made into a structured dtype with the fields named
+    ``f0``, ``f1`` and so on.
+    """
+    if isinstance(dtype_out, (list, tuple)):
+        return np.dtype([('f%d' % i, dtype) for i, dtype in
+                         enumerate(dtype_out)])
+    dtype = np.dtype(dtype_out)
+    return dtype if dtype.names else None
+
+
+def _is_typed(func):
+    return bool(getattr(func, '__annotations__', None)) and \
+        not hasattr(func, 'is_jit')
+
+
+class ReductionBase(object):
+    def __init__(self, reduce_expr, map_func=None, dtype_out=np.float64,
+                 neutral='0', backend=None):
+        backend = array.get_backend(backend)
+        self.tp = Transpiler(backend=backend)
+        self.backend = backend
+        self.reduce_expr = reduce_expr
+        self.dtype_out = dtype_out
+        self._set_map_func(map_func)
+        self._set_output_type(neutral)
+        self._config = get_config()
+        self.cython_gen = CythonGenerator()
+        self.queue = None
+        # The scratch memory of the Cython reduction.
+        self.workspace = Workspace()
+        # This is the source generated for the user code.
+        self.source = '# Source not yet generated.'
+        # This is all the source code used.
+        self.all_source = '# Source not yet generated.'
+        self.index_type = get_index_type()
+        self._index_variants = {}
+        self._build()
+
+    def _set_map_func(self, map_func):
+        # A reduction to several values may use a map function per field.
+        self.struct_dtype = get_struct_dtype(self.dtype_out)
+        self.map_funcs = None
+        if self.struct_dtype is None:
+            if isinstance(map_func, (list, tuple)):
+                map_func = fuse_functions(map_func)
+            funcs = [map_func] if map_func is not None else []
+        else:
+            n_fields = len(self.struct_dtype.names)
+            if isinstance(map_func, (list, tuple)):
+                if len(map_func) != n_fields:
+                    raise ValueError(
+                        'Need one map function for each of the %d fields of '
+                        'the result, got %d.' % (n_fields, len(map_func))
+                    )
+                self.map_funcs = list(map_func)
+            elif map_func is not None:
+                self.map_funcs = [map_func]*n_fields
+            funcs = self._get_map_funcs()
+            names = [f.__name__ for f in funcs]
+            if len(set(names)) != len(funcs):
+                raise ValueError(
+                    'Map functions must have unique names: %s' % names
+                )
+            # The first map function is used to cache the JIT kernels.
+            map_func = funcs[0] if funcs else None
+        self.func = map_func
+        if funcs:
+            self.name = 'reduce_' + '_'.join(f.__name__ for f in funcs)
+        else:
+            self.name = 'reduce'
+
+    def _get_map_funcs(self):
+        funcs = []
+        for func in self.map_funcs or []:
+            if func not in funcs:
+                funcs.append(func)
+        return funcs
+
+    def _set_output_type(self, neutral):
+        if self.struct_dtype is None:
+            self.type = dtype_to_ctype(self.dtype_out, backend=self.backend)
+        else:
+            n_fields = len(self.struct_dtype.names)
+            for name, value in (('reduce_expr', self.reduce_expr),
+                                ('neutral', neutral)):
+                if not isinstance(value, (list, tuple)) or \
+                   len(value) != n_fields:
+                    raise ValueError(
+                        '%s must be a tuple with one entry for each of the '
+                        '%d fields of the result.' % (name, n_fields)
+                    )
+            self.reduce_expr = tuple(self.reduce_expr)
+            # The name is unique for the fields as the struct is registered
+            # by name on the GPU.
+            self.type = '%s_%s' % (
+                self.name, get_md5(str(self.struct_dtype.descr))[:8]
+            )
+        if self.backend == 'cython':
+            # On Windows, INFINITY is not defined so we use INFTY which we
+            # internally define.
+            if self.struct_dtype is None:
+                neutral = neutral.replace('INFINITY', 'INFTY')
+            else:
+                neutral = [x.replace('INFINITY', 'INFTY') for x in neutral]
+        self.neutral = neutral if self.struct_dtype is None else tuple(neutral)
+
+    def _build(self):
+        with build_record(self):
+            self._index_key = self._get_index_key()
+            self.c_func = self._load_from_index()
+            if self.c_func is None:
+                self.c_func = self._generate()
+        if config._profiling:
+            get_traffic_info(self, self._get_traffic_funcs())
+
+    def _get_index_key(self, *extra):
+        if self.struct_dtype is None:
+            funcs = [self.func]
+        else:
+            funcs = self._get_map_funcs()
+            extra = (struct_reduction_cy_template,
+                     str(self.struct_dtype.descr)) + extra
+        return get_index_key(
+            self, 'reduction', funcs, reduction_cy_template,
+            self.reduce_expr, self.neutral, self.type, *extra
+        )
+
+    def _load_from_index(self):
+        return load_from_index(self)
+
+    def _generate(self, declarations=None):
+        if self.struct_dtype is not None:
+            return self._generate_struct(declarations)
+        if self.func is not None:
+            self.func = with_index_type(self.func, self.index_type)
+        if self.backend == 'cython':
+            if self.func is not None:
+                self.tp.add(self.func, declarations=declarations)
+                py_data, c_data = self.cython_gen.get_func_signature(self.func)
+                self._correct_return_type(c_data)
+                name = self.func.__name__
+                cargs = ', '.join(c_data[1])
+                map_expr = '{name}({cargs})'.format(name=name, cargs=cargs)
+            else:
+                index = '{type} i'.format(type=self.index_type)
+                py_data = ([index, '{type}[:] inp'.format(type=self.type)],
+                           ['i', '&inp[0]'])
+                c_data = ([index, '{type}* inp'.format(type=self.type)],
+                          ['i', 'inp'])
+                map_expr = 'inp[i]'
+            py_defn = ['long SIZE'] + py_data[0][1:]
+            c_defn = ['long SIZE'] + c_data[0][1:]
+            py_args = ['SIZE'] + py_data[1][1:]
+            template = TimedTemplate(text=reduction_cy_template)
+            src = template.render(
+                name=self.name,
+                type=self.type,
+                index_type=self.index_type,
+                map_expr=map_expr,
+                reduce_expr=self.reduce_expr,
+                neutral=self.neutral,
+                c_arg_sig=', '.join(c_defn),
+                py_arg_sig=', '.join(py_defn),
+                py_args=', '.join(py_args),
+                openmp=self._config.use_openmp,
+                get_parallel_range=get_parallel_range
+            )
+            # This is the user code source.
+            self.source = self.tp.get_code()
+            self.tp.add_code(src)
+            self.tp.compile()
+            self.all_source = self.tp.source
+            func_name = 'py_' + self.name
+            add_to_index(self, [self.func], func_name)
+            return getattr(self.tp.mod, func_name)
+        elif self.backend == 'opencl':
+            if self.func is not None:
+                self.tp.add(self.func, declarations=declarations)
+                py_data, c_data = self.cython_gen.get_func_signature(self.func)
+                self._correct_opencl_address_space(c_data)
+                name = self.func.__name__
+                expr = '{func}({args})'.format(
+                    func=name,
+                    args=', '.join(c_data[1])
+                )
+                arguments = convert_to_float_if_needed(
+                    ', '.join(c_data[0][1:])
+                )
+                preamble = convert_to_float_if_needed(self.tp.get_code())
+            else:
+                arguments = '{type} *in'.format(type=self.type)
+                expr = None
+                preamble = ''
+
+            from .opencl import get_context, get_queue
+            from pyopencl.reduction import ReductionKernel
+            from pyopencl._cluda import CLUDA_PREAMBLE
+            cluda_preamble = TimedTemplate(text=CLUDA_PREAMBLE).render(
+                double_support=True
+            )
+
+            ctx = get_context()
+            self.queue = get_queue()
+            knl = ReductionKernel(
+                ctx,
+                dtype_out=self.dtype_out,
+                neutral=self.neutral,
+                reduce_expr=self.reduce_expr,
+                map_expr=expr,
+                arguments=arguments,
+                preamble="\n".join([cluda_preamble, preamble])
+            )
+            # only code we generate is saved here.
+            self.source = "\n".join([cluda_preamble, preamble])
+            if knl.stage_1_inf.source:
+                self.all_source = "\n".join([
+                    "// ------ stage 1 -----",
+                    knl.stage_1_inf.source,
+                    "// ------ stage 2 -----",
+                    knl.stage_2_inf.source,
+                ])
+            else:
+                self.all_source = self.source
+            return knl
+        elif self.backend == 'cuda':
+            if self.func is not None:
+                self.tp.add(self.func, declarations=declarations)
+                py_data, c_data = self.cython_gen.get_func_signature(self.func)
+                self._correct_opencl_address_space(c_data)
+                name = self.func.__name__
+                expr = '{func}({args})'.format(
+                    func=name,
+                    args=', '.join(c_data[1])
+                )
+                arguments = convert_to_float_if_needed(
+                    ', '.join(c_data[0][1:])
+                )
+                preamble = convert_to_float_if_needed(self.tp.get_code())
+            else:
+                arguments = '{type} *in'.format(type=self.type)
+                expr = None
+                preamble = ''
+
+            from .cuda import set_context
+            set_context()
+            from pycuda.reduction import ReductionKernel
+            from pycuda._cluda import CLUDA_PREAMBLE
+            cluda_preamble = TimedTemplate(text=CLUDA_PREAMBLE).render(
+                double_support=True
+            )
+
+            knl = ReductionKernel(
+                dtype_out=self.dtype_out,
+                neutral=self.neutral,
+                reduce_expr=self.reduce_expr,
+                map_expr=expr,
+                arguments=arguments,
+                preamble="\n".join([cluda_preamble, preamble])
+            )
+            # only code we generate is saved here.
+            self.source = cluda_preamble + preamble
+            # FIXME: it is difficult to get the sources from pycuda.
+            self.all_source = self.source
+            return knl
+
+    def _correct_return_type(self, c_data, func=None, type=None):
+        func = self.func if func is None else func
+        code = self.tp.blocks[-1].code.splitlines()
+        if self._config.use_openmp:
+            gil = " noexcept nogil"
+        else:
+            gil = ""
+        code[0] = "cdef inline {type} {name}({args}){gil}:".format(
+            type=type or self.type, name=func.__name__,
+            args=', '.join(c_data[0]), gil=gil
+        )
+        self.tp.blocks[-1].code = '\n'.join(code)
+
+    def _add_address_space(self, arg):
+        if '*' in arg and 'GLOBAL_MEM' not in arg:
+            return 'GLOBAL_MEM ' + arg
+        else:
+            return arg
+
+    def _correct_opencl_address_space(self, c_data, func=None, type=None):
+        func = self.func if func is None else func
+        code = self.tp.blocks[-1].code.splitlines()
+        header_idx = 1
+        for line in code:
+            if line.rstrip().endswith(')'):
+                break
+            header_idx += 1
+
+        args = [self._add_address_space(arg) for arg in c_data[0]]
+        code[:header_idx] = wrap(
+            'WITHIN_KERNEL {type} {func}({args})'.format(
+                type=type or self.type,
+                func=func.__name__,
+                args=', '.join(args)
+            ),
+            width=78, subsequent_indent=' ' * 4, break_long_words=False
+        )
+        self.tp.blocks[-1].code = '\n'.join(code)
+
+    def _massage_arg(self, x):
+        if isinstance(x, array.Array):
+            if x._dependents:
+                x._evaluate_dependents()
+            return x.dev
+        elif self.backend != 'cuda' or isinstance(x, np.ndarray):
+            return x
+        else:
+            return np.asarray(x)
+
+    def _generate_struct(self, declarations=None):
+        names = self.struct_dtype.names
+        ctypes = [dtype_to_ctype(self.struct_dtype.fields[name][0],
+                                 backend=self.backend) for name in names]
+        fields = list(zip(names, ctypes))
+        # The arguments of all the map functions, see ``fuse_functions``.
+        arg_names, c_defn, py_defn, py_args = [], [], [], []
+        if self.map_funcs is None:
+            arg_names = ['inp']
+            c_defn = ['{type}* inp'.format(type=ctypes[0])]
+            py_defn = ['{type}[:] inp'.format(type=ctypes[0])]
+            py_args = ['&inp[0]']
+            map_exprs = [(name, 'inp[i]') for name in names]
+        else:
+            calls = {}
+            for func in self._get_map_funcs():
+                ctype = ctypes[self.map_funcs.index(func)]
+                tfunc = with_index_type(func, self.index_type)
+                self.tp.add(tfunc, declarations=declarations)
+                py_data, c_data = self.cython_gen.get_func_signature(tfunc)
+                if self.backend == 'cython':
+                    self._correct_return_type(c_data, tfunc, ctype)
+                else:
+                    self._correct_opencl_address_space(c_data, tfunc, ctype)
+                calls[func] = '{name}({args})'.format(
+                    name=func.__name__, args=', '.join(c_data[1])
+                )
+                for i, arg in enumerate(c_data[1][1:], 1):
+                    if arg not in arg_names:
+                        arg_names.append(arg)
+                        c_defn.append(c_data[0][i])
+                        py_defn.append(py_data[0][i])
+                        py_args.append(py_data[1][i])
+            map_exprs = [(name, calls[func])
+                         for name, func in zip(names, self.map_funcs)]
+        reduce_exprs = [
+            (name, self._get_field_expr(expr, name))
+            for name, expr in zip(names, self.reduce_expr)
+        ]
+        map_expr = '{name}_map({args})'.format(
+            name=self.name, args=', '.join(['i'] + arg_names)
+        )
+        map_sig = ['{type} i'.format(type=self.index_type)]
+        # This is the user code source.
+        self.source = self.tp.get_code()
+        if self.backend == 'cython':
+            src = TimedTemplate(text=struct_reduction_cy_template).render(
+                name=self.name, type=self.type, fields=fields,
+                neutral=list(zip(names, self.neutral)),
+                map_sig=', '.join(map_sig + c_defn), map_exprs=map_exprs,
+                reduce_exprs=reduce_exprs,
+                gil=' noexcept nogil' if self._config.use_openmp else ''
+            )
+            self.tp.add_code(src)
+            src = TimedTemplate(text=reduction_cy_template).render(
+                name=self.name,
+                type=self.type,
+                index_type=self.index_type,
+                map_expr=map_expr,
+                reduce_expr='%s_reduce(a, b)' % self.name,
+                neutral='%s_neutral()' % self.name,
+                c_arg_sig=', '.join(['long SIZE'] + c_defn),
+                py_arg_sig=', '.join(['long SIZE'] + py_defn),
+                py_args=', '.join(['SIZE'] + py_args),
+                openmp=self._config.use_openmp,
+                get_parallel_range=get_parallel_range
+            )
+            self.tp.add_code(src)
+            self.tp.compile()
+            self.all_source = self.tp.source
+            func_name = 'py_' + self.name
+            add_to_index(self, self._get_map_funcs(), func_name)
+            return getattr(self.tp.mod, func_name)
+
+        dtype, c_decl = self._get_gpu_struct_dtype(fields)
+        src = TimedTemplate(text=struct_reduction_gpu_template).render(
+            name=self.name, type=self.type, fields=fields, c_decl=c_decl,
+            neutral=list(zip(names, self.neutral)),
+            map_sig=', '.join(
+                map_sig + [self._add_address_space(x) for x in c_defn]
+            ),
+            map_exprs=map_exprs, reduce_exprs=reduce_exprs
+        )
+        preamble = convert_to_float_if_needed(self.tp.get_code() + src)
+        arguments = convert_to_float_if_needed(', '.join(c_defn))
+        if self.backend == 'opencl':
+            from .opencl import get_context, get_queue
+            from pyopencl.reduction import ReductionKernel
+            from pyopencl._cluda import CLUDA_PREAMBLE
+            self.queue = get_queue()
+            args = [get_context()]
+        else:
+            from .cuda import set_context
+            set_context()
+            from pycuda.reduction import ReductionKernel
+            from pycuda._cluda import CLUDA_PREAMBLE
+            args = []
+        cluda_preamble = TimedTemplate(text=CLUDA_PREAMBLE).render(
+            double_support=True
+        )
+        knl = ReductionKernel(
+            *args,
+            dtype_out=dtype,
+            neutral='%s_neutral()' % self.name,
+            reduce_expr='%s_reduce(a, b)' % self.name,
+            map_expr=map_expr,
+            arguments=arguments,
+            preamble="\n".join([cluda_preamble, preamble])
+        )
+        self.source = "\n".join([cluda_preamble, preamble])
+        self.all_source = self.source
+        return knl
+
+    def _get_field_expr(self, expr, field):
+        # ``a`` and ``b`` are the values of the field being reduced.
+        expr = re.sub(r'\b([ab])\b', r'\1_' + field, expr)
+        if self.backend == 'cython':
+            return expr
+        else:
+            return CConverter().visit(ast.parse(expr, mode='eval').body)
+
+    def _get_gpu_struct_dtype(self, fields):
+        if self.backend == 'opencl':
+            from pyopencl.tools import (get_or_register_dtype,
+                                        match_dtype_to_c_struct)
+            from .opencl import get_context
+            device = get_context().devices[0]
+        else:
+            from pycuda.tools import get_or_register_dtype
+            from .cuda import match_dtype_to_c_struct
+            device = None
+        dtype = np.dtype([
+            (name, ctype_to_dtype(convert_to_float_if_needed(ctype)))
+            for name, ctype in fields
+        ])
+        dtype, c_decl = match_dtype_to_c_struct(device, self.type, dtype)
+        dtype = get_or_register_dtype(self.type, dtype)
+        if self.backend == 'cuda':
+            lines = c_decl.splitlines()
+            template = TimedTemplate(text=struct_volatile_assign_cuda_template)
+            assign = template.render(type=self.type, fields=fields)
+            c_decl = '\n'.join(lines[:-2] + assign.splitlines() + lines[-2:])
+        return dtype, c_decl
+
+    def _get_result(self, result):
+        if self.struct_dtype is None:
+            return result
+        if isinstance(result, dict):
+            # Cython returns structs as dicts.
+            result = np.array(
+                tuple(result[name] for name in self.struct_dtype.names),
+                dtype=self.struct_dtype
+            )
+        result = np.asarray(result)[()]
+        if isinstance(self.dtype_out, (list, tuple)):
+            return tuple(result[name] for name in self.struct_dtype.names)
+        return result
+
+    def _get_c_func(self, *args):
+        return get_index_variant(self, args).c_func
+
+    def _get_traffic_funcs(self):
+        if self.struct_dtype is None:
+            return [self.func]
+        return self._get_map_funcs()
+
+    def _launch_gpu(self, c_func, c_args, **kw):
+        # Return the result array of the reduction on the device.
+        first = start_device_timing(self)
+        if first is None:
+            return c_func(*c_args, **kw)
+        result, event = c_func(*c_args, return_event=True, **kw)
+        record_device_timing(self, event, first)
+        return result
+
+    def _store_result(self, c_func, c_args, out, **kw):
+        # Store the result in the first element of `out` on the device.
+        if self.backend == 'cython':
+            self._massage_arg(out)[0] = self._get_result(c_func(*c_args, **kw))
+        else:
+            self._launch_gpu(c_func, c_args, out=self._massage_arg(out), **kw)
+        return out
+
+    @profile
+    def __call__(self, *args, out=None, workspace=None):
+        """Return the result of the reduction.
+
+        If an array is passed as `out`, the result is stored in its first
+        element and `out` is returned.  On the GPU backends this does not
+        wait for the kernel and copy the result to the host.  Several results
+        may be stored in one array by passing slices of it.
+
+        On the Cython backend, the scratch memory is taken from `workspace`,
+        a ``compyle.memory_pool.Workspace``, or ``self.workspace`` if it is
+        not given.  If the workspace is in use by a call from another thread,
+        a private workspace is used instead.
+        """
+        record_traffic(self, self._get_traffic_funcs(), args)
+        c_func = self._get_c_func(*args)
+        c_args = [self._massage_arg(x) for x in args]
+        if self.backend == 'cython':
+            size = len(c_args[0])
+            c_args.insert(0, size)
+            with (workspace or self.workspace).use() as ws:
+                c_args.append(ws)
+                if out is not None:
+                    return self._store_result(c_func, c_args, out)
+                return self._get_result(c_func(*c_args))
+        if out is not None:
+            return self._store_result(c_func, c_args, out)
+        # Reading the result waits for the kernel to finish.
+        result = self._launch_gpu(c_func, c_args).get()
+        return self._get_result(result)
+
+
+class Reduction(object):
+    def __init__(self, reduce_expr, map_func=None, dtype_out=np.float64,
+                 neutral='0', backend=None):
+        self._reduce_expr = reduce_expr
+        if isinstance(map_func, (list, tuple)) and \
+           get_struct_dtype(dtype_out) is None:
+            map_func = fuse_functions(map_func)
+        self._map_func = map_func
+        self._dtype_out = dtype_out
+        self._neutral = neutral
+        self._backend = backend
+        self.reduction = None
+
+    def _setup(self):
+        map_func = self._map_func
+        reduce_expr = self._reduce_expr
+        dtype_out, neutral = self._dtype_out, self._neutral
+        backend = array.get_backend(self._backend)
+        cfg = get_config()
+        if backend != 'cython' and not cfg.use_double:
+            if isinstance(dtype_out, (list, tuple)):
+                dtype_out = tuple(
+                    np.float32 if np.dtype(x) == np.float64 else x
+                    for x in dtype_out
+                )
+            elif dtype_out == np.float64:
+                dtype_out = np.float32
+        if isinstance(map_func, (list, tuple)):
+            funcs = map_func
+        else:
+            funcs = [map_func] if map_func is not None else []
+        if all(_is_typed(f) for f in funcs):
+            self.reduction = ReductionBase(reduce_expr, map_func=map_func,
+                                           dtype_out=dtype_out,
+                                           neutral=neutral,
+                                           backend=backend)
+        else:
+            from .jit import ReductionJIT
+            self.reduction = ReductionJIT(reduce_expr, map_func=map_func,
+                                          dtype_out=dtype_out,
+                                          neutral=neutral,
+                                          backend=backend)
+
+    def __dir__(self):
+        return sorted(dir(self.reduction) + ['reduction'])
+
+    def __getattr__(self, name):
+        return getattr(self.reduction, name)
+
+    def __call__(self, *args, **kwargs):
+        if self.reduction is None:
+            self._setup()
+        return self.reduction(*args, **kwargs)
+
+    def set_backend(self, backend=None):
+        self._backend = backend
+        self.reduction = None
+
+
+class SegmentedReductionBase(ReductionBase):
+    def __init__(self, reduce_expr, map_func=None, dtype_out=np.float64,
+                 neutral='0', backend=None):
+        backend = array.get_backend(backend)
+        self.tp = Transpiler(backend=backend)
+        self.backend = backend
+        if isinstance(map_func, (list, tuple)):
+            map_func = fuse_functions(map_func)
+        self.func = map_func
+        if map_func is not None:
+            self.name = 'segmented_reduce_' + map_func.__name__
+        else:
+            self.name = 'segmented_reduce'
+        self.reduce_expr = reduce_expr
+        self.dtype_out = dtype_out
+        self.type = dtype_to_ctype(dtype_out, backend=backend)
+        if backend == 'cython':
+            # On Windows, INFINITY is not defined so we use INFTY which we
+            # internally define.
+            self.neutral = neutral.replace('INFINITY', 'INFTY')
+        else:
+            self.neutral = neutral
+        self._config = get_config()
+        self.cython_gen = CythonGenerator()
+        self.queue = None
+        # This is the source generated for the user code.
+        self.source = '# Source not yet generated.'
+        # This is all the source code used.
+        self.all_source = '# Source not yet generated.'
+        self.index_type = get_index_type()
+        self._index_variants = {}
+        self._build()
+
+    def _get_index_key(self, *extra):
+        return get_index_key(
+            self, 'segmented_reduction', [self.func],
+            segmented_reduction_cy_template, self.reduce_expr, self.neutral,
+            self.type, *extra
+        )
+
+    def _generate(self, declarations=None):
+        if self.func is not None:
+            self.func = with_index_type(self.func, self.index_type)
+            self.tp.add(self.func, declarations=declarations)
+            py_data, c_data = self.cython_gen.get_func_signature(self.func)
+            map_expr = '{name}({args})'.format(
+                name=self.func.__name__, args=', '.join(c_data[1])
+            )
+        else:
+            index = '{type} i'.format(type=self.index_type)
+            py_data = ([index, '{type}[:] inp'.format(type=self.type)],
+                       ['i', '&inp[0]'])
+            c_data = ([index, '{type}* inp'.format(type=self.type)],
+                      ['i', 'inp'])
+            map_expr = 'inp[i]'
+        index_type = self.index_type
+        if self.backend == 'cython':
+            if self.func is not None:
+                self._correct_return_type(c_data)
+            c_defn = [
+                'long SIZE', '%s n_segments' % index_type,
+                '%s* seg_offsets' % index_type, '%s* seg_out' % self.type
+            ] + c_data[0][1:]
+            py_defn = [
+                'long SIZE', '%s n_segments' % index_type,
+                '%s[:] seg_offsets' % index_type, '%s[:] seg_out' % self.type
+            ] + py_data[0][1:]
+            py_args = ['SIZE', 'n_segments', '&seg_offsets[0]',
+                       '&seg_out[0]'] + py_data[1][1:]
+            template = TimedTemplate(text=segmented_reduction_cy_template)
+            src = template.render(
+                name=self.name,
+                type=self.type,
+                index_type=index_type,
+                map_expr=map_expr,
+                reduce_expr=self.reduce_expr,
+                neutral=self.neutral,
+                c_arg_sig=', '.join(c_defn),
+                py_arg_sig=', '.join(py_defn),
+                py_args=', '.join(py_args),
+                openmp=self._config.use_openmp,
+                get_parallel_range=get_parallel_range
+            )
+            # This is the user code source.
+            self.source = self.tp.get_code()
+            self.tp.add_code(src)
+            self.tp.compile()
+            self.all_source = self.tp.source
+            func_name = 'py_' + self.name
+            add_to_index(self, [self.func], func_name)
+            return getattr(self.tp.mod, func_name)
+        else:
+            if self.func is not None:
+                self._correct_opencl_address_space(c_data)
+            c_defn = [
+                '%s n_segments' % index_type,
+                'GLOBAL_MEM %s *seg_offsets' % index_type,
+                'GLOBAL_MEM %s *seg_out' % self.type
+            ] + [self._add_address_space(arg) for arg in c_data[0][1:]]
+            # The types of the scalar arguments are needed for the launch.
+            arg_dtypes = [
+                None if arg.endswith('*') else self._get_dtype(arg)
+                for arg in c_data[0][1:]
+            ]
+            if self.backend == 'opencl':
+                from .opencl import get_queue
+                self.queue = get_queue()
+            else:
+                from .cuda import set_context
+                set_context()
+            self.source = self.tp.get_code()
+            template = TimedTemplate(text=segmented_reduction_gpu_template)
+            src = template.render(
+                name=self.name,
+                type=self.type,
+                index_type=index_type,
+                map_expr=map_expr,
+                reduce_expr=self.reduce_expr,
+                neutral=self.neutral,
+                c_arg_sig=', '.join(c_defn)
+            )
+            self.tp.add_code(src)
+            self.tp.compile()
+            self.all_source = self.tp.source
+            if self.backend == 'opencl':
+                knl = getattr(self.tp.mod, self.name)
+            else:
+                knl = self.tp.mod.get_function(self.name)
+            return knl, arg_dtypes
+
+    def _get_dtype(self, arg):
+        ctype = convert_to_float_if_needed(arg.rsplit(' ', 1)[0])
+        return ctype_to_dtype(ctype)
+
+    def _massage_arg(self, x):
+        if isinstance(x, array.Array):
+            if x._dependents:
+                x._evaluate_dependents()
+            return x.dev
+        elif self.backend != 'cuda' or isinstance(x, np.ndarray):
+            return x
+        else:
+            return np.asarray(x)
+
+    def _get_gpu_args(self, args, dtypes):
+        c_args = []
+        for x, dtype in zip(args, dtypes):
+            if dtype is None:
+                dev = self._massage_arg(x)
+                c_args.append(dev.data if self.backend == 'opencl' else dev)
+            else:
+                c_args.append(dtype.type(x))
+        return c_args
+
+    def _launch_gpu(self, c_func, index_dtype, offsets, out, args):
+        knl, arg_dtypes = c_func
+        n_segments = len(out)
+        c_args = [index_dtype.type(n_segments)] + self._get_gpu_args(
+            [offsets, out], [None, None]
+        ) + self._get_gpu_args(args, arg_dtypes)
+        local_size = 128
+        n_groups = max((n_segments + local_size - 1) // local_size, 1)
+        if self.backend == 'opencl':
+            knl(self.queue, (n_groups*local_size,), (local_size,), *c_args)
+        else:
+            knl(*c_args, block=(local_size, 1, 1), grid=(n_groups, 1))
+        finish_launch(self.backend, self.queue)
+
+    @profile
+    def __call__(self, *args, **kw):
+        """Reduce each segment of the elements and return the array of the
+        results.
+
+        The segments are given by the `offsets` keyword argument, an array of
+        the ``n_segments + 1`` offsets of the segments starting with 0 and
+        ending with the number of elements.  The results are stored in `out`
+        if it is passed.  Empty segments are set to the neutral element.
+        """
+        offsets = kw.pop('offsets')
+        out = kw.pop('out', None)
+        n_segments = len(offsets) - 1
+        if out is None:
+            out = array.empty(n_segments, self.dtype_out,
+                              backend=self.backend)
+        elif len(out) != n_segments or out.dtype != self.dtype_out:
+            raise ValueError(
+                'out must be an array of %d elements of type %s'
+                % (n_segments, np.dtype(self.dtype_out))
+            )
+        if n_segments == 0:
+            return out
+        c_func = self._get_c_func(*args)
+        index_dtype = get_index_dtype(get_size(args))
+        if offsets.dtype != index_dtype:
+            offsets = array.wrap_array(offsets.dev.astype(index_dtype),
+                                       self.backend)
+        if self.backend == 'cython':
+            c_args = [len(args[0]), n_segments, self._massage_arg(offsets),
+                      self._massage_arg(out)]
+            c_args += [self._massage_arg(x) for x in args]
+            c_func(*c_args, **kw)
+        else:
+            self._launch_gpu(c_func, index_dtype, offsets, out, args)
+        return out
+
+
+class SegmentedReduction(object):
+    def __init__(self, reduce_expr, map_func=None, dtype_out=np.float64,
+                 neutral='0', backend=None):
+        self._reduce_expr = reduce_expr
+        if isinstance(map_func, (list, tuple)):
+            map_func = fuse_functions(map_func)
+        self._map_func = map_func
+        self._dtype_out = dtype_out
+        self._neutral = neutral
+        self._backend = backend
+        self.reduction = None
+
+    def _setup(self):
+        map_func = self._map_func
+        reduce_expr = self._reduce_expr
+        dtype_out, neutral = self._dtype_out, self._neutral
+        backend = array.get_backend(self._backend)
+        cfg = get_config()
+        if (backend != 'cython' and dtype_out == np.float64 and
+           not cfg.use_double):
+            dtype_out = np.float32
+        if map_func is None or getattr(map_func, '__annotations__', None) and \
+                not hasattr(map_func, 'is_jit'):
+            self.reduction = SegmentedReductionBase(
+                reduce_expr, map_func=map_func, dtype_out=dtype_out,
+                neutral=neutral, backend=backend
+            )
         else:
-            from .jit import ElementwiseJIT
-            self.elementwise = ElementwiseJIT(func, backend=backend)
-
-    def __getattr__(self, name):
-        return getattr(self.elementwise, name)
+            from .jit import SegmentedReductionJIT
+            self.reduction = SegmentedReductionJIT(
+                reduce_expr, map_func=map_func, dtype_out=dtype_out,
+                neutral=neutral, backend=backend
+            )
 
     def __dir__(self):
-        return sorted(dir(self.elementwise) + ['elementwise'])
+        return sorted(dir(self.reduction) + ['reduction'])
+
+    def __getattr__(self, name):
+        return getattr(self.reduction, name)
 
     def __call__(self, *args, **kwargs):
-        if self.elementwise is None:
+        if self.reduction is None:
             self._setup()
-        self.elementwise(*args, **kwargs)
+        return self.reduction(*args, **kwargs)
 
     def set_backend(self, backend=None):
         self._backend = backend
-        self.elementwise = None
-
-
-def elementwise(func=None, backend=None):
-    def _wrapper(function):
-        return wraps(function)(Elementwise(function, backend=backend))
-
-    if func is None:
-        return _wrapper
-    else:
-        return _wrapper(func)
+        self.reduction = None
 
 
-class ReductionBase(object):
-    def __init__(self, reduce_expr, map_func=None, dtype_out=np.float64,
-                 neutral='0', backend=None):
+class HistogramBase(object):
+    def __init__(self, key_func, n_bins=None, backend=None):
         backend = array.get_backend(backend)
         self.tp = Transpiler(backend=backend)
         self.backend = backend
-        self.func = map_func
-        if map_func is not None:
-            self.name = 'reduce_' + map_func.__name__
-        else:
-            self.name = 'reduce'
-        self.reduce_expr = reduce_expr
-        self.dtype_out = dtype_out
-        self.type = dtype_to_ctype(dtype_out, backend=backend)
-        if backend == 'cython':
-            # On Windows, INFINITY is not defined so we use INFTY which we
-            # internally define.
-            self.neutral = neutral.replace('INFINITY', 'INFTY')
-        else:
-            self.neutral = neutral
+        self.func = key_func
+        self.name = 'histogram_' + key_func.__name__
+        self.n_bins = n_bins
         self._config = get_config()
         self.cython_gen = CythonGenerator()
         self.queue = None
@@ -623,36 +2342,48 @@ class ReductionBase(object):
         self.source = '# Source not yet generated.'
         # This is all the source code used.
         self.all_source = '# Source not yet generated.'
-        self.c_func = self._generate()
+        self.index_type = get_index_type()
+        self._index_variants = {}
+        self._build()
+
+    def _build(self):
+        with build_record(self):
+            self._index_key = self._get_index_key()
+            self.c_func = self._load_from_index()
+            if self.c_func is None:
+                self.c_func = self._generate()
+
+    def _get_index_key(self, *extra):
+        return get_index_key(
+            self, 'histogram', [self.func], histogram_cy_template, *extra
+        )
+
+    def _load_from_index(self):
+        return load_from_index(self)
 
     def _generate(self, declarations=None):
+        self.func = with_index_type(self.func, self.index_type)
+        self.tp.add(self.func, declarations=declarations)
+        py_data, c_data = self.cython_gen.get_func_signature(self.func)
+        key_expr = '{name}({args})'.format(
+            name=self.func.__name__, args=', '.join(c_data[1])
+        )
         if self.backend == 'cython':
-            if self.func is not None:
-                self.tp.add(self.func, declarations=declarations)
-                py_data, c_data = self.cython_gen.get_func_signature(self.func)
-                self._correct_return_type(c_data)
-                name = self.func.__name__
-                cargs = ', '.join(c_data[1])
-                map_expr = '{name}({cargs})'.format(name=name, cargs=cargs)
-            else:
-                py_data = (['int i', '{type}[:] inp'.format(type=self.type)],
-                           ['i', '&inp[0]'])
-                c_data = (['int i', '{type}* inp'.format(type=self.type)],
-                          ['i', 'inp'])
-                map_expr = 'inp[i]'
-            py_defn = ['long SIZE'] + py_data[0][1:]
-            c_defn = ['long SIZE'] + c_data[0][1:]
-            py_args = ['SIZE'] + py_data[1][1:]
-            template = Template(text=reduction_cy_template)
+            self._correct_return_type(c_data)
+            c_defn = ['long SIZE', 'int n_bins', 'int* hist_counts',
+                      'int* hist_ranks', 'int use_ranks'] + c_data[0][1:]
+            py_defn = ['long SIZE', 'int n_bins', 'int[:] hist_counts',
+                       'int[:] hist_ranks', 'int use_ranks'] + py_data[0][1:]
+            py_args = ['SIZE', 'n_bins', '&hist_counts[0]', '&hist_ranks[0]',
+                       'use_ranks'] + py_data[1][1:]
+            template = TimedTemplate(text=histogram_cy_template)
             src = template.render(
                 name=self.name,
-                type=self.type,
-                map_expr=map_expr,
-                reduce_expr=self.reduce_expr,
-                neutral=self.neutral,
+                key_expr=key_expr,
                 c_arg_sig=', '.join(c_defn),
                 py_arg_sig=', '.join(py_defn),
                 py_args=', '.join(py_args),
+                index_type=self.index_type,
                 openmp=self._config.use_openmp,
                 get_parallel_range=get_parallel_range
             )
@@ -661,96 +2392,51 @@ class ReductionBase(object):
             self.tp.add_code(src)
             self.tp.compile()
             self.all_source = self.tp.source
-            return getattr(self.tp.mod, 'py_' + self.name)
-        elif self.backend == 'opencl':
-            if self.func is not None:
-                self.tp.add(self.func, declarations=declarations)
-                py_data, c_data = self.cython_gen.get_func_signature(self.func)
-                self._correct_opencl_address_space(c_data)
-                name = self.func.__name__
-                expr = '{func}({args})'.format(
-                    func=name,
-                    args=', '.join(c_data[1])
-                )
-                arguments = convert_to_float_if_needed(
-                    ', '.join(c_data[0][1:])
-                )
-                preamble = convert_to_float_if_needed(self.tp.get_code())
+            func_name = 'py_' + self.name
+            add_to_index(self, [self.func], func_name)
+            return getattr(self.tp.mod, func_name)
+        else:
+            self._correct_opencl_address_space(c_data)
+            c_defn = ['%s SIZE' % self.index_type, 'int n_bins',
+                      'GLOBAL_MEM int *hist_counts',
+                      'GLOBAL_MEM int *hist_ranks',
+                      'GLOBAL_MEM int *hist_keys', 'int use_ranks']
+            c_defn += [self._add_address_space(arg) for arg in c_data[0][1:]]
+            # The types of the scalar arguments are needed for the launch.
+            arg_dtypes = [
+                None if arg.endswith('*') else self._get_dtype(arg)
+                for arg in c_data[0][1:]
+            ]
+            if self.backend == 'opencl':
+                from .opencl import get_queue
+                self.queue = get_queue()
             else:
-                arguments = '{type} *in'.format(type=self.type)
-                expr = None
-                preamble = ''
-
-            from .opencl import get_context, get_queue
-            from pyopencl.reduction import ReductionKernel
-            from pyopencl._cluda import CLUDA_PREAMBLE
-            cluda_preamble = Template(text=CLUDA_PREAMBLE).render(
-                double_support=True
-            )
-
-            ctx = get_context()
-            self.queue = get_queue()
-            knl = ReductionKernel(
-                ctx,
-                dtype_out=self.dtype_out,
-                neutral=self.neutral,
-                reduce_expr=self.reduce_expr,
-                map_expr=expr,
-                arguments=arguments,
-                preamble="\n".join([cluda_preamble, preamble])
+                from .cuda import set_context
+                set_context()
+            self.source = self.tp.get_code()
+            template = TimedTemplate(text=histogram_gpu_template)
+            src = template.render(
+                name=self.name,
+                key_expr=key_expr,
+                c_arg_sig=', '.join(c_defn),
+                index_type=self.index_type,
+                backend=self.backend
             )
-            # only code we generate is saved here.
-            self.source = "\n".join([cluda_preamble, preamble])
-            if knl.stage_1_inf.source:
-                self.all_source = "\n".join([
-                    "// ------ stage 1 -----",
-                    knl.stage_1_inf.source,
-                    "// ------ stage 2 -----",
-                    knl.stage_2_inf.source,
-                ])
-            else:
-                self.all_source = self.source
-            return knl
-        elif self.backend == 'cuda':
-            if self.func is not None:
-                self.tp.add(self.func, declarations=declarations)
-                py_data, c_data = self.cython_gen.get_func_signature(self.func)
-                self._correct_opencl_address_space(c_data)
-                name = self.func.__name__
-                expr = '{func}({args})'.format(
-                    func=name,
-                    args=', '.join(c_data[1])
-                )
-                arguments = convert_to_float_if_needed(
-                    ', '.join(c_data[0][1:])
-                )
-                preamble = convert_to_float_if_needed(self.tp.get_code())
+            self.tp.add_code(src)
+            self.tp.compile()
+            self.all_source = self.tp.source
+            if self.backend == 'opencl':
+                return (getattr(self.tp.mod, self.name),
+                        getattr(self.tp.mod, self.name + '_global'),
+                        arg_dtypes)
             else:
-                arguments = '{type} *in'.format(type=self.type)
-                expr = None
-                preamble = ''
-
-            from .cuda import set_context
-            set_context()
-            from pycuda.reduction import ReductionKernel
-            from pycuda._cluda import CLUDA_PREAMBLE
-            cluda_preamble = Template(text=CLUDA_PREAMBLE).render(
-                double_support=True
-            )
+                return (self.tp.mod.get_function(self.name),
+                        self.tp.mod.get_function(self.name + '_global'),
+                        arg_dtypes)
 
-            knl = ReductionKernel(
-                dtype_out=self.dtype_out,
-                neutral=self.neutral,
-                reduce_expr=self.reduce_expr,
-                map_expr=expr,
-                arguments=arguments,
-                preamble="\n".join([cluda_preamble, preamble])
-            )
-            # only code we generate is saved here.
-            self.source = cluda_preamble + preamble
-            # FIXME: it is difficult to get the sources from pycuda.
-            self.all_source = self.source
-            return knl
+    def _get_dtype(self, arg):
+        ctype = convert_to_float_if_needed(arg.rsplit(' ', 1)[0])
+        return ctype_to_dtype(ctype)
 
     def _correct_return_type(self, c_data):
         code = self.tp.blocks[-1].code.splitlines()
@@ -758,9 +2444,8 @@ class ReductionBase(object):
             gil = " noexcept nogil"
         else:
             gil = ""
-        code[0] = "cdef inline {type} {name}({args}){gil}:".format(
-            type=self.type, name=self.func.__name__, args=', '.join(c_data[0]),
-            gil=gil
+        code[0] = "cdef inline int {name}({args}){gil}:".format(
+            name=self.func.__name__, args=', '.join(c_data[0]), gil=gil
         )
         self.tp.blocks[-1].code = '\n'.join(code)
 
@@ -780,8 +2465,7 @@ class ReductionBase(object):
 
         args = [self._add_address_space(arg) for arg in c_data[0]]
         code[:header_idx] = wrap(
-            'WITHIN_KERNEL {type} {func}({args})'.format(
-                type=self.type,
+            'WITHIN_KERNEL int {func}({args})'.format(
                 func=self.func.__name__,
                 args=', '.join(args)
             ),
@@ -791,78 +2475,176 @@ class ReductionBase(object):
 
     def _massage_arg(self, x):
         if isinstance(x, array.Array):
+            if x._dependents:
+                x._evaluate_dependents()
             return x.dev
         elif self.backend != 'cuda' or isinstance(x, np.ndarray):
             return x
         else:
             return np.asarray(x)
 
-    @profile
-    def __call__(self, *args):
-        c_args = [self._massage_arg(x) for x in args]
-        if self.backend == 'cython':
-            size = len(c_args[0])
-            c_args.insert(0, size)
-            return self.c_func(*c_args)
-        elif self.backend == 'opencl':
-            result = self.c_func(*c_args)
-            self.queue.finish()
-            return result.get()
-        elif self.backend == 'cuda':
-            import pycuda.driver as drv
-            event = drv.Event()
-            result = self.c_func(*c_args)
-            event.record()
-            event.synchronize()
-            return result.get()
+    def _get_c_func(self, *args):
+        return get_index_variant(self, args).c_func
 
+    def _get_gpu_args(self, args, dtypes):
+        c_args = []
+        for x, dtype in zip(args, dtypes):
+            if dtype is None:
+                dev = self._massage_arg(x)
+                c_args.append(dev.data if self.backend == 'opencl' else dev)
+            else:
+                c_args.append(dtype.type(x))
+        return c_args
+
+    def _launch_gpu(self, c_func, n, n_bins, counts, ranks, args):
+        local_knl, global_knl, arg_dtypes = c_func
+        use_ranks = ranks is not None
+        if ranks is None:
+            ranks = keys = counts
+        else:
+            keys = array.empty(n, np.int32, backend=self.backend)
+        # The size has the index type of the kernel.
+        c_args = [get_index_dtype(get_size(args)).type(n), np.int32(n_bins)]
+        c_args += self._get_gpu_args(
+            [counts, ranks, keys], [None, None, None]
+        ) + [np.int32(use_ranks)] + self._get_gpu_args(args, arg_dtypes)
+        local_size = 256
+        lmem_size = 4*n_bins
+        n_groups = max((n + local_size - 1) // local_size, 1)
+        if self.backend == 'opencl':
+            import pyopencl as cl
+            device = self.queue.device
+            local_size = min(local_size, device.max_work_group_size)
+            n_groups = max((n + local_size - 1) // local_size, 1)
+            if lmem_size <= device.local_mem_size // 2:
+                n_groups = min(n_groups, 4*device.max_compute_units)
+                c_args.append(cl.LocalMemory(lmem_size))
+                knl = local_knl
+            else:
+                knl = global_knl
+            knl(self.queue, (n_groups*local_size,), (local_size,), *c_args)
+        else:
+            import pycuda.driver as drv
+            device = drv.Context.get_device()
+            max_shared = device.get_attribute(
+                drv.device_attribute.MAX_SHARED_MEMORY_PER_BLOCK
+            )
+            if lmem_size <= max_shared // 2:
+                n_sm = device.get_attribute(
+                    drv.device_attribute.MULTIPROCESSOR_COUNT
+                )
+                n_groups = min(n_groups, 4*n_sm)
+                local_knl(*c_args, block=(local_size, 1, 1),
+                          grid=(n_groups, 1), shared=lmem_size)
+            else:
+                global_knl(*c_args, block=(local_size, 1, 1),
+                           grid=(n_groups, 1))
+        finish_launch(self.backend, self.queue)
 
-class Reduction(object):
-    def __init__(self, reduce_expr, map_func=None, dtype_out=np.float64,
-                 neutral='0', backend=None):
-        self._reduce_expr = reduce_expr
-        self._map_func = map_func
-        self._dtype_out = dtype_out
-        self._neutral = neutral
+    @profile
+    def __call__(self, *args, **kw):
+        """Count the keys of the elements into `counts` and return it.
+
+        The `counts` and `ranks` arrays and the number of bins `n_bins` may be
+        passed as keyword arguments.  If `ranks` is passed, the rank of each
+        element within its bin is stored in it.
+        """
+        counts = kw.pop('counts', None)
+        ranks = kw.pop('ranks', None)
+        n_bins = kw.pop('n_bins', self.n_bins)
+        if n_bins is None:
+            if counts is None:
+                raise ValueError('Pass either n_bins or counts.')
+            n_bins = len(counts)
+        if counts is None:
+            counts = array.zeros(n_bins, np.int32, backend=self.backend)
+        elif len(counts) < n_bins or counts.dtype != np.int32:
+            raise ValueError(
+                'counts must be an int32 array with at least %d elements'
+                % n_bins
+            )
+        if ranks is not None and ranks.dtype != np.int32:
+            raise ValueError('ranks must be an int32 array')
+        c_func = self._get_c_func(*args)
+        n = len(args[0])
+        if self.backend == 'cython':
+            use_ranks = ranks is not None
+            if ranks is None:
+                ranks = counts
+            c_args = [n, n_bins, self._massage_arg(counts),
+                      self._massage_arg(ranks), use_ranks]
+            c_args += [self._massage_arg(x) for x in args]
+            c_func(*c_args, **kw)
+        else:
+            counts.fill(0)
+            self._launch_gpu(c_func, n, n_bins, counts, ranks, args)
+        return counts
+
+
+class Histogram(object):
+    """Count the number of elements that fall in each bin.
+
+    The `key_func` is called as ``key_func(i, *args)`` for each element and
+    should return the bin of the element which must be in ``[0, n_bins)``.
+    Keys below 0 are counted in the first bin and keys from `n_bins` on in
+    the last bin.
+    Calling the histogram with the arguments returns an int32 array of the
+    number of elements in each bin.
+
+    On the Cython backend each thread counts the elements of a contiguous
+    chunk of the input in its own bins which are merged at the end.  On
+    OpenCL/CUDA each work group counts in local memory and adds its counts to
+    the result with atomics.  This avoids contention on the bins and makes a
+    counting sort scale with the number of cores.
+
+    If an int32 `ranks` array is passed when calling, the rank of each element
+    within its bin is stored in it.  These are the offsets needed by a
+    counting sort, on the Cython backend the ranks are in the order of the
+    elements which makes the sort stable.
+
+    Example
+    -------
+
+    >>> @annotate(i='int', x='gfloatp', h='float')
+    ... def cell(i, x, h):
+    ...     return cast(floor(x[i]/h), 'int')
+    >>> hist = Histogram(cell, n_bins=10)
+    >>> counts = hist(x, 0.1, ranks=ranks)
+    """
+    def __init__(self, key_func, n_bins=None, backend=None):
+        self._key_func = key_func
+        self._n_bins = n_bins
         self._backend = backend
-        self.reduction = None
+        self.histogram = None
 
     def _setup(self):
-        map_func = self._map_func
-        reduce_expr = self._reduce_expr
-        dtype_out, neutral = self._dtype_out, self._neutral
+        key_func = self._key_func
         backend = array.get_backend(self._backend)
-        cfg = get_config()
-        if (backend != 'cython' and dtype_out == np.float64 and
-           not cfg.use_double):
-            dtype_out = np.float32
-        if map_func is None or getattr(map_func, '__annotations__', None) and \
-                not hasattr(map_func, 'is_jit'):
-            self.reduction = ReductionBase(reduce_expr, map_func=map_func,
-                                           dtype_out=dtype_out,
-                                           neutral=neutral,
-                                           backend=backend)
+        if getattr(key_func, '__annotations__', None) and \
+                not hasattr(key_func, 'is_jit'):
+            self.histogram = HistogramBase(
+                key_func, n_bins=self._n_bins, backend=backend
+            )
         else:
-            from .jit import ReductionJIT
-            self.reduction = ReductionJIT(reduce_expr, map_func=map_func,
-                                          dtype_out=dtype_out,
-                                          neutral=neutral,
-                                          backend=backend)
+            from .jit import HistogramJIT
+            self.histogram = HistogramJIT(
+                key_func, n_bins=self._n_bins, backend=backend
+            )
 
     def __dir__(self):
-        return sorted(dir(self.reduction) + ['reduction'])
+        return sorted(dir(self.histogram) + ['histogram'])
 
     def __getattr__(self, name):
-        return getattr(self.reduction, name)
+        return getattr(self.histogram, name)
 
     def __call__(self, *args, **kwargs):
-        if self.reduction is None:
+        if self.histogram is None:
             self._setup()
-        return self.reduction(*args, **kwargs)
+        return self.histogram(*args, **kwargs)
 
     def set_backend(self, backend=None):
         self._backend = backend
-        self.reduction = None
+        self.histogram = None
 
 
 class ScanBase(object):
@@ -896,7 +2678,43 @@ class ScanBase(object):
         self.all_source = '# Source not yet generated.'
         self.cython_gen = CythonGenerator()
         self.queue = None
-        self.c_func = self._generate()
+        # The scratch memory of the Cython scan.
+        self.workspace = Workspace()
+        self.index_type = get_index_type()
+        self._index_variants = {}
+        self._build()
+
+    def _build(self):
+        with build_record(self):
+            self._index_key = self._get_index_key()
+            self.c_func = self._load_from_index()
+            if self.c_func is None:
+                self.c_func = self._generate()
+        if config._profiling:
+            get_traffic_info(self, self._get_traffic_funcs())
+
+    def _get_traffic_funcs(self):
+        return [self.input_func, self.output_func, self.is_segment_func]
+
+    def _get_index_key(self, *extra):
+        funcs = [self.input_func, self.output_func, self.is_segment_func]
+        if self._config.use_openmp:
+            template = scan_cy_template
+        else:
+            template = scan_cy_single_thread_template
+        return get_index_key(
+            self, 'scan', funcs, template, self.scan_expr, self.neutral,
+            self.type, self.complex_map, *extra
+        )
+
+    def _load_from_index(self):
+        c_func = load_from_index(self)
+        if c_func is not None:
+            if not hasattr(self.output_func, 'arg_keys'):
+                self.output_func.arg_keys = {}
+            self.output_func.arg_keys[self._get_backend_key()] = \
+                self._index_entry['arg_keys']
+        return c_func
 
     def _get_backend_key(self):
         return get_common_cache_key(self)
@@ -933,6 +2751,13 @@ class ScanBase(object):
         return [args[x] for x in indices]
 
     def _generate(self, declarations=None):
+        names = ('i', 'N')
+        self.input_func = with_index_type(self.input_func, self.index_type,
+                                          names)
+        self.output_func = with_index_type(self.output_func, self.index_type,
+                                           names)
+        self.is_segment_func = with_index_type(self.is_segment_func,
+                                               self.index_type, names)
         if self.backend == 'opencl':
             return self._generate_opencl_kernel(declarations=declarations)
         elif self.backend == 'cuda':
@@ -941,9 +2766,10 @@ class ScanBase(object):
             return self._generate_cython_code(declarations=declarations)
 
     def _default_cython_input_function(self):
-        py_data = (['int i', '{type}[:] input'.format(type=self.type)],
+        index = '{type} i'.format(type=self.index_type)
+        py_data = ([index, '{type}[:] input'.format(type=self.type)],
                    ['i', '&input[0]'])
-        c_data = (['int i', '{type}* input'.format(type=self.type)],
+        c_data = ([index, '{type}* input'.format(type=self.type)],
                   ['i', 'input'])
         input_expr = 'input[i]'
         return py_data, c_data, input_expr
@@ -1026,12 +2852,13 @@ class ScanBase(object):
         self.output_func.arg_keys[self._get_backend_key()] = c_args
 
         if self._config.use_openmp:
-            template = Template(text=scan_cy_template)
+            template = TimedTemplate(text=scan_cy_template)
         else:
-            template = Template(text=scan_cy_single_thread_template)
+            template = TimedTemplate(text=scan_cy_single_thread_template)
         src = template.render(
             name=self.name,
             type=self.type,
+            index_type=self.index_type,
             input_expr=input_expr,
             scan_expr=self.scan_expr,
             output_expr=output_expr,
@@ -1050,7 +2877,12 @@ class ScanBase(object):
         self.tp.add_code(src)
         self.tp.compile()
         self.all_source = self.tp.source
-        return getattr(self.tp.mod, 'py_' + self.name)
+        func_name = 'py_' + self.name
+        add_to_index(
+            self, [self.input_func, self.output_func, self.is_segment_func],
+            func_name, arg_keys=c_args
+        )
+        return getattr(self.tp.mod, func_name)
 
     def _wrap_ocl_function(self, func, func_type=None, declarations=None):
         if func is not None:
@@ -1104,11 +2936,19 @@ class ScanBase(object):
 
         preamble = convert_to_float_if_needed(self.tp.get_code())
 
-        args = input_args + segment_args + output_args
+        # The last item of the scan is also stored for ``aggregate``.
+        total_arg = '%s *scan_total' % self.type
+        if self.backend == 'opencl':
+            total_arg = '__global ' + total_arg
+        output_expr = '%s; if (i + 1 == N) scan_total[0] = item' % \
+            output_expr
+
+        args = input_args + segment_args + output_args + [total_arg]
         args = drop_duplicates(args)
         arg_defn = convert_to_float_if_needed(','.join(args))
 
-        c_args = input_c_args + segment_c_args + output_c_args
+        c_args = input_c_args + segment_c_args + output_c_args + \
+            ['scan_total']
         c_args = drop_duplicates(c_args)
         if not hasattr(self.output_func, 'arg_keys'):
             self.output_func.arg_keys = {}
@@ -1130,6 +2970,7 @@ class ScanBase(object):
         knl = GenericScanKernel(
             ctx,
             dtype=self.dtype,
+            index_dtype=ctype_to_dtype(self.index_type),
             arguments=arg_defn,
             input_expr=input_expr,
             scan_expr=scan_expr,
@@ -1162,6 +3003,7 @@ class ScanBase(object):
         set_context()
         knl = GenericScanKernel(
             dtype=self.dtype,
+            index_dtype=ctype_to_dtype(self.index_type),
             arguments=arg_defn,
             input_expr=input_expr,
             scan_expr=scan_expr,
@@ -1203,14 +3045,47 @@ class ScanBase(object):
 
     def _massage_arg(self, x):
         if isinstance(x, array.Array):
+            if x._dependents:
+                x._evaluate_dependents()
             return x.dev
         elif self.backend != 'cuda' or isinstance(x, np.ndarray):
             return x
         else:
             return np.asarray(x)
 
+    def _get_scan_total(self, aggregate):
+        # The array the GPU kernels store the last item of the scan in.
+        if aggregate is not None:
+            return self._massage_arg(aggregate)
+        total = getattr(self, '_scan_total', None)
+        if total is None:
+            dtype = ctype_to_dtype(convert_to_float_if_needed(self.type))
+            total = array.empty(1, dtype, backend=self.backend)
+            self._scan_total = total
+        return total.dev
+
+    def _get_c_func(self, **kwargs):
+        return get_index_variant(self, kwargs.values()).c_func
+
     @profile
-    def __call__(self, **kwargs):
+    def __call__(self, async_launch=None, aggregate=None, workspace=None,
+                 **kwargs):
+        """Run the scan with the arrays and values given as keyword
+        arguments.
+
+        If an array is passed as `aggregate`, the last item of the inclusive
+        scan, i.e. the total for a sum, is stored in its first element on the
+        device.  It may then be used by other kernels or read along with other
+        results.
+
+        On the Cython backend, the scratch memory is taken from `workspace`,
+        a ``compyle.memory_pool.Workspace``, or ``self.workspace`` if it is
+        not given.  If the workspace is in use by a call from another thread,
+        a private workspace is used instead.
+        """
+        record_traffic(self, self._get_traffic_funcs(), list(kwargs.values()),
+                       names=list(kwargs.keys()))
+        c_func = self._get_c_func(**kwargs)
         c_args_dict = {k: self._massage_arg(x) for k, x in kwargs.items()}
         if self._get_backend_key() in self.output_func.arg_keys:
             output_arg_keys = self.output_func.arg_keys[
@@ -1224,16 +3099,17 @@ class ScanBase(object):
         if self.backend == 'cython':
             size = len(c_args_dict[output_arg_keys[1]])
             c_args_dict['SIZE'] = size
-            self.c_func(*[c_args_dict[k] for k in output_arg_keys])
-        elif self.backend == 'opencl':
-            self.c_func(*[c_args_dict[k] for k in output_arg_keys])
-            self.queue.finish()
-        elif self.backend == 'cuda':
-            import pycuda.driver as drv
-            event = drv.Event()
-            self.c_func(*[c_args_dict[k] for k in output_arg_keys])
-            event.record()
-            event.synchronize()
+            with (workspace or self.workspace).use() as ws:
+                total = c_func(*[c_args_dict[k] for k in output_arg_keys],
+                               ws)
+            if aggregate is not None:
+                self._massage_arg(aggregate)[0] = total
+        else:
+            c_args_dict['scan_total'] = self._get_scan_total(aggregate)
+            first = start_device_timing(self)
+            event = c_func(*[c_args_dict[k] for k in output_arg_keys])
+            record_device_timing(self, event, first)
+            return finish_launch(self.backend, self.queue, async_launch)
 
 
 class Scan(object):
@@ -1291,8 +3167,106 @@ class Scan(object):
     def __call__(self, **kwargs):
         if self.scan is None:
             self._setup()
-        self.scan(**kwargs)
+        return self.scan(**kwargs)
 
     def set_backend(self, backend=None):
         self._backend = backend
         self.scan = None
+
+
+def _get_kernel_attr(knl):
+    if isinstance(knl, Elementwise):
+        return 'elementwise'
+    elif isinstance(knl, (Reduction, SegmentedReduction)):
+        return 'reduction'
+    elif isinstance(knl, Scan):
+        return 'scan'
+    elif isinstance(knl, Histogram):
+        return 'histogram'
+    else:
+        raise TypeError(
+            'Expected an Elementwise, Reduction, SegmentedReduction, Scan or '
+            'Histogram instance, got %r' % knl
+        )
+
+
+def _setup_kernel(knl, args):
+    attr = _get_kernel_attr(knl)
+    if getattr(knl, attr) is None:
+        knl._setup()
+    obj = getattr(knl, attr)
+    if args is not None and hasattr(obj, '_generate_kernel'):
+        if isinstance(args, dict):
+            obj._generate_kernel(**args)
+        else:
+            obj._generate_kernel(*args)
+
+
+def get_kernels(module):
+    """Return all the Elementwise, Reduction, SegmentedReduction, Scan and
+    Histogram instances defined in the given module.
+    """
+    return [
+        value for name, value in sorted(vars(module).items())
+        if isinstance(value, (Elementwise, Reduction, SegmentedReduction,
+                              Scan, Histogram))
+    ]
+
+
+def compile_all(kernels, n_jobs=None, bundle=False):
+    """Generate and compile many kernels together.
+
+    On the Cython backend each kernel is compiled into its own extension
+    module which is done serially when the kernels are first called.  This
+    function first generates the sources for all the given kernels, then
+    compiles all the extension modules that are not already built on a pool of
+    `n_jobs` processes and finally loads them.  On the other backends the
+    kernels are simply setup one after the other.
+
+    Parameters
+    ----------
+
+    kernels: list: a list of Elementwise, Reduction, SegmentedReduction,
+        Scan or Histogram instances.  JIT kernels need the argument types to
+        generate code, for these pass a tuple of ``(kernel, args)`` where
+        ``args`` is a tuple of the arguments (a dict of the keyword arguments
+        for a Scan) that the kernel will be called with.  A Python module may
+        also be passed in which case all the kernels defined in it are used.
+    n_jobs: int: number of processes to use, defaults to the number of CPUs.
+    bundle: bool: if True, the sources of the kernels are merged into as few
+        extension modules as possible, see ``ext_module.build_bundles``.  This
+        reduces the number of modules that need to be compiled and loaded.
+
+    Example
+    -------
+
+    >>> e = Elementwise(axpb)
+    >>> r = Reduction('a+b', map_func=norm)
+    >>> compile_all([e, (r, (x,))], n_jobs=4)
+    """
+    if isinstance(kernels, types.ModuleType):
+        kernels = get_kernels(kernels)
+    items = []
+    for knl in kernels:
+        if isinstance(knl, tuple):
+            items.append(knl)
+        else:
+            items.append((knl, None))
+
+    pending = []
+    with defer_builds() as deferred:
+        for knl, args in items:
+            try:
+                _setup_kernel(knl, args)
+            except DeferredBuild:
+                pending.append((knl, args))
+                knl.set_backend(knl._backend)
+
+    if deferred:
+        if bundle:
+            build_bundles(deferred, n_jobs=n_jobs)
+        else:
+            build_all(deferred, n_jobs=n_jobs)
+
+    for knl, args in pending:
+        _setup_kernel(knl, args)
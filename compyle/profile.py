@@ -2,8 +2,16 @@
 """
 
 from contextlib import contextmanager
-from collections import defaultdict
-import time
+from collections import defaultdict, deque
+from functools import wraps
+import json
+import os
+from threading import get_ident
+from time import perf_counter_ns
+
+import numpy as np
+
+from . import config
 from .config import get_config
 
 
@@ -15,6 +23,9 @@ _current_level = 0
 _profile_info = defaultdict(
     lambda: defaultdict(_make_default)
 )
+# The time in nanoseconds spent on bookkeeping inside the profiled regions
+# which is not counted in their time, see ``exclude_from_profile``.
+_excluded_ns = 0
 
 
 def _record_profile(name, time):
@@ -24,8 +35,141 @@ def _record_profile(name, time):
     li[name]['calls'] += 1
 
 
+def exclude_from_profile(ns):
+    """Do not count `ns` nanoseconds spent on profiling bookkeeping, like
+    ``parallel.record_traffic``, in the time of the enclosing profiled
+    regions.
+    """
+    global _excluded_ns
+    _excluded_ns += ns
+
+
+def _get_size(x):
+    # The length of a compyle, NumPy or device array, 0 for anything else.
+    n = getattr(x, 'length', None)
+    if n is None:
+        shape = getattr(x, 'shape', None)
+        n = shape[0] if shape else 0
+    return n if isinstance(n, int) else 0
+
+
+class TraceBuffer(object):
+    """A ring buffer of the profiled regions in the order they finish.
+
+    Every region is stored as a tuple of its name, category, start and end
+    times from ``time.perf_counter_ns``, thread id, nesting level, the length
+    of the largest array argument and the backend.  The buffer is allocated
+    up front and once it is full the oldest regions are overwritten, see
+    ``dropped``.
+
+    Parameters
+    ----------
+
+    capacity: int: the number of regions kept.
+    """
+    def __init__(self, capacity=1 << 16):
+        self.capacity = capacity
+        self._events = [None]*capacity
+        self._count = 0
+
+    def __len__(self):
+        return min(self._count, self.capacity)
+
+    @property
+    def dropped(self):
+        """The number of regions that were overwritten.
+        """
+        return max(self._count - self.capacity, 0)
+
+    def add(self, name, category, start, end, args=(), kwargs=None):
+        size, backend = 0, None
+        if kwargs:
+            args = tuple(args) + tuple(kwargs.values())
+            backend = kwargs.get('backend')
+        for x in args:
+            size = max(size, _get_size(x))
+            if backend is None:
+                backend = getattr(x, 'backend', None)
+        self._events[self._count % self.capacity] = (
+            name, category, start, end, get_ident(), _current_level, size,
+            backend
+        )
+        self._count += 1
+
+    def get_events(self):
+        """Return the recorded regions, the oldest first.
+        """
+        n = len(self)
+        first = self._count - n
+        return [self._events[i % self.capacity]
+                for i in range(first, first + n)]
+
+    def clear(self):
+        self._events = [None]*self.capacity
+        self._count = 0
+
+    def to_chrome_trace(self):
+        """Return the regions in the Chrome trace event format.
+
+        The result can be saved as JSON and loaded in Perfetto
+        (https://ui.perfetto.dev) or ``chrome://tracing``.
+        """
+        pid = os.getpid()
+        events = []
+        for name, cat, start, end, tid, level, size, backend in \
+                self.get_events():
+            events.append(dict(
+                name=name, cat=cat, ph='X', pid=pid, tid=tid,
+                ts=start*1e-3, dur=(end - start)*1e-3,
+                args=dict(level=level, size=size, backend=str(backend))
+            ))
+        return dict(traceEvents=events, displayTimeUnit='ns',
+                    otherData=dict(dropped=self.dropped))
+
+    def save(self, fname):
+        """Save the regions as a Chrome trace JSON file.
+        """
+        with open(fname, 'w') as f:
+            json.dump(self.to_chrome_trace(), f)
+
+
+_trace = None
+
+
+def start_trace(capacity=1 << 16):
+    """Start recording the profiled regions in a new ``TraceBuffer`` of the
+    given capacity which is returned.
+
+    Only the regions that are profiled are recorded so profiling must be
+    enabled with ``get_config().profile``.
+    """
+    global _trace
+    _trace = TraceBuffer(capacity)
+    return _trace
+
+
+def stop_trace():
+    """Stop recording the profiled regions and return the ``TraceBuffer``
+    with the regions recorded so far, or None if none was started.
+    """
+    global _trace
+    trace, _trace = _trace, None
+    return trace
+
+
+def get_trace():
+    """Return the ``TraceBuffer`` being recorded or None.
+    """
+    return _trace
+
+
+def _record_event(name, category, start, end, args=(), kwargs=None):
+    if _trace is not None:
+        _trace.add(name, category, start, end, args, kwargs)
+
+
 @contextmanager
-def profile_ctx(name):
+def profile_ctx(name, category='call'):
     """ Context manager for profiling
 
     For profiling a function f, it can be used as follows::
@@ -35,16 +179,18 @@ def profile_ctx(name):
     """
     global _current_level
     _current_level += 1
-    start = time.time()
+    excluded = _excluded_ns
+    start = perf_counter_ns()
     try:
         yield start
-        end = time.time()
+        end = perf_counter_ns()
     finally:
         _current_level -= 1
-    _record_profile(name, end - start)
+    _record_profile(name, (end - start - _excluded_ns + excluded)*1e-9)
+    _record_event(name, category, start, end)
 
 
-def profile(method=None, name=None):
+def profile(method=None, name=None, category='call'):
     """Decorator for profiling a function. Can be used as follows::
 
     @profile
@@ -57,9 +203,17 @@ def profile(method=None, name=None):
     has a `self.name` attribute, it will use that. Otherwise, it will use the
     method's qualified name to record the profile.
 
+    The calls are only profiled when ``get_config().profile`` is set.  This is
+    checked with a cached flag so the wrapper does no other work when
+    profiling is off.  The `category` is that of the regions recorded by
+    ``start_trace``.
     """
     def make_wrapper(method):
+        @wraps(method)
         def wrapper(*args, **kwargs):
+            global _current_level
+            if not config._profiling:
+                return method(*args, **kwargs)
             self = args[0] if len(args) else None
             if name is None:
                 if hasattr(self, method.__name__) and hasattr(self, 'name'):
@@ -68,9 +222,19 @@ def profile(method=None, name=None):
                     p_name = getattr(method, '__qualname__', method.__name__)
             else:
                 p_name = name
-            with profile_ctx(p_name):
-                return method(*args, **kwargs)
-        wrapper.__doc__ = method.__doc__
+            _current_level += 1
+            excluded = _excluded_ns
+            start = perf_counter_ns()
+            try:
+                result = method(*args, **kwargs)
+                end = perf_counter_ns()
+            finally:
+                _current_level -= 1
+            _record_profile(p_name,
+                            (end - start - _excluded_ns + excluded)*1e-9)
+            if _trace is not None:
+                _trace.add(p_name, category, start, end, args, kwargs)
+            return result
         return wrapper
     if method is None:
         return make_wrapper
@@ -96,12 +260,366 @@ class ProfileContext:
         self.name = name
         global _current_level
         _current_level += 1
-        self.start = time.time()
+        self.start = perf_counter_ns()
 
     def stop(self):
         global _current_level
+        end = perf_counter_ns()
         _current_level -= 1
-        _record_profile(self.name, time.time() - self.start)
+        _record_profile(self.name, (end - self.start)*1e-9)
+        _record_event(self.name, 'call', self.start, end)
+
+
+# The OpenCL events of the launches whose device timings are not yet read.
+_device_events = deque()
+# The events are read once this many are pending.
+_max_device_events = 1024
+_device_profile_info = defaultdict(
+    lambda: dict(calls=0, queued=0.0, submit=0.0, time=0.0)
+)
+
+
+def record_device_event(name, event, first=None):
+    """Record the device timing of a kernel launch from its OpenCL event.
+
+    The command queue must have been created with profiling enabled.  For a
+    launch that runs several kernels, `event` is the event of the last one
+    and `first` an event, like a marker, enqueued just before the launch.
+
+    The events are only read when the timings are needed or when many
+    events are pending so that recording does not wait for the kernels.
+    """
+    _device_events.append((name, event, first))
+    if len(_device_events) >= _max_device_events:
+        _read_device_events()
+
+
+def _read_device_events():
+    # Each event is removed before it is read so that it is not counted again
+    # if reading an event fails.
+    while _device_events:
+        name, event, first = _device_events.popleft()
+        event.wait()
+        end = event.profile.end
+        if first is None:
+            first = event
+            start = event.profile.start
+        else:
+            # The kernels of the launch start once the marker is complete.
+            start = first.profile.end
+        queued, submit = first.profile.queued, first.profile.submit
+        info = _device_profile_info[name]
+        info['calls'] += 1
+        info['queued'] += (submit - queued)*1e-9
+        info['submit'] += (start - submit)*1e-9
+        info['time'] += (end - start)*1e-9
+
+
+def get_device_profile_info():
+    """Return the device timings of the kernel launches by name.
+
+    For every name, the number of launches, the total time they waited in
+    the queue before being submitted to the device (queued), the time from
+    submission to the start of execution (submit) and the time spent
+    executing on the device (time) are given in seconds.  These are recorded
+    for the OpenCL backend when profiling is enabled.
+    """
+    _read_device_events()
+    return _device_profile_info
+
+
+_throughput_info = defaultdict(
+    lambda: dict(calls=0, elements=0, bytes=0, backend=None)
+)
+# The peak memory bandwidth in GB/s of each backend, see measure_bandwidth.
+_peak_bandwidth = {}
+
+
+def record_throughput(name, args, access=None, size=None, backend=None):
+    """Record the elements processed and the bytes moved by a kernel launch.
+
+    `args` is a sequence of ``(name, value)`` pairs of the arguments of the
+    launch.  Every array argument moves ``min(len(array), size)`` elements
+    each way it is accessed: `access` maps the names of the arrays to the
+    number of ways, i.e. 2 if an array is both read and written, and arrays
+    that are not in it are counted once.  The `size` is the number of
+    elements processed, this defaults to the length of the first array.
+    """
+    nbytes = 0
+    arrays = []
+    for arg_name, x in args:
+        n = _get_size(x)
+        dtype = getattr(x, 'dtype', None)
+        if n > 0 and dtype is not None:
+            arrays.append((arg_name, n, dtype.itemsize))
+    if size is None:
+        size = arrays[0][1] if arrays else 0
+    for arg_name, n, itemsize in arrays:
+        count = 1 if access is None else access.get(arg_name, 1)
+        nbytes += min(n, size)*itemsize*count
+    info = _throughput_info[name]
+    info['calls'] += 1
+    info['elements'] += size
+    info['bytes'] += nbytes
+    info['backend'] = backend
+
+
+def get_throughput_info():
+    """Return the throughput of the kernels by name.
+
+    For every kernel, the number of calls, the total elements processed and
+    bytes moved, the time taken in seconds, the elements per second and the
+    bandwidth in GB/s are given.  The time is that on the device when it is
+    available and that of the calls on the host otherwise.  If the peak
+    bandwidth of the backend has been measured with ``measure_bandwidth``,
+    the fraction of the peak that is achieved is also given, otherwise this
+    is None.
+    """
+    device_info = get_device_profile_info()
+    result = {}
+    for name, data in _throughput_info.items():
+        if name in device_info:
+            time = device_info[name]['time']
+        else:
+            time = sum(_profile_info[level][name]['time']
+                       for level in _profile_info
+                       if name in _profile_info[level])
+        info = dict(data, time=time, elements_per_sec=0.0, bandwidth=0.0,
+                    peak_fraction=None)
+        if time > 0:
+            info['elements_per_sec'] = data['elements']/time
+            info['bandwidth'] = data['bytes']/time*1e-9
+            peak = _peak_bandwidth.get(data['backend'])
+            if peak:
+                info['peak_fraction'] = info['bandwidth']/peak
+        result[name] = info
+    return result
+
+
+def _stream_copy(i, a, c):
+    c[i] = a[i]
+
+
+def _stream_scale(i, b, c, s):
+    b[i] = s*c[i]
+
+
+def _stream_add(i, a, b, c):
+    c[i] = a[i] + b[i]
+
+
+def _stream_triad(i, a, b, c, s):
+    a[i] = b[i] + s*c[i]
+
+
+def measure_bandwidth(backend=None, n=1 << 24, repeat=5):
+    """Measure the memory bandwidth of the backend with kernels like those of
+    the STREAM benchmark.
+
+    The copy, scale, add and triad kernels are run `repeat` times on arrays of
+    `n` elements and the best bandwidth of each is returned in a dictionary
+    in GB/s.  The best of these is stored as the peak bandwidth of the
+    backend which ``get_throughput_info`` and ``print_profile`` compare the
+    kernels with.
+    """
+    from .array import get_backend, ones
+    from .parallel import Elementwise, synchronize
+    from .types import annotate
+    backend = get_backend(backend)
+    if backend == 'cython' or get_config().use_double:
+        dtype, ptr, scalar = np.float64, 'gdoublep', 'double'
+    else:
+        dtype, ptr, scalar = np.float32, 'gfloatp', 'float'
+    a, b, c = [ones(n, dtype, backend=backend) for i in range(3)]
+    s = dtype(3.0)
+    kernels = [
+        (_stream_copy, dict(a=ptr, c=ptr), (a, c), 2),
+        (_stream_scale, dict(b=ptr, c=ptr, s=scalar), (b, c, s), 2),
+        (_stream_add, dict(a=ptr, b=ptr, c=ptr), (a, b, c), 3),
+        (_stream_triad, dict(a=ptr, b=ptr, c=ptr, s=scalar), (a, b, c, s), 3)
+    ]
+    result = {}
+    with config.use_config(profile=False):
+        for func, arg_types, args, n_arrays in kernels:
+            knl = Elementwise(annotate(i='int', **arg_types)(func),
+                              backend=backend)
+            knl(*args)
+            synchronize(backend)
+            best = None
+            for i in range(repeat):
+                start = perf_counter_ns()
+                knl(*args)
+                synchronize(backend)
+                t = perf_counter_ns() - start
+                best = t if best is None else min(best, t)
+            nbytes = n_arrays*n*np.dtype(dtype).itemsize
+            result[func.__name__[8:]] = nbytes/max(best, 1)
+    _peak_bandwidth[backend] = max(result.values())
+    return result
+
+
+def get_peak_bandwidth(backend=None):
+    """Return the peak bandwidth of the backend in GB/s measured with
+    ``measure_bandwidth`` or None if it has not been measured.
+    """
+    from .array import get_backend
+    return _peak_bandwidth.get(get_backend(backend))
+
+
+# The records of the kernels built, only the latest ones are kept, and those
+# being built (innermost last).
+_build_records = deque(maxlen=10000)
+_active_builds = []
+# The phases being timed, nested phases of the same kind are not timed.
+_active_phases = []
+
+
+def _new_build_record(name, kind, backend):
+    return dict(name=name, kind=kind, backend=backend, time=0.0, phases={},
+                cache=None, lock_wait=0.0, source_hash=None, commands=[])
+
+
+@contextmanager
+def build_record(obj=None, name=None, kind=None, backend=None, store=True):
+    """Context manager to record the build of the kernel `obj`.
+
+    The record is a dictionary with the `name`, `kind` and `backend` of the
+    kernel, these default to the ``name``, class name and ``backend`` of
+    `obj`.  The total time of the build and the time in each of its phases,
+    see ``build_phase``, are recorded in seconds.  The code that compiles the
+    kernel adds the hash of the source, how it was cached, the time waited
+    for a lock on the cache and the compiler commands used, see
+    ``update_build_record``.  The records are returned by
+    ``get_build_records``.
+
+    If `obj` is None and a kernel is being built, the record of that kernel
+    is used, this is used when compiling extension modules.  If `store` is
+    False, a new record is always used and it is not added to the records,
+    this is used by ``build_all`` whose builds may run in other processes.
+    """
+    if obj is None and _active_builds and store:
+        yield _active_builds[-1]
+        return
+    if obj is not None:
+        name = name or getattr(obj, 'name', None)
+        kind = kind or type(obj).__name__
+        backend = backend or getattr(obj, 'backend', None)
+    record = _new_build_record(name, kind, backend)
+    _active_builds.append(record)
+    start = perf_counter_ns()
+    try:
+        yield record
+    finally:
+        record['time'] = (perf_counter_ns() - start)*1e-9
+        _active_builds.pop()
+        if store:
+            _build_records.append(record)
+
+
+@contextmanager
+def build_phase(phase):
+    """Context manager, also usable as a decorator, that adds the time taken
+    to the given phase of the kernel being built, see ``build_record``.
+    """
+    if phase in _active_phases or not _active_builds:
+        yield
+        return
+    _active_phases.append(phase)
+    start = perf_counter_ns()
+    try:
+        yield
+    finally:
+        _active_phases.pop()
+        add_build_time(phase, (perf_counter_ns() - start)*1e-9)
+
+
+def add_build_time(phase, seconds):
+    """Add the time in seconds to the phase of the kernel being built.
+    """
+    if _active_builds:
+        phases = _active_builds[-1]['phases']
+        phases[phase] = phases.get(phase, 0.0) + seconds
+
+
+def update_build_record(**kw):
+    """Update the record of the kernel being built with the given values.
+    """
+    if _active_builds:
+        _active_builds[-1].update(kw)
+
+
+def merge_build_record(record):
+    """Merge the record of a build that was not stored, see ``build_record``,
+    into the latest record of the same source whose build was deferred.  The
+    record is added as is if there is no such record.
+    """
+    for old in reversed(_build_records):
+        if (old['cache'] == 'deferred' and
+                old['source_hash'] == record['source_hash']):
+            break
+    else:
+        _build_records.append(record)
+        return
+    old['time'] += record['time']
+    old['lock_wait'] += record['lock_wait']
+    old['cache'] = record['cache']
+    old['commands'] = old['commands'] + record['commands']
+    for phase, seconds in record['phases'].items():
+        old['phases'][phase] = old['phases'].get(phase, 0.0) + seconds
+
+
+def get_build_records():
+    """Return the list of records of the kernels built, see
+    ``build_record``.  Only the latest 10000 records are kept.
+    """
+    return list(_build_records)
+
+
+def clear_build_records():
+    """Remove all the records of the kernels built.
+    """
+    _build_records.clear()
+
+
+def print_build_summary(records=None, n_slowest=10):
+    """Print the total time spent building kernels by phase and cache status
+    along with the slowest builds.
+    """
+    if records is None:
+        records = get_build_records()
+    hr = '-'*70
+    print(hr)
+    if not records:
+        print("No kernels were built")
+        print(hr)
+        return
+    phases, caches = defaultdict(float), defaultdict(int)
+    lock_wait = 0.0
+    for record in records:
+        for phase, t in record['phases'].items():
+            phases[phase] += t
+        caches[str(record['cache'])] += 1
+        lock_wait += record['lock_wait']
+    total = sum(r['time'] for r in records)
+    print("Built %d kernels in %g secs" % (len(records), total))
+    print("{:<40} {:<10}".format('Phase', 'Time'))
+    for phase, t in sorted(phases.items(), key=lambda x: x[1], reverse=True):
+        print("{:<40} {:<10.3g}".format(phase, t))
+    print("Waited for locks: %g secs" % lock_wait)
+    print("Cache: " + ', '.join(
+        '%s: %d' % (cache, n) for cache, n in sorted(caches.items())
+    ))
+    print(hr)
+    print("{:<30} {:<20} {:<10} {:<10}".format(
+        'Kernel', 'Kind', 'Cache', 'Time'
+    ))
+    slowest = sorted(records, key=lambda x: x['time'], reverse=True)
+    for record in slowest[:n_slowest]:
+        print("{:<30} {:<20} {:<10} {:<10.3g}".format(
+            str(record['name']), str(record['kind']), str(record['cache']),
+            record['time']
+        ))
+    print(hr)
 
 
 def get_profile_info():
@@ -135,6 +653,45 @@ def print_profile():
             if level == 0:
                 tot_time += data['time']
     print("Total profiled time: %g secs" % tot_time)
+    device_info = get_device_profile_info()
+    if device_info:
+        # The host time is that of the call on the host which includes the
+        # Python overhead of the call and the wait for the device.
+        print(hr)
+        print("Device timings:")
+        print(
+            "{:<40} {:<10} {:<10} {:<10} {:<10}".format(
+                'Kernel', 'N calls', 'Device', 'Queued', 'Host')
+        )
+        device_data = sorted(
+            device_info.items(), key=lambda x: x[1]['time'], reverse=True
+        )
+        for kernel, data in device_data:
+            host = sum(_profile_info[level][kernel]['time']
+                       for level in _profile_info
+                       if kernel in _profile_info[level])
+            print("{:<40} {:<10} {:<10.3g} {:<10.3g} {:<10.3g}".format(
+                kernel, data['calls'], data['time'],
+                data['queued'] + data['submit'], host)
+            )
+    throughput_info = get_throughput_info()
+    if throughput_info:
+        print(hr)
+        print("Throughput:")
+        print(
+            "{:<40} {:<12} {:<10} {:<10}".format(
+                'Kernel', 'Elements/s', 'GB/s', '% of peak')
+        )
+        throughput_data = sorted(
+            throughput_info.items(), key=lambda x: x[1]['time'],
+            reverse=True
+        )
+        for kernel, data in throughput_data:
+            peak = data['peak_fraction']
+            peak = '-' if peak is None else '%.3g' % (100*peak)
+            print("{:<40} {:<12.3g} {:<10.3g} {:<10}".format(
+                kernel, data['elements_per_sec'], data['bandwidth'], peak)
+            )
     print(hr)
 
 
@@ -172,21 +729,26 @@ def profile_kernel(kernel, name, backend=None):
 
     def _profile_knl(*args, **kwargs):
         if backend == 'opencl':
-            start = time.time()
+            start = perf_counter_ns()
             event = kernel(*args, **kwargs)
             event.wait()
-            end = time.time()
-            _record_profile(name, end - start)
+            end = perf_counter_ns()
+            _record_profile(name, (end - start)*1e-9)
+            _record_event(name, 'kernel', start, end, args, kwargs)
             return event
         elif backend == 'cuda':
+            start = perf_counter_ns()
             exec_time = kernel(*args, **kwargs, time_kernel=True)
             _record_profile(name, exec_time)
+            _record_event(name, 'kernel', start, perf_counter_ns(), args,
+                          kwargs)
             return exec_time
         else:
-            start = time.time()
+            start = perf_counter_ns()
             kernel(*args, **kwargs)
-            end = time.time()
-            _record_profile(name, end - start)
+            end = perf_counter_ns()
+            _record_profile(name, (end - start)*1e-9)
+            _record_event(name, 'kernel', start, end, args, kwargs)
 
     if get_config().profile:
         wgi = getattr(kernel, 'get_work_group_info', None)
@@ -1,15 +1,253 @@
 import numpy as np
+from mako.template import Template as MakoTemplate
+from pytools import memoize
 
 from .config import get_config
 from .cython_generator import get_parallel_range, CythonGenerator
 from .transpiler import Transpiler, convert_to_float_if_needed
 from .types import dtype_to_ctype, annotate
-from .parallel import Scan
+from .parallel import (Scan, get_index_dtype, get_index_type,
+                       thread_helpers_cy_template)
 from .template import Template
 
 from . import array
 
 
+# An LSD radix sort that sorts `radix_bits` bits of the keys in each pass.
+# Every thread owns a contiguous chunk of the input and counts the digits of
+# its chunk in its own histogram.  The histograms are then turned into the
+# offsets at which each thread writes the elements of each digit so that the
+# scatter is stable.  The keys are sorted along with the permutation which is
+# used to reorder any other arrays once at the end.  Signed integer and
+# floating point keys are mapped to unsigned integers with the same order by
+# flipping the sign bit (all the bits for negative floats).
+radix_sort_cy_template = '''
+from cython.parallel import parallel, prange
+from libc.stdlib cimport malloc, free
+from libc.string cimport memset, memcpy
+cimport openmp
+''' + thread_helpers_cy_template + '''
+
+ctypedef ${key_type} radix_key_t
+ctypedef ${ukey_type} radix_ukey_t
+ctypedef ${index_type} radix_index_t
+
+
+cdef inline radix_ukey_t radix_key(radix_key_t k) noexcept nogil:
+% if kind == 'f':
+    cdef radix_ukey_t u = (<radix_ukey_t*>&k)[0]
+    if u >> ${bits - 1}:
+        return ~u
+    return u | (<radix_ukey_t>1 << ${bits - 1})
+% elif kind == 'i':
+    return (<radix_ukey_t>k) ^ (<radix_ukey_t>1 << ${bits - 1})
+% else:
+    return k
+% endif
+
+
+<%
+    thread_range = get_parallel_range('n_thread', nogil=True,
+                                      schedule='static', chunksize=1)
+%>
+cpdef py_key_range(radix_key_t[:] keys):
+    cdef long n = keys.shape[0]
+    cdef long i, start, end, chunksize
+    cdef int t, tid, n_thread
+    cdef radix_ukey_t lo, hi, u
+    cdef radix_key_t* kp = &keys[0]
+    n_thread = get_number_of_threads()
+    cdef radix_ukey_t* los = <radix_ukey_t*>malloc(
+        2*n_thread*sizeof(radix_ukey_t)
+    )
+    if los == NULL:
+        raise MemoryError("Unable to allocate memory for radix sort")
+    cdef radix_ukey_t* his = los + n_thread
+    chunksize = (n + n_thread - 1) // n_thread
+
+%if openmp:
+    for tid in ${thread_range}:
+%else:
+    for tid in range(n_thread):
+%endif
+        start = min(tid*chunksize, n - 1)
+        end = min(start + chunksize, n)
+        lo = radix_key(kp[start])
+        hi = lo
+        for i in range(start, end):
+            u = radix_key(kp[i])
+            if u < lo:
+                lo = u
+            if u > hi:
+                hi = u
+        los[tid] = lo
+        his[tid] = hi
+
+    lo = los[0]
+    hi = his[0]
+    for t in range(1, n_thread):
+        lo = min(lo, los[t])
+        hi = max(hi, his[t])
+    free(los)
+    return lo, hi
+
+
+cdef void c_radix_sort(long n, radix_key_t* keys, radix_key_t* keys_out,
+                       radix_key_t* keys_tmp, radix_index_t* order,
+                       radix_index_t* order_tmp,
+                       radix_ukey_t kmin, int n_bits, int radix_bits):
+    cdef long i, start, end, chunksize, total, count, pos, digit_start
+    cdef int t, d, tid, n_thread, radix, shift, skip, dst_is_out
+    cdef radix_ukey_t mask
+    cdef long* hist
+    cdef long* my_hist
+    cdef radix_key_t* src_k
+    cdef radix_key_t* dst_k
+    cdef radix_index_t* src_o
+    cdef radix_index_t* dst_o
+
+    n_thread = get_number_of_threads()
+    radix = 1 << radix_bits
+    hist = <long*>malloc(n_thread*radix*sizeof(long))
+    if hist == NULL:
+        raise MemoryError("Unable to allocate memory for radix sort")
+    chunksize = (n + n_thread - 1) // n_thread
+
+    src_k = keys
+    src_o = NULL
+    dst_is_out = 1
+    for shift in range(0, n_bits, radix_bits):
+        if dst_is_out:
+            dst_k = keys_out
+            dst_o = order
+        else:
+            dst_k = keys_tmp
+            dst_o = order_tmp
+        # The last pass may sort fewer bits.
+        mask = (<radix_ukey_t>1 << min(radix_bits, n_bits - shift)) - 1
+        memset(hist, 0, n_thread*radix*sizeof(long))
+
+%if openmp:
+        for tid in ${thread_range}:
+%else:
+        for tid in range(n_thread):
+%endif
+            my_hist = hist + tid*radix
+            start = tid*chunksize
+            end = min(start + chunksize, n)
+            for i in range(start, end):
+                my_hist[((radix_key(src_k[i]) - kmin) >> shift) & mask] += 1
+
+        # Exclusive scan over the digits and then the threads.  The pass is
+        # skipped if all the keys have the same digit.
+        total = 0
+        skip = 0
+        for d in range(radix):
+            digit_start = total
+            for t in range(n_thread):
+                count = hist[t*radix + d]
+                hist[t*radix + d] = total
+                total = total + count
+            if total - digit_start == n:
+                skip = 1
+        if skip:
+            continue
+
+%if openmp:
+        for tid in ${thread_range}:
+%else:
+        for tid in range(n_thread):
+%endif
+            my_hist = hist + tid*radix
+            start = tid*chunksize
+            end = min(start + chunksize, n)
+            for i in range(start, end):
+                d = ((radix_key(src_k[i]) - kmin) >> shift) & mask
+                pos = my_hist[d]
+                my_hist[d] = pos + 1
+                dst_k[pos] = src_k[i]
+                if src_o == NULL:
+                    dst_o[pos] = i
+                else:
+                    dst_o[pos] = src_o[i]
+
+        src_k = dst_k
+        src_o = dst_o
+        dst_is_out = 1 - dst_is_out
+
+    free(hist)
+
+    if src_o == NULL:
+        memcpy(keys_out, keys, n*sizeof(radix_key_t))
+%if openmp:
+        for i in ${get_parallel_range("n", nogil=True)}:
+%else:
+        for i in range(n):
+%endif
+            order[i] = i
+    elif src_k != keys_out:
+        memcpy(keys_out, src_k, n*sizeof(radix_key_t))
+        memcpy(order, src_o, n*sizeof(radix_index_t))
+
+
+cpdef py_radix_sort(radix_key_t[:] keys, radix_key_t[:] keys_out,
+                    radix_key_t[:] keys_tmp, radix_index_t[:] order,
+                    radix_index_t[:] order_tmp,
+                    radix_ukey_t kmin, int n_bits, int radix_bits):
+    c_radix_sort(keys.shape[0], &keys[0], &keys_out[0], &keys_tmp[0],
+                 &order[0], &order_tmp[0], kmin, n_bits, radix_bits)
+
+
+cpdef py_segment_keys(radix_key_t[:] keys, int[:] seg_ids,
+                      unsigned long long[:] out, radix_ukey_t kmin,
+                      int key_bits):
+    cdef long i
+    cdef long n = keys.shape[0]
+%if openmp:
+    for i in ${get_parallel_range("n", nogil=True)}:
+%else:
+    for i in range(n):
+%endif
+        out[i] = ((<unsigned long long>seg_ids[i] << key_bits) |
+                  <unsigned long long>(radix_key(keys[i]) - kmin))
+'''
+
+
+def can_radix_sort(dtype, backend='cython'):
+    """Return True if keys of the given type can be radix sorted.
+    """
+    dtype = np.dtype(dtype)
+    if np.issubdtype(dtype, np.integer):
+        return True
+    return backend == 'cython' and dtype in (np.float32, np.float64)
+
+
+@memoize(key=lambda dtype, index_type='int': (
+    dtype, index_type, get_config().use_openmp
+))
+def get_radix_sort_module(dtype, index_type='int'):
+    """Return the compiled Cython radix sort module for keys of the given
+    integer or floating point type and permutations of the given index type.
+    """
+    dtype = np.dtype(dtype)
+    key_type = dtype_to_ctype(dtype)
+    if key_type == 'char':
+        key_type = 'signed char'
+    src = MakoTemplate(text=radix_sort_cy_template).render(
+        key_type=key_type,
+        ukey_type=dtype_to_ctype(np.dtype('u%d' % dtype.itemsize)),
+        kind=dtype.kind,
+        bits=8 * dtype.itemsize,
+        index_type=index_type,
+        openmp=get_config().use_openmp,
+        get_parallel_range=get_parallel_range
+    )
+    tp = Transpiler(backend='cython')
+    tp.add_code(src)
+    tp.compile()
+    return tp.mod
+
+
 class OutputSortBit(Template):
     def __init__(self, name, num_arys):
         super(OutputSortBit, self).__init__(name=name)
@@ -39,19 +277,129 @@ def input_sort_bit(i, inp_0, bit_number):
     return 1 if (inp_0[i] >> bit_number) & 1 == 0 else 0
 
 
-def radix_sort(ary_list, out_list=None, max_key_bits=None, backend=None):
+@memoize(key=lambda num_arys, dtype, backend: (
+    num_arys, dtype, backend, get_config().use_openmp,
+    get_config().use_double
+))
+def get_sort_bit_kernel(num_arys, dtype, backend):
+    output_sort_bit = OutputSortBit('output_sort_bit', num_arys)
+    return Scan(input_sort_bit, output_sort_bit.function,
+                'a+b', dtype=dtype, backend=backend)
+
+
+def get_key_bits(keys, backend=None):
+    """Return the number of bits needed to sort the given integer keys.
+
+    This is the number of bits of the largest key if all the keys are
+    non-negative and the number of bits of the type otherwise.
+    """
+    if array.minimum(keys, backend=backend) < 0:
+        return 8 * keys.dtype.itemsize
+    return max(int(array.maximum(keys, backend=backend)).bit_length(), 1)
+
+
+def _radix_sort_cython(ary_list, out_list, key_bits, radix_bits,
+                       index_dtype=None):
+    keys = ary_list[0]
+    n = keys.length
+    if index_dtype is None:
+        index_type = get_index_type(n)
+        index_dtype = get_index_dtype(n)
+    else:
+        index_dtype = np.dtype(index_dtype)
+        index_type = dtype_to_ctype(index_dtype)
+    mod = get_radix_sort_module(keys.dtype, index_type)
+    kmin = 0
+    if key_bits is None or keys.dtype.kind == 'i':
+        lo, hi = mod.py_key_range(keys.dev) if n else (0, 0)
+        # The sign bit of the signed keys is flipped so negative keys are
+        # below this and cannot be sorted with only the lower bits.
+        has_negative = (keys.dtype.kind == 'i' and
+                        lo < 1 << (8*keys.dtype.itemsize - 1))
+        if key_bits is None or has_negative:
+            kmin = lo
+            key_bits = int(hi - lo).bit_length()
+
+    if out_list:
+        sorted_keys = out_list[0]
+        sorted_keys.resize(n)
+    else:
+        sorted_keys = array.empty(n, keys.dtype, backend='cython')
+    order = array.empty(n, index_dtype, backend='cython')
+    if n:
+        keys_tmp = array.empty(n, keys.dtype, backend='cython')
+        order_tmp = array.empty(n, index_dtype, backend='cython')
+        mod.py_radix_sort(keys.dev, sorted_keys.dev, keys_tmp.dev, order.dev,
+                          order_tmp.dev, kmin, key_bits, radix_bits)
+
+    payload_out = out_list[1:] if out_list else None
+    if payload_out:
+        for ary in payload_out:
+            ary.resize(n)
+    payload = array.align(ary_list[1:], order, out_list=payload_out,
+                          backend='cython')
+    return [sorted_keys] + payload, order
+
+
+def segment_radix_keys(keys, seg_ids, n_segments):
+    """Return uint64 keys which order the Cython array `keys` by the int32
+    segment ids `seg_ids` and then by the keys.
+
+    The radix sort order of the keys is shifted to start at zero and the
+    segment id is placed above its bits.  Returns None if the segment ids and
+    the range of the keys do not fit in 64 bits.
+    """
+    n = keys.length
+    mod = get_radix_sort_module(keys.dtype, get_index_type(n))
+    lo, hi = mod.py_key_range(keys.dev) if n else (0, 0)
+    key_bits = int(hi - lo).bit_length()
+    if key_bits + int(n_segments - 1).bit_length() > 64:
+        return None
+    out = array.empty(n, np.uint64, backend='cython')
+    if n:
+        mod.py_segment_keys(keys.dev, seg_ids.dev, out.dev, lo, key_bits)
+    return out
+
+
+def radix_sort(ary_list, out_list=None, max_key_bits=None, backend=None,
+               radix_bits=8, index_dtype=None):
+    """Sort the arrays in `ary_list` by the keys in the first array.
+
+    The sort is stable.  Returns the list of sorted arrays and the permutation
+    that sorts the keys.  If `out_list` is passed the sorted arrays are
+    stored in it.
+
+    On the Cython backend, `radix_bits` bits of the keys are sorted in each
+    pass in parallel with OpenMP.  If `max_key_bits` is not given, only the
+    bits needed for the range of the keys are sorted.  It is also ignored
+    for signed keys if any of them are negative.  The keys may also be
+    float32/float64 in which case `max_key_bits` is ignored, NaNs with the
+    sign bit set are placed first and the others last.  The permutation is
+    an array of `index_dtype`, an int32 or int64 type, which defaults to the
+    index type of the kernels for the number of keys.  The other backends
+    only sort integers, one bit per pass with a scan, and always use the
+    index type.
+    """
     keys = ary_list[0]
     backend = array.get_backend(backend)
-    if not np.issubdtype(keys.dtype, np.integer):
-        raise ValueError("RadixSort can only sort integer types")
+    if not can_radix_sort(keys.dtype, backend):
+        raise ValueError("RadixSort cannot sort keys of type %s on %s"
+                         % (keys.dtype, backend))
+    if backend == 'cython':
+        if keys.dtype.kind == 'f':
+            max_key_bits = None
+        return _radix_sort_cython(ary_list, out_list, max_key_bits,
+                                  radix_bits, index_dtype)
     if max_key_bits is None:
-        max_key_bits = 8 * keys.dtype.itemsize
+        max_key_bits = get_key_bits(keys, backend=backend)
 
     # temp arrays
-    sorted_indices = array.zeros(keys.length, np.int32, backend=backend)
+    index_dtype = get_index_dtype(keys.length)
+    sorted_indices = array.zeros(keys.length, index_dtype, backend=backend)
     temp_indices = array.zeros_like(sorted_indices)
 
-    indices = array.arange(0, keys.length, 1, backend=backend)
+    indices = array.arange(0, keys.length, 1, dtype=index_dtype,
+                           backend=backend)
 
     # allocate temp arrays
     if out_list:
@@ -61,10 +409,7 @@ def radix_sort(ary_list, out_list=None, max_key_bits=None, backend=None):
     sorted_ary_list = [array.zeros_like(ary) for ary in ary_list]
 
     # kernel
-    output_sort_bit = OutputSortBit('output_sort_bit', len(ary_list))
-
-    sort_bit_knl = Scan(input_sort_bit, output_sort_bit.function,
-                        'a+b', dtype=keys.dtype, backend=backend)
+    sort_bit_knl = get_sort_bit_kernel(len(ary_list), keys.dtype, backend)
 
     for bit_number in range(max_key_bits):
         if bit_number == 0:
@@ -74,7 +419,7 @@ def radix_sort(ary_list, out_list=None, max_key_bits=None, backend=None):
             inp_indices = temp_indices
             inp_ary_list = temp_ary_list
 
-        args = {'bit_number': bit_number, 'indices': indices,
+        args = {'bit_number': bit_number, 'indices': inp_indices,
                 'sorted_indices': sorted_indices}
         args.update({'inp_%i' % i: ary for i, ary in enumerate(inp_ary_list)})
         args.update({'out_%i' %
@@ -52,7 +52,7 @@ class Template(object):
             name=name, args=arg_string, docs=docstring
         )
         src = sig + self.render(template)
-        annotations = getattr(self.template, '__annotations__', {})
+        annotations = dict(getattr(self.template, '__annotations__', {}))
         data = kwtype_to_annotation(extra_annotations)
         annotations.update(data)
         return src, annotations
@@ -5,6 +5,8 @@ from ..array import Array, wrap_array
 from ..config import Config, get_config
 import compyle.array as array
 from compyle import config
+from compyle.api import Elementwise, annotate
+from compyle.sort import radix_sort
 
 
 @pytest.fixture
@@ -274,11 +276,8 @@ def test_sort_by_keys(backend):
     out_array1, out_array2 = array.sort_by_keys([dev_array1, dev_array2])
 
     # Then
-    if backend in ['opencl', 'cuda']:
-        # opencl/cuda backend radix sort is stable
-        order = np.argsort(nparr1, stable=True)
-    else:
-        order = np.argsort(nparr1)
+    # All the backends use a stable radix sort for integer keys.
+    order = np.argsort(nparr1, stable=True)
     act_result1 = np.take(nparr1, order)
     act_result2 = np.take(nparr2, order)
 
@@ -309,6 +308,83 @@ def test_radix_sort_by_keys():
     get_config().use_openmp = False
 
 
+@pytest.mark.parametrize('use_openmp', [False, True])
+@pytest.mark.parametrize('dtype', [np.int32, np.int64, np.uint16, np.int8])
+def test_radix_sort_with_payloads(dtype, use_openmp):
+    # Given
+    info = np.iinfo(dtype)
+    keys = np.random.randint(info.min, info.max, 5000, dtype=dtype)
+    x = np.random.random(5000)
+    y = np.arange(5000, dtype=np.int32)
+    arrays = array.wrap(keys, x, y, backend='cython')
+
+    # When
+    with config.use_config(use_openmp=use_openmp):
+        (out_keys, out_x, out_y), order = radix_sort(arrays, radix_bits=6)
+
+    # Then
+    expect = np.argsort(keys, stable=True)
+    np.testing.assert_array_equal(order.get(), expect)
+    np.testing.assert_array_equal(out_keys.get(), keys[expect])
+    np.testing.assert_array_equal(out_x.get(), x[expect])
+    np.testing.assert_array_equal(out_y.get(), y[expect])
+
+
+def test_radix_sort_uses_the_range_of_the_keys():
+    # Given
+    keys = np.random.randint(1000, 1010, 100).astype(np.int32)
+    dev_keys = array.wrap(keys, backend='cython')
+    out = [array.zeros(1, np.int32, backend='cython')]
+
+    # When
+    result, order = radix_sort([dev_keys], out_list=out)
+
+    # Then
+    assert result[0] is out[0]
+    np.testing.assert_array_equal(out[0].get(), np.sort(keys))
+
+    # When
+    result, order = radix_sort([dev_keys], max_key_bits=4)
+
+    # Then
+    # Only the lower 4 bits are sorted.
+    expect = np.argsort(keys & 15, stable=True)
+    np.testing.assert_array_equal(result[0].get(), keys[expect])
+
+
+def test_radix_sort_ignores_max_key_bits_for_negative_keys():
+    # Given
+    keys = np.array([3, -1, 2, -5, 0], dtype=np.int64)
+    dev_keys = array.wrap(keys, backend='cython')
+
+    # When
+    result, order = radix_sort([dev_keys], max_key_bits=4)
+
+    # Then
+    np.testing.assert_array_equal(result[0].get(), np.sort(keys))
+    np.testing.assert_array_equal(order.get(), np.argsort(keys))
+
+
+@check_all_backends
+def test_radix_sort_with_long_index(backend):
+    check_import(backend)
+
+    # Given
+    keys = np.random.randint(0, 100, 1000).astype(np.int32)
+    values = np.random.random(1000)
+    dev_keys, dev_values = array.wrap(keys, values, backend=backend)
+
+    # When
+    with config.use_config(index_type='long', use_double=True):
+        result, order = radix_sort([dev_keys, dev_values], backend=backend)
+
+    # Then
+    expect = np.argsort(keys, stable=True)
+    assert order.dtype == np.int64
+    np.testing.assert_array_equal(order.get(), expect)
+    np.testing.assert_array_equal(result[1].get(), values[expect])
+
+
 @pytest.mark.parametrize(
     'backend', ['cython', 'opencl',
                 pytest.param('cuda', marks=pytest.mark.xfail)])
@@ -338,10 +414,7 @@ def test_sort_by_keys_with_output(backend):
     assert np.all(out_arrays[1].get() == act_result2)
 
 
-@pytest.mark.parametrize(
-    'backend', ['cython', 'cuda',
-                pytest.param('opencl', marks=pytest.mark.xfail)]
-)
+@check_all_backends
 def test_argsort(backend):
     check_import(backend)
 
@@ -353,8 +426,185 @@ def test_argsort(backend):
     out = array.argsort(devarr1)
 
     # Then
-    ans = np.argsort(nparr1)
+    ans = np.argsort(nparr1, stable=True)
     assert np.all(out.get() == ans)
+    assert np.all(devarr1.get() == nparr1[ans])
+    if backend != 'opencl':
+        assert out.dtype == np.intp
+
+
+@check_all_backends
+def test_argsort_without_sorting_the_input(backend):
+    check_import(backend)
+
+    # Given
+    nparr1 = np.random.randint(0, 100, 1000, dtype=np.int32)
+    devarr1 = array.wrap(nparr1.copy(), backend=backend)
+
+    # When
+    out = array.argsort(devarr1, inplace=False)
+
+    # Then
+    assert np.all(out.get() == np.argsort(nparr1, stable=True))
+    assert np.all(devarr1.get() == nparr1)
+
+
+@check_all_backends
+def test_segmented_sort(backend):
+    check_import(backend)
+
+    # Given
+    keys = np.random.randint(0, 20, 1000).astype(np.int32)
+    values = np.random.random(1000)
+    offsets = np.array([0, 10, 10, 400, 999, 1000], dtype=np.int32)
+    dev_keys, dev_values, dev_offsets = array.wrap(
+        keys, values, offsets, backend=backend
+    )
+
+    # When
+    order = array.segmented_argsort(dev_keys, dev_offsets)
+    out_keys, out_values = array.segmented_sort(
+        [dev_keys, dev_values], dev_offsets
+    )
+
+    # Then
+    expect = np.concatenate([
+        start + np.argsort(keys[start:end], stable=True)
+        for start, end in zip(offsets[:-1], offsets[1:])
+    ])
+    if backend != 'cuda':
+        np.testing.assert_array_equal(order.get(), expect)
+        np.testing.assert_array_equal(out_values.get(), values[expect])
+    np.testing.assert_array_equal(keys[order.get()], keys[expect])
+    np.testing.assert_array_equal(out_keys.get(), keys[expect])
+    np.testing.assert_array_equal(dev_keys.get(), keys)
+
+
+@check_all_backends
+@pytest.mark.parametrize('dtype', [np.float32, np.float64, np.int64])
+def test_segmented_argsort_with_wide_and_float_keys(backend, dtype):
+    check_import(backend)
+
+    # Given
+    keys = np.random.uniform(-100, 100, 1000).astype(dtype)
+    if dtype == np.int64:
+        # The range of the keys does not fit with the segment ids.
+        keys[:2] = np.iinfo(np.int64).min, np.iinfo(np.int64).max
+    offsets = np.arange(0, 1001, 100, dtype=np.int32)
+    dev_keys, dev_offsets = array.wrap(keys, offsets, backend=backend)
+
+    # When
+    order = array.segmented_argsort(dev_keys, dev_offsets)
+
+    # Then
+    expect = np.concatenate([
+        start + np.argsort(keys[start:end], stable=True)
+        for start, end in zip(offsets[:-1], offsets[1:])
+    ])
+    np.testing.assert_array_equal(order.get(), expect)
+
+
+@check_all_backends
+def test_segmented_argsort_with_many_segments(backend):
+    check_import(backend)
+
+    # Given
+    info = np.iinfo(np.int64)
+    keys = np.random.randint(info.min, info.max, 100000, dtype=np.int64)
+    offsets = np.arange(0, 100001, 2, dtype=np.int32)
+    dev_keys, dev_offsets = array.wrap(keys, offsets, backend=backend)
+
+    # When
+    order = array.segmented_argsort(dev_keys, dev_offsets)
+
+    # Then
+    # The ranks of the keys, n_segments*n, do not fit in an int.
+    assert (len(offsets) - 1) * len(keys) > 2**31
+    seg_ids = np.repeat(np.arange(len(offsets) - 1), 2)
+    np.testing.assert_array_equal(order.get(), np.lexsort((keys, seg_ids)))
+
+
+@check_all_backends
+def test_sort_by_keys_and_argsort_with_negative_keys(backend):
+    check_import(backend)
+
+    # Given
+    keys = np.random.randint(-100, 100, 1000).astype(np.int32)
+    payload = np.random.random(1000)
+    dev_keys, dev_payload = array.wrap(keys, payload, backend=backend)
+    expect = np.argsort(keys, stable=True)
+
+    # When
+    out_keys, out_payload = array.sort_by_keys([dev_keys, dev_payload],
+                                               key_bits=8)
+
+    # Then
+    np.testing.assert_array_equal(out_keys.get(), keys[expect])
+    if backend != 'cuda':
+        np.testing.assert_array_equal(out_payload.get(), payload[expect])
+
+    # When
+    order = array.argsort(dev_keys, inplace=False)
+
+    # Then
+    np.testing.assert_array_equal(keys[order.get()], keys[expect])
+    if backend != 'cuda':
+        np.testing.assert_array_equal(order.get(), expect)
+
+
+@check_all_backends
+def test_reduce_by_key(backend):
+    check_import(backend)
+
+    # Given
+    keys = np.sort(np.random.randint(0, 50, 1000)).astype(np.int32)
+    values = np.random.random(1000)
+    dev_keys, dev_values = array.wrap(keys, values, backend=backend)
+
+    # When
+    offsets, unique_keys = array.segment_offsets(dev_keys)
+    out_keys, sums = array.reduce_by_key(dev_keys, dev_values)
+    out_keys, maxs = array.reduce_by_key(
+        dev_keys, dev_values, reduce_expr='max(a, b)', neutral='-INFINITY'
+    )
+
+    # Then
+    expect_keys, starts = np.unique(keys, return_index=True)
+    np.testing.assert_array_equal(unique_keys.get(), expect_keys)
+    np.testing.assert_array_equal(out_keys.get(), expect_keys)
+    np.testing.assert_array_equal(offsets.get(),
+                                  np.append(starts, len(keys)))
+    np.testing.assert_allclose(sums.get(), np.add.reduceat(values, starts))
+    np.testing.assert_allclose(maxs.get(),
+                               np.maximum.reduceat(values, starts))
+
+
+@pytest.mark.parametrize('use_openmp', [False, True])
+@check_all_dtypes
+def test_sort_by_keys_and_argsort_are_stable_on_cython(dtype, use_openmp):
+    # Given
+    keys = (np.random.standard_normal(5000) * 100).astype(dtype)
+    keys[::3] = keys[1::3][:len(keys[::3])]
+    if dtype != np.int32:
+        keys[:3] = [np.inf, -np.inf, 0]
+    payload = np.random.random(5000)
+    dev_keys, dev_payload = array.wrap(keys, payload, backend='cython')
+    expect = np.argsort(keys, stable=True)
+
+    with config.use_config(use_openmp=use_openmp):
+        # When
+        out_keys, out_payload = array.sort_by_keys([dev_keys, dev_payload])
+
+        # Then
+        np.testing.assert_array_equal(out_keys.get(), keys[expect])
+        np.testing.assert_array_equal(out_payload.get(), payload[expect])
+
+        # When
+        order = array.argsort(dev_keys)
+
+        # Then
+        np.testing.assert_array_equal(order.get(), expect)
+        np.testing.assert_array_equal(dev_keys.get(), keys[expect])
 
 
 @check_all_backends
@@ -590,3 +840,269 @@ def test_binary_op(backend):
     # Then
     assert np.all(out_add.get() == x_np + x_np)
     assert np.all(out_sub.get() == np.zeros_like(x_np))
+
+
+@check_all_backends
+@check_all_dtypes
+def test_binary_op_with_scalar(backend, dtype, reset_use_double):
+    check_import(backend)
+    if dtype == np.float64:
+        get_config().use_double = True
+
+    # Given
+    x = array.arange(0, 10, 1, dtype=dtype, backend=backend)
+    x_np = np.arange(10, dtype=dtype)
+
+    # When
+    out_add = x + 2
+    out_radd = 2 + x
+    out_sub = x - 2
+    out_rsub = 2 - x
+
+    # Then
+    for out, expect in ((out_add, x_np + 2), (out_radd, 2 + x_np),
+                        (out_sub, x_np - 2), (out_rsub, 2 - x_np)):
+        assert out.dtype == expect.dtype
+        assert out.backend == backend
+        assert np.all(out.get() == expect)
+
+
+@check_all_backends
+def test_inplace_binary_op(backend):
+    check_import(backend)
+
+    # Given
+    x = array.arange(0, 10, 1, dtype=np.float32, backend=backend)
+    y = array.ones_like(x)
+    data = x.dev
+    x_np = np.arange(10, dtype=np.float32)
+
+    # When
+    x += y
+    x *= 3
+    x -= 1
+    x /= 2.0
+
+    # Then
+    assert x.dev is data
+    assert np.allclose(x.get(), ((x_np + 1)*3 - 1)/2.0)
+
+
+def test_inplace_binary_op_checks_types():
+    # Given
+    x = array.arange(0, 10, 1, dtype=np.int32, backend='cython')
+
+    # When/Then
+    with pytest.raises(TypeError):
+        x /= 2
+    with pytest.raises(TypeError):
+        x += 2.5
+    with pytest.raises(ValueError):
+        x += array.ones(5, dtype=np.int32, backend='cython')
+
+
+@check_all_backends
+def test_binary_op_with_out(backend):
+    check_import(backend)
+
+    # Given
+    x = array.arange(0, 10, 1, dtype=np.float32, backend=backend)
+    y = array.ones_like(x)
+    out = array.zeros_like(x)
+    cmp_out = array.zeros(10, dtype=np.int32, backend=backend)
+    x_np = np.arange(10, dtype=np.float32)
+
+    # When
+    result = array.binary_op('-', x, y, out=out)
+    cmp_result = array.binary_op('>=', x, out, out=cmp_out)
+
+    # Then
+    assert result is out
+    assert cmp_result is cmp_out
+    assert np.all(out.get() == x_np - 1)
+    assert np.all(cmp_out.get() == 1)
+
+
+@check_all_backends
+def test_out_argument(backend):
+    check_import(backend)
+
+    # Given
+    x = array.arange(0, 10, 1, dtype=np.float32, backend=backend)
+    x_np = np.arange(10, dtype=np.float32)
+    cond = x > 5
+
+    # When
+    out_where = array.zeros_like(x)
+    res_where = array.where(cond, x, array.zeros_like(x), out=out_where)
+    out_take = array.zeros(10, dtype=np.float32, backend=backend)
+    res_take = array.take_bool(x, cond, out=out_take)
+    out_diff = array.ones(9, dtype=np.float32, backend=backend)
+    res_diff = array.diff(x, 1, out=out_diff)
+    out_lin = array.zeros(5, dtype=np.float32, backend=backend)
+    res_lin = array.linspace(0, 2, 5, dtype=np.float32, backend=backend,
+                             out=out_lin)
+
+    # Then
+    assert res_where is out_where
+    assert np.all(out_where.get() == np.where(x_np > 5, x_np, 0))
+    assert res_take is out_take
+    assert np.all(out_take.get() == x_np[x_np > 5])
+    assert res_diff is out_diff
+    assert np.all(out_diff.get() == 1)
+    assert res_lin is out_lin
+    assert np.allclose(out_lin.get(), np.linspace(0, 2, 5))
+
+
+@check_all_backends
+def test_array_expression_is_lazy(backend):
+    check_import(backend)
+
+    # Given
+    a = array.arange(0, 10, 1, dtype=np.float32, backend=backend)
+    b = array.ones_like(a)
+    c = array.ones_like(a)
+    a_np = np.arange(10, dtype=np.float32)
+
+    # When
+    tmp = a*b + c
+    expr = tmp - 2*a/4.0
+
+    # Then
+    assert isinstance(expr, array.ArrayExpression)
+    assert not expr.is_evaluated
+    assert expr.dtype == np.float32
+    assert len(expr) == 10
+
+    # When
+    result = expr.get()
+
+    # Then
+    assert expr.is_evaluated
+    assert not tmp.is_evaluated
+    assert np.allclose(result, a_np + 1 - 2*a_np/4.0)
+
+
+def test_array_expression_data_is_the_evaluated_array():
+    # Given
+    a = array.wrap(np.arange(5, dtype=np.float64), backend='cython')
+    b = array.wrap(np.ones(5), backend='cython')
+
+    # When
+    c = a + b
+    data = c.data
+
+    # Then
+    assert c.is_evaluated
+    assert isinstance(data, np.ndarray)
+    assert np.all(data == np.arange(5) + 1)
+
+@check_all_backends
+def test_array_expression_division(backend):
+    check_import(backend)
+
+    # Given
+    x = array.arange(1, 11, 1, dtype=np.int32, backend=backend)
+    x_np = np.arange(1, 11, dtype=np.int32)
+
+    # When
+    y = x/(x + 1)
+    z = 3/x
+
+    # Then
+    assert y.dtype == np.float64
+    assert np.allclose(y.get(), x_np/(x_np + 1))
+    assert np.allclose(z.get(), 3/x_np)
+
+
+def test_array_expression_is_evaluated_before_operand_changes():
+    # Given
+    x = array.arange(0, 10, 1, dtype=np.float64, backend='cython')
+    y = x*2
+    z = x + 1
+    w = x - 1
+    x_np = np.arange(10, dtype=np.float64)
+
+    @annotate
+    def set_one(i, x):
+        x[i] = 1.0
+
+    # When
+    x += 1
+
+    # Then
+    assert z.is_evaluated
+    assert np.all(y.get() == x_np*2)
+    assert np.all(z.get() == x_np + 1)
+    assert np.all(w.get() == x_np - 1)
+
+    # When
+    x.fill(5)
+    v = x*3
+    Elementwise(set_one, backend='cython')(x)
+
+    # Then
+    assert np.all(v.get() == 15)
+    assert np.all(x.get() == 1)
+
+
+def test_array_expression_is_evaluated_before_operand_is_replaced():
+    # Given
+    a = array.wrap(np.arange(5, dtype=np.float64), backend='cython')
+    b = array.wrap(np.ones(5), backend='cython')
+    c = a + b
+    d = a*2
+    e = b - 1
+
+    # When
+    a.set(np.zeros(5))
+
+    # Then
+    assert c.is_evaluated
+    assert np.all(c.get() == np.arange(5) + 1)
+    assert np.all(d.get() == np.arange(5)*2)
+
+    # When
+    b.set_data(np.zeros(5))
+
+    # Then
+    assert np.all(e.get() == 0)
+
+    # When
+    f = a + b
+    a.resize(3)
+
+    # Then
+    assert len(f) == 5
+    assert np.all(f.get() == 0)
+
+
+def test_array_expression_is_evaluated_before_out_is_written():
+    # Given
+    a = array.wrap(np.arange(5, dtype=np.float64), backend='cython')
+    b = array.wrap(np.ones(5), backend='cython')
+    idx = array.wrap(np.arange(5)[::-1].astype(np.int32), backend='cython')
+    c = b*2.0
+
+    # When
+    array.cumsum(a, out=b)
+
+    # Then
+    assert np.all(c.get() == 2)
+    assert np.all(b.get() == np.cumsum(np.arange(5)))
+
+    # When
+    d = b + 1.0
+    array.take(a, idx, out=b)
+
+    # Then
+    assert np.all(d.get() == np.cumsum(np.arange(5)) + 1)
+    assert np.all(b.get() == np.arange(5)[::-1])
+
+    # When
+    e = b*3.0
+    a.copy_values(idx, b)
+
+    # Then
+    assert np.all(e.get() == np.arange(5)[::-1]*3)
+    assert np.all(b.get() == np.arange(5)[::-1])
@@ -5,7 +5,7 @@ from textwrap import dedent
 import unittest
 
 from ..ast_utils import (
-    get_assigned, get_symbols, get_unknown_names_and_calls,
+    get_array_access, get_assigned, get_symbols, get_unknown_names_and_calls,
     has_node, has_return
 )
 
@@ -120,6 +120,24 @@ class TestASTUtils(unittest.TestCase):
         self.assertSetEqual(names, e_names)
         self.assertSetEqual(calls, e_calls)
 
+    def test_get_array_access(self):
+        # Given
+        code = dedent('''
+        def f(i, x, y, z, idx, a):
+            y[i] = x[idx[i]] + a
+            z[i] += 2.0*y[i]
+        ''')
+
+        # When
+        access = get_array_access(code)
+
+        # Then
+        expect = {
+            'x': (True, False), 'idx': (True, False), 'y': (True, True),
+            'z': (True, True)
+        }
+        self.assertEqual(access, expect)
+
 
 if __name__ == '__main__':
     unittest.main()
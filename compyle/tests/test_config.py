@@ -85,6 +85,17 @@ class ConfigTestCase(TestCase):
         # Then
         self.assertEqual(config.use_double, 10)
 
+    def test_set_get_async_launch_config(self):
+        # Given
+        config = self.config
+        # When
+        # Then
+        self.assertFalse(config.async_launch)
+        # When
+        config.async_launch = True
+        # Then
+        self.assertTrue(config.async_launch)
+
     def test_default_global_config_is_really_global(self):
         # Given.
         config = get_config()
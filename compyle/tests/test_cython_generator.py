@@ -7,6 +7,7 @@ import sys
 
 
 from ..config import get_config, set_config, use_config
+from ..low_level import atomic_add, atomic_inc, atomic_max
 from ..types import declare, KnownType, annotate
 from ..cython_generator import (
     CythonGenerator, CythonClassHelper, all_numeric, get_parallel_range,
@@ -260,6 +261,13 @@ def simple_func(d_idx, d_x, x=0.0):
     d_x[d_idx] += x
 
 
+def func_with_atomics(d_idx, d_x, d_y):
+    j = declare('int')
+    j = atomic_inc(d_y[0])
+    atomic_add(d_x[j], d_x[d_idx + 1])
+    atomic_max(d_x[0], max(d_x[d_idx], 0.0))
+
+
 @annotate(i='int', y='floatp', return_='float')
 def annotated_f(i, y=[0.0]):
     x = declare('LOCAL_MEM matrix(64, "unsigned int")')
@@ -627,6 +635,34 @@ class TestCythonCodeGenerator(TestBase):
         """)
         self.assert_code_equal(cg.get_code().strip(), expect.strip())
 
+    def test_atomics_without_openmp(self):
+        cg = CythonGenerator()
+        cg.parse(func_with_atomics)
+        expect = dedent("""
+        cdef inline void func_with_atomics(long d_idx, double* d_x, double* d_y) noexcept:
+            cdef int j
+            j = d_y[0]
+            d_y[0] += 1
+
+            d_x[j] += d_x[d_idx + 1]
+            d_x[0] = max(d_x[0], max(d_x[d_idx], 0.0))
+        """)
+        self.assert_code_equal(cg.get_code().strip(), expect.strip())
+
+    def test_atomics_with_openmp(self):
+        get_config().use_openmp = True
+        cg = CythonGenerator()
+        cg.parse(func_with_atomics)
+        expect = dedent("""
+        cdef inline void func_with_atomics(long d_idx, double* d_x, double* d_y) noexcept nogil:
+            cdef int j
+            j = compyle_atomic_inc(&d_y[0])
+
+            compyle_atomic_add(&d_x[j], d_x[d_idx + 1])
+            compyle_atomic_max(&d_x[0], max(d_x[d_idx], 0.0))
+        """)
+        self.assert_code_equal(cg.get_code().strip(), expect.strip())
+
     def test_wrap_function(self):
         cg = CythonGenerator()
         cg.parse(func_with_return)
@@ -18,7 +18,10 @@ except ImportError:
 import compyle.ext_module
 
 from ..ext_module import (get_md5, ExtModule, get_ext_extension,
-                          get_config_file_opts, get_openmp_flags)
+                          get_config_file_opts, get_openmp_flags,
+                          build_all, build_bundles, defer_builds,
+                          DeferredBuild, make_bundles, split_source)
+from ..profile import get_build_records
 
 
 def _check_write_source(root):
@@ -168,6 +171,137 @@ class TestExtModule(TestCase):
         self.assertEqual(mod.f(), "hello world")
         self.assertTrue(exists(s.ext_path))
 
+    def test_load_records_the_build(self):
+        # Given
+        s = ExtModule(self.data, root=self.root)
+        n_records = len(get_build_records())
+
+        # When
+        s.load()
+        ExtModule(self.data, root=self.root).load()
+
+        # Then
+        records = get_build_records()[n_records:]
+        self.assertEqual(len(records), 2)
+        built, cached = records
+        self.assertEqual(built['name'], s.name)
+        self.assertEqual(built['cache'], 'miss')
+        self.assertEqual(built['source_hash'], s.hash)
+        for phase in ('cython', 'c_compile', 'load'):
+            self.assertTrue(built['phases'][phase] >= 0.0)
+        self.assertEqual(cached['cache'], 'hit')
+        self.assertNotIn('c_compile', cached['phases'])
+
+    def test_load_is_deferred_inside_defer_builds(self):
+        # Given
+        s = ExtModule(self.data, root=self.root)
+
+        # When
+        with defer_builds() as deferred:
+            self.assertRaises(DeferredBuild, s.load)
+
+        # Then
+        self.assertEqual(deferred, [s])
+        self.assertFalse(exists(s.ext_path))
+
+    def test_build_all(self):
+        # Given
+        data = self.data.replace('hello world', 'hello again')
+        mods = [ExtModule(self.data, root=self.root),
+                ExtModule(data, root=self.root),
+                ExtModule(data, root=self.root)]
+
+        # When
+        result = build_all(mods, n_jobs=2)
+
+        # Then
+        self.assertEqual(result, [True, True, True])
+        for s in mods:
+            self.assertTrue(exists(s.ext_path))
+        self.assertEqual(mods[1].load().f(), "hello again")
+
+    def test_build_all_merges_the_records_of_deferred_builds(self):
+        # Given
+        s = ExtModule(self.data, root=self.root)
+        with defer_builds():
+            self.assertRaises(DeferredBuild, s.load)
+        n_records = len(get_build_records())
+
+        # When
+        build_all([s], n_jobs=2)
+
+        # Then
+        records = get_build_records()
+        self.assertEqual(len(records), n_records)
+        record = records[-1]
+        self.assertEqual(record['source_hash'], s.hash)
+        self.assertEqual(record['cache'], 'miss')
+        for phase in ('cython', 'c_compile'):
+            self.assertTrue(record['phases'][phase] >= 0.0)
+
+    def test_split_source(self):
+        # Given
+        src = dedent('''\
+        # cython: language_level=3
+        from libc.math cimport *
+        cdef int N = 10
+
+        cdef inline double f(int i,
+                             double x):
+            return x
+
+        cpdef g():
+            return 1
+        ''')
+
+        # When
+        units = split_source(src)
+
+        # Then
+        keys = [x[0] for x in units]
+        self.assertEqual(keys, ['# cython: language_level=3',
+                                'from libc.math cimport *', 'N', 'f', 'g'])
+        self.assertTrue(units[3][1].endswith('return x'))
+
+    def test_make_bundles_merges_and_deduplicates_sources(self):
+        # Given
+        data = self.data.replace('def f():', 'def g():')
+        conflict = self.data.replace('hello world', 'hello again')
+        mods = [ExtModule(self.data, root=self.root),
+                ExtModule(data, root=self.root),
+                ExtModule(conflict, root=self.root)]
+
+        # When
+        bundles = make_bundles(mods)
+
+        # Then
+        self.assertEqual(len(bundles), 2)
+        self.assertEqual(bundles[0].members, mods[:2])
+        code = bundles[0].get_code()
+        self.assertEqual(code.count('# cython: language_level=3'), 1)
+        self.assertIn('def f():', code)
+        self.assertIn('def g():', code)
+        self.assertEqual(bundles[1].members, mods[2:])
+
+    def test_build_bundles(self):
+        # Given
+        data = self.data.replace('def f():', 'def g():')
+        mods = [ExtModule(self.data, root=self.root),
+                ExtModule(data, root=self.root)]
+
+        # When
+        result = build_bundles(mods, n_jobs=1)
+
+        # Then
+        self.assertEqual(result, [True, True])
+        for s in mods:
+            self.assertFalse(exists(s.ext_path))
+        m1 = ExtModule(self.data, root=self.root).load()
+        m2 = ExtModule(data, root=self.root).load()
+        self.assertIs(m1, m2)
+        self.assertEqual(m1.f(), "hello world")
+        self.assertEqual(m2.g(), "hello world")
+
     @pytest.mark.usefixtures("use_capsys")
     def test_compiler_errors_are_captured(self):
         # Given
@@ -0,0 +1,149 @@
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from ..array import wrap
+from ..config import use_config
+from ..kernel_index import (KernelIndex, get_dependencies, get_kernel_index,
+                            set_kernel_index)
+from ..parallel import Elementwise, ElementwiseBase, ReductionBase, ScanBase
+from ..types import annotate
+
+SCALE = 2.0
+
+
+@annotate(i='int', x='doublep', return_='double')
+def helper(i, x):
+    return SCALE*x[i]
+
+
+@annotate(i='int', doublep='x, y')
+def scale(i, x, y):
+    y[i] = helper(i, x)
+
+
+@annotate(i='int', ary='doublep', return_='double')
+def input_expr(i, ary):
+    return ary[i]
+
+
+@annotate(i='int', item='double', doublep='ary, out')
+def output_expr(i, item, ary, out):
+    out[i] = item
+
+
+class TestKernelIndex(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.orig_index = get_kernel_index()
+        self.index = KernelIndex(root=self.root)
+        set_kernel_index(self.index)
+
+    def tearDown(self):
+        set_kernel_index(self.orig_index)
+        shutil.rmtree(self.root)
+
+    def test_key_depends_on_source_and_config(self):
+        # Given
+        index = self.index
+
+        # When
+        with use_config(use_openmp=False) as cfg:
+            k1 = index.get_key('elementwise', [scale], config=cfg)
+            k2 = index.get_key('elementwise', [scale], config=cfg)
+            k3 = index.get_key('elementwise', [helper], config=cfg)
+            k4 = index.get_key('elementwise', [scale], extra=('int',),
+                               config=cfg)
+        with use_config(use_openmp=True) as cfg:
+            k5 = index.get_key('elementwise', [scale], config=cfg)
+
+        # Then
+        self.assertEqual(k1, k2)
+        self.assertEqual(len(set([k1, k3, k4, k5])), 4)
+
+    def test_get_dependencies(self):
+        # When
+        deps = get_dependencies([scale])
+
+        # Then
+        names = [x[1] for x in deps]
+        self.assertIn('helper', names)
+        self.assertIn('SCALE', names)
+        self.assertIn([__name__, 'SCALE', '2.0'], deps)
+
+    def test_elementwise_is_loaded_from_index(self):
+        # Given
+        x = wrap(np.arange(10, dtype=np.float64), backend='cython')
+        y = wrap(np.zeros(10), backend='cython')
+        e = ElementwiseBase(scale, backend='cython')
+        self.assertIsNone(getattr(e, '_index_entry', None))
+
+        # When
+        e1 = ElementwiseBase(scale, backend='cython')
+        e1(x, y)
+
+        # Then
+        self.assertIsNotNone(e1._index_entry)
+        np.testing.assert_array_almost_equal(y.get(), 2.0*x.get())
+        self.assertEqual(e1.source, e.source)
+        self.assertEqual(e1.all_source, e.all_source)
+
+    def test_jit_elementwise_is_loaded_from_index(self):
+        # Given
+        x = wrap(np.arange(10, dtype=np.float64), backend='cython')
+        y = wrap(np.zeros(10), backend='cython')
+        e = Elementwise(scale, backend='cython')
+        e(x, y)
+        # Remove the in-memory cache of kernels.
+        del scale.cached_kernel
+
+        # When
+        e1 = Elementwise(scale, backend='cython')
+        e1(x, y)
+
+        # Then
+        self.assertIsNotNone(e1.elementwise._index_entry)
+        np.testing.assert_array_almost_equal(y.get(), 2.0*x.get())
+
+    def test_changed_dependency_invalidates_entry(self):
+        # Given
+        e = ElementwiseBase(scale, backend='cython')
+        key = e._index_key
+        self.assertIsNotNone(self.index.get(key))
+
+        # When
+        with mock.patch('%s.SCALE' % __name__, 3.0):
+            entry = self.index.get(key)
+
+        # Then
+        self.assertIsNone(entry)
+        self.assertIsNotNone(self.index.get(key))
+
+    def test_reduction_and_scan_are_loaded_from_index(self):
+        # Given
+        x = wrap(np.arange(10, dtype=np.float64), backend='cython')
+        out = wrap(np.zeros(10), backend='cython')
+        ReductionBase('a+b', backend='cython')
+        ScanBase(input_expr, output_expr, 'a+b', dtype=np.float64,
+                 backend='cython')
+        del output_expr.arg_keys
+
+        # When
+        r = ReductionBase('a+b', backend='cython')
+        result = r(x)
+        scan = ScanBase(input_expr, output_expr, 'a+b', dtype=np.float64,
+                        backend='cython')
+        scan(ary=x, out=out)
+
+        # Then
+        self.assertIsNotNone(r._index_entry)
+        self.assertIsNotNone(scan._index_entry)
+        self.assertEqual(result, 45.0)
+        np.testing.assert_array_almost_equal(out.get(), np.cumsum(x.get()))
+
+    def test_index_is_not_used_when_disabled(self):
+        with use_config(use_kernel_index=False):
+            self.assertIsNone(get_kernel_index())
@@ -0,0 +1,230 @@
+import unittest
+
+import numpy as np
+from pytest import importorskip
+
+from ..array import empty, zeros
+from ..config import use_config
+from ..memory_pool import (NumpyPool, Workspace, bin_size, get_memory_pool,
+                           get_workspace_stats)
+
+
+class TestNumpyPool(unittest.TestCase):
+    def test_bin_size(self):
+        self.assertEqual(bin_size(1), 1)
+        self.assertEqual(bin_size(8), 8)
+        self.assertEqual(bin_size(9), 10)
+        self.assertEqual(bin_size(1 << 20), 1 << 20)
+        self.assertEqual(bin_size((1 << 20) + 1), 5 << 18)
+        for n in (13, 1000, 12345678):
+            self.assertTrue(n <= bin_size(n) <= 1.25*n)
+
+    def test_memory_is_reused_once_released(self):
+        # Given
+        pool = NumpyPool(min_bytes=0)
+        x = pool.empty(1000, np.float64)
+        address = x.ctypes.data
+
+        # When
+        y = pool.empty(1000, np.float64)
+
+        # Then
+        self.assertNotEqual(y.ctypes.data, address)
+
+        # When
+        del x
+        z = pool.empty(990, np.float64)
+
+        # Then
+        self.assertEqual(z.ctypes.data, address)
+        self.assertEqual(z.shape, (990,))
+        self.assertEqual(z.dtype, np.float64)
+        stats = pool.get_stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 2)
+        self.assertEqual(stats['active_blocks'], 2)
+        self.assertEqual(stats['held_blocks'], 0)
+
+    def test_views_keep_memory_in_use(self):
+        # Given
+        pool = NumpyPool(min_bytes=0)
+        x = pool.empty(1000, np.float64)
+        view = x[10:20]
+        other = x.view(np.int64)[5:]
+        address = x.ctypes.data
+
+        # When
+        del x
+        y = pool.empty(1000, np.float64)
+
+        # Then
+        self.assertNotEqual(y.ctypes.data, address)
+        self.assertEqual(view.ctypes.data, address + 80)
+
+        # When
+        del view
+        z = pool.empty(1000, np.float64)
+
+        # Then
+        self.assertNotEqual(z.ctypes.data, address)
+
+        # When
+        del other
+        w = pool.empty(1000, np.float64)
+
+        # Then
+        self.assertEqual(w.ctypes.data, address)
+
+    def test_memory_used_by_a_memoryview_is_not_reused(self):
+        # Given
+        pool = NumpyPool(min_bytes=0)
+        x = pool.empty(1000, np.float64)
+        mv = memoryview(x)
+        address = x.ctypes.data
+
+        # When
+        del x
+        y = pool.empty(1000, np.float64)
+
+        # Then
+        self.assertNotEqual(y.ctypes.data, address)
+        self.assertEqual(pool.get_stats()['active_blocks'], 2)
+
+        # When
+        mv.release()
+
+        # Then
+        self.assertEqual(pool.get_stats()['held_blocks'], 1)
+
+    def test_trim_releases_unused_memory(self):
+        # Given
+        pool = NumpyPool(min_bytes=0)
+        x = pool.empty(1000, np.float64)
+        y = pool.empty(100, np.int32)
+        del y
+        self.assertEqual(pool.get_stats()['held_blocks'], 1)
+
+        # When
+        pool.trim()
+
+        # Then
+        stats = pool.get_stats()
+        self.assertEqual(stats['held_blocks'], 0)
+        self.assertEqual(stats['active_blocks'], 1)
+        self.assertEqual(stats['active_bytes'], bin_size(x.nbytes))
+
+    def test_small_allocations_are_not_pooled(self):
+        # Given
+        pool = NumpyPool(min_bytes=1024)
+
+        # When
+        x = pool.empty(10, np.float64)
+
+        # Then
+        self.assertIsNone(x.base)
+        self.assertEqual(pool.get_stats()['misses'], 0)
+
+
+class TestWorkspace(unittest.TestCase):
+    def test_workspace_only_grows_when_needed(self):
+        # Given
+        stats = get_workspace_stats()
+        ws = Workspace()
+
+        # When
+        x = ws.get(1000)
+        y = ws.get(500)
+
+        # Then
+        self.assertIs(x, y)
+        self.assertEqual(ws.nbytes, bin_size(1000))
+        self.assertEqual(ws.get_stats(), dict(nbytes=bin_size(1000), grows=1))
+
+        # When
+        z = ws.get(2000)
+
+        # Then
+        self.assertIsNot(z, x)
+        self.assertEqual(ws.grows, 2)
+        self.assertEqual(ws.nbytes, bin_size(2000))
+        new_stats = get_workspace_stats()
+        self.assertEqual(new_stats['workspaces'], stats['workspaces'] + 1)
+        self.assertEqual(new_stats['nbytes'], stats['nbytes'] + ws.nbytes)
+
+        # When
+        ws.release()
+
+        # Then
+        self.assertEqual(ws.nbytes, 0)
+        self.assertEqual(len(ws.get(0)), 1)
+
+
+def _check_array_constructors_use_pool(backend):
+    # Given
+    n = 100000
+    pool = get_memory_pool(backend)
+    pool.trim()
+
+    # When
+    x = zeros(n, np.float64, backend=backend)
+    y = empty(n, np.float64, backend=backend)
+
+    # Then
+    assert np.all(x.get() == 0.0)
+    assert len(y) == n
+    stats = pool.get_stats()
+    assert stats['active_blocks'] >= 2
+
+    # When
+    del x, y
+    pool.trim()
+
+    # Then
+    assert pool.get_stats()['held_blocks'] == 0
+
+
+def test_array_constructors_use_pool_cython():
+    _check_array_constructors_use_pool('cython')
+
+
+def test_array_constructors_use_pool_opencl():
+    importorskip('pyopencl')
+    _check_array_constructors_use_pool('opencl')
+
+
+def test_array_constructors_use_pool_cuda():
+    importorskip('pycuda')
+    _check_array_constructors_use_pool('cuda')
+
+
+def test_pool_can_be_disabled():
+    # Given
+    pool = get_memory_pool('cython')
+    stats = pool.get_stats()
+
+    # When
+    with use_config(use_memory_pool=False):
+        x = empty(100000, np.float64, backend='cython')
+
+    # Then
+    assert len(x) == 100000
+    new_stats = pool.get_stats()
+    assert new_stats['hits'] == stats['hits']
+    assert new_stats['misses'] == stats['misses']
+
+    def test_workspace_in_use_is_not_shared(self):
+        # Given
+        ws = Workspace()
+
+        # When
+        with ws.use() as first:
+            with ws.use() as second:
+                pass
+        with ws.use() as third:
+            pass
+
+        # Then
+        self.assertIs(first, ws)
+        self.assertIsInstance(second, Workspace)
+        self.assertIsNot(second, ws)
+        self.assertIs(third, ws)
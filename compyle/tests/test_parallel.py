@@ -1,19 +1,43 @@
+import inspect
 from math import sin
+import shutil
+import tempfile
 import unittest
+from unittest import mock
 import numpy as np
 
 from pytest import importorskip
 
 from ..config import get_config, use_config
 from ..array import wrap, zeros
-from ..types import annotate, declare
-from ..parallel import Elementwise, Reduction, Scan
-from ..low_level import atomic_inc, atomic_dec
+from ..types import KnownType, annotate, declare, dtype_to_ctype
+from ..parallel import (Elementwise, Histogram, Reduction, Scan,
+                        SegmentedReduction, compile_all, fuse, fuse_functions,
+                        get_index_dtype, get_index_type, synchronize)
+from ..ext_module import build_all, build_bundles
+from ..low_level import (
+    atomic_inc, atomic_dec, atomic_add, atomic_min, atomic_max
+)
 from .test_jit import g
 
 MY_CONST = 42
 
 
+@annotate(i='int', doublep='x, y')
+def compile_all_axpb(i, x, y):
+    y[i] = 2.0*x[i] + 1.0
+
+
+@annotate(i='int', doublep='x, y')
+def bundle_axpb(i, x, y):
+    y[i] = 3.0*x[i] + 1.0
+
+
+@annotate(i='int', x='doublep', z='intp')
+def external_i(i, x, z):
+    z[i] = i
+
+
 @annotate(x='int', return_='int')
 def external(x):
     return x
@@ -33,6 +57,28 @@ class ParallelUtilsBase(object):
 
         self._check_simple_elementwise(backend='cuda')
 
+    def test_bound_elementwise_works_with_cython(self):
+        self._check_bound_elementwise(backend='cython')
+
+    def test_bound_elementwise_works_with_opencl(self):
+        importorskip('pyopencl')
+        self._check_bound_elementwise(backend='opencl')
+
+    def test_bound_elementwise_works_with_cuda(self):
+        importorskip('pycuda')
+        self._check_bound_elementwise(backend='cuda')
+
+    def test_fused_elementwise_works_with_cython(self):
+        self._check_fused_elementwise(backend='cython')
+
+    def test_fused_elementwise_works_with_opencl(self):
+        importorskip('pyopencl')
+        self._check_fused_elementwise(backend='opencl')
+
+    def test_fused_elementwise_works_with_cuda(self):
+        importorskip('pycuda')
+        self._check_fused_elementwise(backend='cuda')
+
     def test_elementwise_works_with_global_constant_cython(self):
         self._check_elementwise_with_constant(backend='cython')
 
@@ -50,6 +96,17 @@ class ParallelUtilsBase(object):
     def test_reduction_works_with_map_cython(self):
         self._check_reduction_with_map(backend='cython')
 
+    def test_reduction_works_with_fused_map_cython(self):
+        self._check_reduction_with_fused_map(backend='cython')
+
+    def test_reduction_works_with_fused_map_opencl(self):
+        importorskip('pyopencl')
+        self._check_reduction_with_fused_map(backend='opencl')
+
+    def test_reduction_works_with_fused_map_cuda(self):
+        importorskip('pycuda')
+        self._check_reduction_with_fused_map(backend='cuda')
+
     def test_reduction_works_with_external_func_cython(self):
         self._check_reduction_with_external_func(backend='cython')
 
@@ -88,6 +145,48 @@ class ParallelUtilsBase(object):
         importorskip('pycuda')
         self._check_reduction_min(backend='cuda')
 
+    def test_struct_reduction_cython(self):
+        self._check_struct_reduction(backend='cython')
+
+    def test_struct_reduction_cython_parallel(self):
+        with use_config(use_openmp=True):
+            self._check_struct_reduction(backend='cython')
+
+    def test_struct_reduction_opencl(self):
+        importorskip('pyopencl')
+        self._check_struct_reduction(backend='opencl')
+
+    def test_struct_reduction_cuda(self):
+        importorskip('pycuda')
+        self._check_struct_reduction(backend='cuda')
+
+    def test_minmax_reduction_cython(self):
+        self._check_minmax_reduction(backend='cython')
+
+    def test_minmax_reduction_opencl(self):
+        importorskip('pyopencl')
+        self._check_minmax_reduction(backend='opencl')
+
+    def test_minmax_reduction_cuda(self):
+        importorskip('pycuda')
+        self._check_minmax_reduction(backend='cuda')
+
+    def _check_minmax_reduction(self, backend):
+        # Given
+        x = np.random.uniform(-1, 1, 1000)
+        xa = wrap(x, backend=backend)
+
+        # When
+        r = Reduction(('min(a, b)', 'max(a, b)'),
+                      dtype_out=(np.float64, np.float64),
+                      neutral=('INFINITY', '-INFINITY'), backend=backend)
+        result = r(xa)
+
+        # Then
+        self.assertIsInstance(result, tuple)
+        self.assertAlmostEqual(result[0], x.min())
+        self.assertAlmostEqual(result[1], x.max())
+
     def test_scan_works_cython(self):
         self._test_scan(backend='cython')
 
@@ -206,6 +305,219 @@ class ParallelUtilsBase(object):
         importorskip('pycuda')
         self._test_atomic_dec(backend='cuda')
 
+    def test_atomic_add_min_max_cython(self):
+        self._test_atomic_add_min_max(backend='cython')
+
+    def test_atomic_add_min_max_cython_parallel(self):
+        with use_config(use_openmp=True):
+            self._test_atomic_add_min_max(backend='cython')
+
+    def test_atomic_add_min_max_opencl(self):
+        importorskip('pyopencl')
+        self._test_atomic_add_min_max(backend='opencl')
+
+    def test_atomic_add_min_max_cuda(self):
+        importorskip('pycuda')
+        self._test_atomic_add_min_max(backend='cuda')
+
+    def test_atomics_on_narrow_integers_cython_parallel(self):
+        # Given
+        n = wrap(np.ones(1000, dtype=np.int32), backend='cython')
+        dtypes = [np.int8, np.uint8, np.int16, np.uint16]
+
+        for dtype in dtypes:
+            ctype = dtype_to_ctype(dtype)
+            x = wrap(np.array([0, 0, 100, 5, 3], dtype=dtype),
+                     backend='cython')
+
+            @annotate(i='int', n='gintp',
+                      x=KnownType('GLOBAL_MEM %s*' % ctype, ctype))
+            def narrow_atomics(i, n, x):
+                atomic_inc(x[0])
+                atomic_add(x[1], n[i])
+                atomic_dec(x[2])
+                atomic_min(x[3], 1)
+                atomic_max(x[4], 7)
+
+            # When
+            with use_config(use_openmp=True):
+                Elementwise(narrow_atomics, backend='cython')(n, x)
+
+            # Then
+            expect = np.array([1000, 1000, 100 - 1000, 1, 7]).astype(dtype)
+            np.testing.assert_equal(x.get(), expect)
+
+    def test_histogram_cython(self):
+        self._test_histogram(backend='cython')
+
+    def test_histogram_cython_parallel(self):
+        with use_config(use_openmp=True):
+            self._test_histogram(backend='cython')
+
+    def test_histogram_opencl(self):
+        importorskip('pyopencl')
+        self._test_histogram(backend='opencl')
+
+    def test_histogram_cuda(self):
+        importorskip('pycuda')
+        self._test_histogram(backend='cuda')
+
+    def _check_histogram(self, keys, counts, ranks, backend):
+        expect = np.bincount(keys, minlength=len(counts))
+        np.testing.assert_equal(counts, expect)
+        # The position of each element in a counting sort must be unique.
+        starts = np.cumsum(expect) - expect
+        positions = starts[keys] + ranks
+        np.testing.assert_equal(np.sort(positions), np.arange(len(keys)))
+        if backend == 'cython':
+            # The ranks are in the order of the elements.
+            order = np.argsort(keys, kind='stable')
+            np.testing.assert_equal(positions[order], np.arange(len(keys)))
+
+    def test_segmented_reduction_cython(self):
+        self._test_segmented_reduction(backend='cython')
+
+    def test_segmented_reduction_cython_parallel(self):
+        with use_config(use_openmp=True):
+            self._test_segmented_reduction(backend='cython')
+
+    def test_segmented_reduction_opencl(self):
+        importorskip('pyopencl')
+        self._test_segmented_reduction(backend='opencl')
+
+    def test_segmented_reduction_cuda(self):
+        importorskip('pycuda')
+        self._test_segmented_reduction(backend='cuda')
+
+    def test_reduction_result_in_out_cython(self):
+        self._check_reduction_result_in_out(backend='cython')
+
+    def test_reduction_result_in_out_opencl(self):
+        importorskip('pyopencl')
+        self._check_reduction_result_in_out(backend='opencl')
+
+    def test_reduction_result_in_out_cuda(self):
+        importorskip('pycuda')
+        self._check_reduction_result_in_out(backend='cuda')
+
+    def test_reduction_evaluates_pending_expressions_cython(self):
+        self._check_reduction_evaluates_pending_expressions(backend='cython')
+
+    def test_reduction_evaluates_pending_expressions_opencl(self):
+        importorskip('pyopencl')
+        self._check_reduction_evaluates_pending_expressions(backend='opencl')
+
+    def test_reduction_evaluates_pending_expressions_cuda(self):
+        importorskip('pycuda')
+        self._check_reduction_evaluates_pending_expressions(backend='cuda')
+
+    def _check_reduction_result_in_out(self, backend):
+        # Given
+        x = np.arange(1000, dtype=np.int32)
+        xa = wrap(x, backend=backend)
+        results = zeros(2, dtype=np.int32, backend=backend)
+        r_sum = Reduction('a+b', dtype_out=np.int32, backend=backend)
+        r_max = Reduction('max(a, b)', dtype_out=np.int32, neutral='-1',
+                          backend=backend)
+
+        # When
+        out = r_sum(xa, out=results[:1])
+        r_max(xa, out=results[1:])
+
+        # Then
+        self.assertEqual(len(out), 1)
+        np.testing.assert_equal(results.get(), [x.sum(), x.max()])
+
+    def test_scan_aggregate_cython(self):
+        self._check_scan_aggregate(backend='cython')
+
+    def test_scan_aggregate_cython_parallel(self):
+        with use_config(use_openmp=True):
+            self._check_scan_aggregate(backend='cython')
+
+    def test_scan_aggregate_opencl(self):
+        importorskip('pyopencl')
+        self._check_scan_aggregate(backend='opencl')
+
+    def test_scan_aggregate_cuda(self):
+        importorskip('pycuda')
+        self._check_scan_aggregate(backend='cuda')
+
+    def _check_scan_aggregate(self, backend):
+        # Given
+        counts = np.random.randint(0, 10, 10000).astype(np.int32)
+        ca = wrap(counts, backend=backend)
+        starts = zeros(len(counts), dtype=np.int32, backend=backend)
+        total = zeros(1, dtype=np.int32, backend=backend)
+
+        @annotate(i='int', counts='intp', return_='int')
+        def input_counts(i, counts):
+            return counts[i]
+
+        @annotate(int='i, prev_item', starts='intp')
+        def output_starts(i, prev_item, starts):
+            starts[i] = prev_item
+
+        scan = Scan(input_counts, output_starts, 'a+b', dtype=np.int32,
+                    backend=backend)
+
+        # When
+        scan(counts=ca, starts=starts, aggregate=total)
+
+        # Then
+        expect = np.cumsum(counts)
+        np.testing.assert_equal(starts.get(), expect - counts)
+        self.assertEqual(total.get()[0], expect[-1])
+
+    def test_scan_workspace_is_reused_cython_parallel(self):
+        with use_config(use_openmp=True):
+            self._check_scan_workspace_is_reused(backend='cython')
+
+    def _check_scan_workspace_is_reused(self, backend):
+        # Given
+        @annotate(i='int', ary='intp', return_='int')
+        def input_ws(i, ary):
+            return ary[i]
+
+        @annotate(i='int', seg_flag='intp', return_='int')
+        def segment_ws(i, seg_flag):
+            return seg_flag[i]
+
+        @annotate(int='i, item', ary='intp')
+        def output_ws(i, item, ary):
+            ary[i] = item
+
+        scan = Scan(input_ws, output_ws, 'a+b', dtype=np.int32,
+                    is_segment=segment_ws, complex_map=True, backend=backend)
+        r = Reduction('a+b', dtype_out=np.int32, backend=backend)
+
+        for n, grows in ((20000, 1), (10000, 1), (40000, 2)):
+            a = np.random.randint(0, 100, n, dtype=np.int32)
+            seg = (np.random.randint(0, 100, n) == 0).astype(np.int32)
+            expect = self._get_segmented_scan_actual(a.copy(), seg)
+            ary, seg_flag = wrap(a, seg, backend=backend)
+
+            # When
+            scan(ary=ary, seg_flag=seg_flag)
+            result = r(ary)
+
+            # Then
+            np.testing.assert_equal(ary.get(), expect)
+            self.assertEqual(result, expect.sum())
+            self.assertEqual(scan.workspace.grows, grows)
+            self.assertEqual(r.workspace.grows, 1)
+            self.assertTrue(scan.workspace.nbytes >= 4*(2*n))
+
+    def _make_segments(self):
+        # Empty segments and one segment much longer than the others so that
+        # the segments are shared between the threads.
+        lengths = np.random.randint(0, 10, 100)
+        lengths[[0, 5, 6, 7, 99]] = 0
+        lengths[50] = 5000
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int32)
+        offsets[1:] = np.cumsum(lengths)
+        return offsets
+
     def test_repeated_scans_with_different_settings(self):
         importorskip('pyopencl')
         with use_config(use_double=False):
@@ -230,6 +542,72 @@ class TestParallelUtils(ParallelUtilsBase, unittest.TestCase):
     def tearDown(self):
         get_config().use_double = self._use_double
 
+    def _check_bound_elementwise(self, backend):
+        # Given
+        @annotate(i='int', doublep='x, y', a='double')
+        def axpy(i, x, y, a):
+            y[i] += a*x[i]
+
+        x = np.linspace(0, 1, 100)
+        y = np.zeros_like(x)
+        x, y = wrap(x, y, backend=backend)
+        e = Elementwise(axpy, backend=backend)
+
+        # When
+        step = e.bind(x, y, 2.0)
+        step()
+        step()
+
+        # Then
+        y.pull()
+        self.assertTrue(np.allclose(y.data, 4.0*x.data))
+
+        # When
+        x.resize(200)
+        y.resize(200)
+        y.fill(0.0)
+        x.fill(1.0)
+        step()
+
+        # Then
+        result = y.get()
+        self.assertEqual(len(result), 200)
+        self.assertTrue(np.allclose(result, 2.0))
+
+    def _check_fused_elementwise(self, backend):
+        # Given
+        @annotate(i='int', doublep='v, f', dt='double')
+        def update_v(i, v, f, dt):
+            v[i] += f[i]*dt
+
+        @annotate(i='int', doublep='x, v', dt='double')
+        def update_x(i, x, v, dt):
+            x[i] += v[i]*dt
+
+        @annotate(i='int', f='doublep')
+        def reset_f(i, f):
+            f[i] = 0.0
+
+        x = np.linspace(0, 1, 1000)
+        v = np.ones_like(x)
+        f = np.linspace(1, 2, 1000)
+        dt = 0.1
+        expect_v = v + f*dt
+        expect_x = x + expect_v*dt
+        x, v, f = wrap(x, v, f, backend=backend)
+
+        # When
+        e = fuse([update_v, update_x, reset_f], backend=backend)
+        e(v, f, dt, x)
+
+        # Then
+        x.pull()
+        v.pull()
+        f.pull()
+        self.assertTrue(np.allclose(v.data, expect_v))
+        self.assertTrue(np.allclose(x.data, expect_x))
+        self.assertTrue(np.allclose(f.data, 0.0))
+
     def _check_simple_elementwise(self, backend):
         # Given
         @annotate(i='int', x='doublep', y='doublep', double='a,b')
@@ -314,6 +692,56 @@ class TestParallelUtils(ParallelUtilsBase, unittest.TestCase):
         # Then
         self.assertAlmostEqual(result, 0.5, 6)
 
+    def _check_reduction_with_fused_map(self, backend):
+        # Given
+        x = np.linspace(0, 1, 1000)
+        err = np.zeros_like(x)
+        x, err = wrap(x, err, backend=backend)
+
+        @annotate(i='int', doublep='x, err')
+        def step(i, x, err):
+            err[i] = 2.0*x[i] - x[i]
+            x[i] = 2.0*x[i]
+
+        @annotate(i='int', err='doublep', return_='double')
+        def error(i, err):
+            return abs(err[i])
+
+        # When
+        r = Reduction('a+b', map_func=[step, error], backend=backend)
+        result = r(x, err)
+
+        # Then
+        x.pull()
+        err.pull()
+        expect = np.linspace(0, 1, 1000)
+        self.assertAlmostEqual(result, expect.sum(), 6)
+        self.assertTrue(np.allclose(err.data, expect))
+        self.assertTrue(np.allclose(x.data, 2.0*expect))
+
+    def _check_reduction_evaluates_pending_expressions(self, backend):
+        # Given
+        x = wrap(np.arange(5.0), backend=backend)
+        res = wrap(np.ones(1), backend=backend)
+        c = x + 1.0
+        d = res * 3.0
+
+        @annotate(i='int', x='doublep', return_='double')
+        def clear(i, x):
+            x[i] = 0
+            return 1.0
+
+        r = Reduction('a+b', map_func=clear, backend=backend)
+
+        # When
+        r(x, out=res)
+
+        # Then
+        np.testing.assert_allclose(c.get(), np.arange(5.0) + 1.0)
+        np.testing.assert_allclose(d.get(), [3.0])
+        np.testing.assert_allclose(x.get(), np.zeros(5))
+        np.testing.assert_allclose(res.get(), [5.0])
+
     def _check_reduction_with_external_func(self, backend):
         # Given
         x = np.arange(1000, dtype=np.int32)
@@ -330,6 +758,35 @@ class TestParallelUtils(ParallelUtilsBase, unittest.TestCase):
         # Then
         self.assertAlmostEqual(result, 499500)
 
+    def _check_struct_reduction(self, backend):
+        # Given
+        x = np.random.uniform(-1, 1, 10000)
+        xa = wrap(x, backend=backend)
+
+        @annotate(i='int', x='doublep', return_='double')
+        def value(i, x):
+            return x[i]
+
+        @annotate(i='int', x='doublep', return_='int')
+        def index(i, x):
+            return i
+
+        dtype = np.dtype([('lo', np.float64), ('arg', np.int32),
+                          ('total', np.float64)])
+
+        # When
+        r = Reduction(
+            ('min(a, b)', 'a if a_lo <= b_lo else b', 'a + b'),
+            map_func=(value, index, value), dtype_out=dtype,
+            neutral=('INFINITY', '-1', '0'), backend=backend
+        )
+        result = r(xa)
+
+        # Then
+        self.assertAlmostEqual(result['lo'], x.min())
+        self.assertEqual(result['arg'], np.argmin(x))
+        self.assertAlmostEqual(result['total'], x.sum(), 8)
+
     def _test_scan(self, backend):
         # Given
         a = np.arange(10000, dtype=np.int32)
@@ -554,6 +1011,96 @@ class TestParallelUtils(ParallelUtilsBase, unittest.TestCase):
         # Then
         self.assertTrue(result[0] == -50000)
 
+    def _test_atomic_add_min_max(self, backend):
+        # Given
+        x = np.random.randint(0, 100, 50000).astype(np.float32)
+        n = np.random.randint(-100, 100, 50000).astype(np.int32)
+        xa, na = wrap(x, n, backend=backend)
+        xr = wrap(np.array([0.0, 1000.0, -1.0], dtype=np.float32),
+                  backend=backend)
+        nr = wrap(np.array([0, 1000, -1000], dtype=np.int32), backend=backend)
+
+        @annotate(i='int', gfloatp='x, xr', gintp='n, nr')
+        def atomics_knl(i, x, n, xr, nr):
+            atomic_add(xr[0], x[i])
+            atomic_min(xr[1], x[i])
+            atomic_max(xr[2], x[i])
+            atomic_add(nr[0], n[i])
+            atomic_min(nr[1], n[i])
+            atomic_max(nr[2], n[i])
+
+        # When
+        knl = Elementwise(atomics_knl, backend=backend)
+        knl(xa, na, xr, nr)
+
+        # Then
+        np.testing.assert_equal(xr.get(), [x.sum(), x.min(), x.max()])
+        np.testing.assert_equal(nr.get(), [n.sum(), n.min(), n.max()])
+
+    def _test_histogram(self, backend):
+        # Given
+        keys = np.random.randint(0, 50, 20000).astype(np.int32)
+        ka = wrap(keys, backend=backend)
+        ranks = zeros(len(keys), dtype=np.int32, backend=backend)
+
+        @annotate(i='int', keys='gintp', shift='int', return_='int')
+        def get_key(i, keys, shift):
+            return keys[i] + shift
+
+        # When
+        hist = Histogram(get_key, n_bins=50, backend=backend)
+        counts = hist(ka, 0, ranks=ranks)
+
+        # Then
+        self._check_histogram(keys, counts.get(), ranks.get(), backend)
+
+        # When
+        counts = hist(ka, 1, n_bins=51)
+
+        # Then
+        self.assertEqual(len(counts), 51)
+        self.assertEqual(counts.get()[0], 0)
+        np.testing.assert_equal(counts.get()[1:],
+                                np.bincount(keys, minlength=50))
+
+        # When
+        # Keys outside the bins are counted in the first or last bin.
+        counts = hist(ka, -25, n_bins=50, ranks=ranks)
+
+        # Then
+        clipped = np.clip(keys - 25, 0, 49)
+        self._check_histogram(clipped, counts.get(), ranks.get(), backend)
+
+    def _test_segmented_reduction(self, backend):
+        # Given
+        offsets = self._make_segments()
+        x = np.random.uniform(-1, 1, offsets[-1])
+        xa, oa = wrap(x, offsets, backend=backend)
+
+        @annotate(i='int', x='doublep', return_='double')
+        def sq(i, x):
+            return x[i]*x[i]
+
+        # When
+        r = SegmentedReduction('a+b', sq, backend=backend)
+        result = r(xa, offsets=oa)
+
+        # Then
+        expect = [np.sum(x[s:e]**2) for s, e in zip(offsets, offsets[1:])]
+        np.testing.assert_allclose(result.get(), expect)
+
+        # When
+        r = SegmentedReduction('max(a, b)', neutral='-INFINITY',
+                               backend=backend)
+        out = zeros(len(offsets) - 1, dtype=np.float64, backend=backend)
+        result = r(xa, offsets=oa, out=out)
+
+        # Then
+        self.assertIs(result, out)
+        expect = [np.max(x[s:e], initial=-np.inf)
+                  for s, e in zip(offsets, offsets[1:])]
+        np.testing.assert_allclose(out.get(), expect)
+
 
 class TestParallelUtilsJIT(ParallelUtilsBase, unittest.TestCase):
     def setUp(self):
@@ -564,6 +1111,72 @@ class TestParallelUtilsJIT(ParallelUtilsBase, unittest.TestCase):
     def tearDown(self):
         get_config().use_double = self._use_double
 
+    def _check_bound_elementwise(self, backend):
+        # Given
+        @annotate
+        def axpy(i, x, y, a):
+            y[i] += a*x[i]
+
+        x = np.linspace(0, 1, 100)
+        y = np.zeros_like(x)
+        x, y = wrap(x, y, backend=backend)
+        e = Elementwise(axpy, backend=backend)
+
+        # When
+        step = e.bind(x, y, 2.0)
+        step()
+        step()
+
+        # Then
+        y.pull()
+        self.assertTrue(np.allclose(y.data, 4.0*x.data))
+
+        # When
+        x.resize(200)
+        y.resize(200)
+        y.fill(0.0)
+        x.fill(1.0)
+        step()
+
+        # Then
+        result = y.get()
+        self.assertEqual(len(result), 200)
+        self.assertTrue(np.allclose(result, 2.0))
+
+    def _check_fused_elementwise(self, backend):
+        # Given
+        @annotate
+        def update_v(i, v, f, dt):
+            v[i] += f[i]*dt
+
+        @annotate
+        def update_x(i, x, v, dt):
+            x[i] += v[i]*dt
+
+        @annotate
+        def reset_f(i, f):
+            f[i] = 0.0
+
+        x = np.linspace(0, 1, 1000)
+        v = np.ones_like(x)
+        f = np.linspace(1, 2, 1000)
+        dt = 0.1
+        expect_v = v + f*dt
+        expect_x = x + expect_v*dt
+        x, v, f = wrap(x, v, f, backend=backend)
+
+        # When
+        e = fuse([update_v, update_x, reset_f], backend=backend)
+        e(v, f, dt, x)
+
+        # Then
+        x.pull()
+        v.pull()
+        f.pull()
+        self.assertTrue(np.allclose(v.data, expect_v))
+        self.assertTrue(np.allclose(x.data, expect_x))
+        self.assertTrue(np.allclose(f.data, 0.0))
+
     def _check_simple_elementwise(self, backend):
         # Given
         @annotate
@@ -651,6 +1264,79 @@ class TestParallelUtilsJIT(ParallelUtilsBase, unittest.TestCase):
         # Then
         self.assertAlmostEqual(result, 0.5, 6)
 
+    def _check_reduction_with_fused_map(self, backend):
+        # Given
+        x = np.linspace(0, 1, 1000)
+        err = np.zeros_like(x)
+        x, err = wrap(x, err, backend=backend)
+
+        @annotate
+        def step(i, x, err):
+            err[i] = 2.0*x[i] - x[i]
+            x[i] = 2.0*x[i]
+
+        @annotate
+        def error(i, err):
+            return abs(err[i])
+
+        # When
+        r = Reduction('a+b', map_func=[step, error], backend=backend)
+        result = r(x, err)
+
+        # Then
+        x.pull()
+        err.pull()
+        expect = np.linspace(0, 1, 1000)
+        self.assertAlmostEqual(result, expect.sum(), 6)
+        self.assertTrue(np.allclose(err.data, expect))
+        self.assertTrue(np.allclose(x.data, 2.0*expect))
+
+    def _check_reduction_evaluates_pending_expressions(self, backend):
+        # Given
+        x = wrap(np.arange(5.0), backend=backend)
+        res = wrap(np.ones(1), backend=backend)
+        c = x + 1.0
+        d = res * 3.0
+
+        @annotate
+        def clear(i, x):
+            x[i] = 0
+            return 1.0
+
+        r = Reduction('a+b', map_func=clear, backend=backend)
+
+        # When
+        r(x, out=res)
+
+        # Then
+        np.testing.assert_allclose(c.get(), np.arange(5.0) + 1.0)
+        np.testing.assert_allclose(d.get(), [3.0])
+        np.testing.assert_allclose(x.get(), np.zeros(5))
+        np.testing.assert_allclose(res.get(), [5.0])
+
+    def _check_struct_reduction(self, backend):
+        # Given
+        x = np.random.randint(-100, 100, 10000).astype(np.int32)
+        xa = wrap(x, backend=backend)
+
+        @annotate
+        def value(i, x):
+            return x[i]
+
+        @annotate
+        def one(i, x):
+            return 1
+
+        # When
+        r = Reduction(('a + b', 'a + b', 'max(a, b)'),
+                      map_func=(value, one, value),
+                      dtype_out=(np.int64, np.int32, np.int32),
+                      neutral=('0', '0', '-1000'), backend=backend)
+        result = r(xa)
+
+        # Then
+        self.assertEqual(result, (x.sum(), len(x), x.max()))
+
     def _check_reduction_with_external_func(self, backend):
         # Given
         x = np.arange(1000, dtype=np.int32)
@@ -888,3 +1574,291 @@ class TestParallelUtilsJIT(ParallelUtilsBase, unittest.TestCase):
 
         # Then
         self.assertTrue(result[0] == -50000)
+
+    def _test_atomic_add_min_max(self, backend):
+        # Given
+        x = np.random.randint(0, 100, 50000).astype(np.float32)
+        n = np.random.randint(-100, 100, 50000).astype(np.int32)
+        xa, na = wrap(x, n, backend=backend)
+        xr = wrap(np.array([0.0, 1000.0, -1.0], dtype=np.float32),
+                  backend=backend)
+        nr = wrap(np.array([0, 1000, -1000], dtype=np.int32), backend=backend)
+
+        @annotate
+        def atomics_knl(i, x, n, xr, nr):
+            atomic_add(xr[0], x[i])
+            atomic_min(xr[1], x[i])
+            atomic_max(xr[2], x[i])
+            atomic_add(nr[0], n[i])
+            atomic_min(nr[1], n[i])
+            atomic_max(nr[2], n[i])
+
+        # When
+        knl = Elementwise(atomics_knl, backend=backend)
+        knl(xa, na, xr, nr)
+
+        # Then
+        np.testing.assert_equal(xr.get(), [x.sum(), x.min(), x.max()])
+        np.testing.assert_equal(nr.get(), [n.sum(), n.min(), n.max()])
+
+    def _test_histogram(self, backend):
+        # Given
+        keys = np.random.randint(0, 50, 20000).astype(np.int32)
+        ka = wrap(keys, backend=backend)
+        ranks = zeros(len(keys), dtype=np.int32, backend=backend)
+        counts = zeros(50, dtype=np.int32, backend=backend)
+
+        @annotate
+        def get_key(i, keys):
+            return keys[i]
+
+        # When
+        hist = Histogram(get_key, backend=backend)
+        result = hist(ka, counts=counts, ranks=ranks)
+
+        # Then
+        self.assertIs(result, counts)
+        self._check_histogram(keys, counts.get(), ranks.get(), backend)
+
+    def _test_segmented_reduction(self, backend):
+        # Given
+        offsets = self._make_segments()
+        x = np.random.randint(-100, 100, offsets[-1]).astype(np.int32)
+        xa, oa = wrap(x, offsets, backend=backend)
+
+        @annotate
+        def shifted(i, x, shift):
+            return x[i] + shift
+
+        # When
+        r = SegmentedReduction('min(a, b)', shifted, dtype_out=np.int32,
+                               neutral='1000', backend=backend)
+        result = r(xa, 2, offsets=oa)
+
+        # Then
+        expect = [np.min(x[s:e] + 2, initial=1000)
+                  for s, e in zip(offsets, offsets[1:])]
+        np.testing.assert_equal(result.get(), expect)
+
+
+class TestAsyncLaunch(unittest.TestCase):
+    def _check_async_elementwise(self, backend):
+        # Given
+        x = np.linspace(0, 1, 1000)
+        y = np.zeros_like(x)
+        x, y = wrap(x, y, backend=backend)
+
+        @annotate(i='int', doublep='x, y')
+        def axpb(i, x, y):
+            y[i] = 2.0*x[i] + 1.0
+
+        e = Elementwise(axpb, backend=backend)
+
+        # When
+        with use_config(async_launch=True):
+            event = e(x, y)
+            events = [event, e(x, y, async_launch=False)]
+        synchronize(backend)
+
+        # Then
+        self.assertIsNone(events[1])
+        np.testing.assert_array_almost_equal(y.get(), 2.0*x.get() + 1.0)
+        return event
+
+    def test_async_elementwise_cython(self):
+        event = self._check_async_elementwise('cython')
+        self.assertIsNone(event)
+
+    def test_async_elementwise_opencl(self):
+        cl = importorskip('pyopencl')
+        event = self._check_async_elementwise('opencl')
+        self.assertIsInstance(event, cl.Event)
+
+    def test_async_elementwise_cuda(self):
+        drv = importorskip('pycuda.driver')
+        event = self._check_async_elementwise('cuda')
+        self.assertIsInstance(event, drv.Event)
+
+
+class TestIndexType(unittest.TestCase):
+    def setUp(self):
+        cfg = get_config()
+        self._use_double = cfg.use_double
+        cfg.use_double = True
+
+    def tearDown(self):
+        get_config().use_double = self._use_double
+
+    def test_index_type_depends_on_size(self):
+        # When/Then
+        self.assertEqual(get_index_type(100), 'int')
+        self.assertEqual(get_index_type(2**31 - 1), 'int')
+        self.assertEqual(get_index_type(2**31), 'long')
+        self.assertEqual(get_index_dtype(2**31), np.int64)
+        with use_config(index_type='long'):
+            self.assertEqual(get_index_type(100), 'long')
+        with use_config(index_type='int'):
+            self.assertEqual(get_index_type(2**31), 'int')
+
+    def _check_long_index(self, backend):
+        # Given
+        x = np.linspace(0, 1, 1000)
+        y = np.zeros_like(x)
+        z = np.zeros_like(x)
+        x, y, z = wrap(x, y, z, backend=backend)
+
+        @annotate(i='int', doublep='x, y')
+        def axpb(i, x, y):
+            y[i] = 2.0*x[i] + i
+
+        @annotate
+        def ident(i, x):
+            return x[i]
+
+        @annotate(i='int', ary='gdoublep', return_='double')
+        def inp(i, ary):
+            return ary[i]
+
+        @annotate(int='i, N', item='double', res='gdoublep')
+        def out(i, N, item, res):
+            res[N - i - 1] = item
+
+        e = Elementwise(axpb, backend=backend)
+        r = Reduction('a+b', map_func=ident, backend=backend)
+        s = Scan(inp, out, 'a+b', dtype=np.float64, backend=backend)
+        e(x, y)
+        expect = 2.0*x.get() + np.arange(1000)
+
+        # When
+        cfg = get_config()
+        cfg.index_type = 'long'
+        try:
+            y.fill(0.0)
+            e(x, y)
+            total = r(y)
+            s(ary=y, res=z)
+        finally:
+            cfg.index_type = None
+
+        # Then
+        self.assertEqual(e.elementwise.index_type, 'int')
+        self.assertEqual(list(e.elementwise._index_variants), ['long'])
+        self.assertAlmostEqual(total, expect.sum())
+        np.testing.assert_array_almost_equal(y.get(), expect)
+        np.testing.assert_array_almost_equal(
+            z.get(), np.cumsum(expect)[::-1]
+        )
+        if backend == 'cython':
+            variant = e.elementwise._index_variants['long']
+            self.assertIn('cdef long i', variant.all_source)
+            self.assertIn('axpb(long i', variant.all_source)
+
+    def test_long_index_cython(self):
+        self._check_long_index('cython')
+
+    def test_long_index_cython_parallel(self):
+        with use_config(use_openmp=True):
+            self._check_long_index('cython')
+
+    def test_long_index_opencl(self):
+        importorskip('pyopencl')
+        self._check_long_index('opencl')
+
+    def test_long_index_cuda(self):
+        importorskip('pycuda')
+        self._check_long_index('cuda')
+
+
+class TestFuse(unittest.TestCase):
+    def test_fuse_functions_merges_arguments(self):
+        # When
+        func = fuse_functions([compile_all_axpb, bundle_axpb, external_i])
+
+        # Then
+        self.assertEqual(func.__name__,
+                         'fused_compile_all_axpb_bundle_axpb_external_i')
+        self.assertEqual(inspect.getfullargspec(func).args,
+                         ['i', 'x', 'y', 'z'])
+        self.assertEqual(func.__annotations__['z'].type, 'int*')
+        self.assertFalse(func.is_jit)
+
+    def test_fuse_functions_raises_on_type_mismatch(self):
+        # Given
+        @annotate(i='int', x='intp')
+        def bad(i, x):
+            x[i] = 0
+
+        # When/Then
+        self.assertRaises(ValueError, fuse_functions, [bundle_axpb, bad])
+
+
+class TestCompileAll(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_compile_all_builds_pending_kernels_together(self):
+        # Given
+        x = wrap(np.arange(10, dtype=np.float64), backend='cython')
+        y = wrap(np.zeros(10), backend='cython')
+        e = Elementwise(compile_all_axpb, backend='cython')
+        r = Reduction('a+b', backend='cython')
+
+        # When
+        with use_config(use_kernel_index=False), \
+                mock.patch('compyle.ext_module.get_default_root',
+                           return_value=self.root), \
+                mock.patch('compyle.parallel.build_all',
+                           wraps=build_all) as m:
+            compile_all([(e, (x, y)), r], n_jobs=2)
+
+        # Then
+        self.assertEqual(m.call_count, 1)
+        self.assertEqual(len(m.call_args[0][0]), 2)
+        e(x, y)
+        np.testing.assert_array_almost_equal(y.get(), 2.0*x.get() + 1.0)
+        self.assertEqual(r(x), 45.0)
+
+    def test_compile_all_does_not_rebuild_existing_kernels(self):
+        # Given
+        r = Reduction('a+b', backend='cython')
+        r1 = Reduction('a+b', backend='cython')
+        with use_config(use_kernel_index=False), \
+                mock.patch('compyle.ext_module.get_default_root',
+                           return_value=self.root):
+            compile_all([r])
+
+            # When
+            with mock.patch('compyle.parallel.build_all') as m:
+                compile_all([r1])
+
+        # Then
+        self.assertEqual(m.call_count, 0)
+        self.assertIsNotNone(r1.reduction)
+
+    def test_compile_all_bundles_kernels(self):
+        # Given
+        x = wrap(np.arange(10, dtype=np.float64), backend='cython')
+        y = wrap(np.zeros(10), backend='cython')
+        e = Elementwise(bundle_axpb, backend='cython')
+        r = Reduction('a+b', backend='cython')
+
+        # When
+        with use_config(use_kernel_index=False), \
+                mock.patch('compyle.ext_module.get_default_root',
+                           return_value=self.root), \
+                mock.patch('compyle.parallel.build_bundles',
+                           wraps=build_bundles) as m:
+            compile_all([(e, (x, y)), r], bundle=True)
+
+        # Then
+        self.assertEqual(m.call_count, 1)
+        self.assertIs(e.elementwise.tp.mod, r.reduction.tp.mod)
+        e(x, y)
+        np.testing.assert_array_almost_equal(y.get(), 3.0*x.get() + 1.0)
+        self.assertEqual(r(x), 45.0)
+
+    def test_compile_all_raises_for_unknown_objects(self):
+        self.assertRaises(TypeError, compile_all, [object()])
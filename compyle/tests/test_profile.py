@@ -1,13 +1,24 @@
+import json
+import os
+import shutil
+import tempfile
 import unittest
 import numpy as np
 
-from pytest import importorskip
+from pytest import importorskip, raises
 
 from ..config import get_config, use_config
 from ..array import wrap, zeros, ones
 from ..profile import (
-    get_profile_info, named_profile, profile, profile_ctx, ProfileContext
+    build_phase, build_record, exclude_from_profile, get_build_records,
+    get_device_profile_info,
+    get_peak_bandwidth, get_profile_info, get_throughput_info,
+    measure_bandwidth, named_profile, print_build_summary, profile,
+    profile_ctx, ProfileContext, record_device_event, record_throughput,
+    TraceBuffer, start_trace, stop_trace, update_build_record,
+    _device_profile_info
 )
+from ..types import annotate
 
 
 def axpb():
@@ -67,23 +78,50 @@ def test_profile_ctx():
 
 
 def test_profile():
-    for i in range(100):
-        profiled_axpb()
+    with use_config(profile=True):
+        for i in range(100):
+            profiled_axpb()
 
     profile_info = get_profile_info()
     assert profile_info[0]['profiled_axpb']['calls'] == 100
 
 
+def test_profile_is_off_by_default():
+    # Given
+    @profile
+    def not_profiled():
+        return 1
+
+    # When
+    result = not_profiled()
+
+    # Then
+    assert result == 1
+    name = not_profiled.__qualname__
+    assert name not in get_profile_info()[0]
+
+    # When
+    with use_config(profile=True):
+        not_profiled()
+    not_profiled()
+
+    # Then
+    info = get_profile_info()[0]
+    assert info[name]['calls'] == 1
+    assert info[name]['time'] > 0.0
+
+
 def test_profile_method():
     # Given
     a = A()
     b = B()
 
     # When
-    for i in range(5):
-        a.f()
-        b.f()
-        b.named()
+    with use_config(profile=True):
+        for i in range(5):
+            a.f()
+            b.f()
+            b.named()
 
     # Then
     profile_info = get_profile_info()
@@ -109,9 +147,10 @@ def test_named_profile():
 
 def test_nesting_and_context():
     # When
-    p = ProfileContext('main')
-    nested()
-    p.stop()
+    with use_config(profile=True):
+        p = ProfileContext('main')
+        nested()
+        p.stop()
 
     # Then
     prof = get_profile_info()
@@ -119,3 +158,325 @@ def test_nesting_and_context():
     assert prof[0]['main']['calls'] == 1
     assert prof[1]['nested']['calls'] == 1
     assert prof[2]['profiled_axpb']['calls'] == 1
+
+
+def test_trace_records_regions_with_sizes():
+    # Given
+    x = zeros(1000, np.float64, backend='cython')
+
+    @profile
+    def traced(x, n=1):
+        profiled_axpb()
+
+    # When
+    with use_config(profile=True):
+        trace = start_trace()
+        traced(x)
+        traced(x=x[:10])
+        stop_trace()
+    traced(x)
+
+    # Then
+    events = trace.get_events()
+    assert len(events) == 4
+    names = [e[0] for e in events]
+    assert names[0] == 'profiled_axpb'
+    assert names[1] == traced.__qualname__
+    name, cat, start, end, tid, level, size, backend = events[1]
+    assert cat == 'call'
+    assert start <= events[0][2] <= events[0][3] <= end
+    assert level == 0 and events[0][5] == 1
+    assert size == 1000 and backend == 'cython'
+    assert events[3][6] == 10
+
+    # When
+    data = trace.to_chrome_trace()
+
+    # Then
+    assert len(data['traceEvents']) == 4
+    ev = data['traceEvents'][1]
+    assert ev['ph'] == 'X'
+    assert ev['dur'] == (end - start)*1e-3
+    assert ev['args']['size'] == 1000
+
+
+def test_trace_is_a_ring_buffer():
+    # Given
+    trace = TraceBuffer(capacity=3)
+
+    # When
+    for i in range(5):
+        trace.add('f%d' % i, 'call', i, i + 1)
+
+    # Then
+    assert len(trace) == 3
+    assert trace.dropped == 2
+    assert [e[0] for e in trace.get_events()] == ['f2', 'f3', 'f4']
+
+    # When
+    fname = os.path.join(tempfile.mkdtemp(), 'trace.json')
+    try:
+        trace.save(fname)
+        with open(fname) as f:
+            data = json.load(f)
+    finally:
+        shutil.rmtree(os.path.dirname(fname))
+
+    # Then
+    assert [e['name'] for e in data['traceEvents']] == ['f2', 'f3', 'f4']
+    assert data['otherData']['dropped'] == 2
+
+
+def test_record_throughput():
+    # Given
+    x = np.ones(100)
+    y = np.ones(50, dtype=np.float32)
+    args = [('x', x), ('y', y), ('a', 2.0), ('n', np.int32(5))]
+
+    # When
+    record_throughput('fake_stream', args, {'x': 2}, backend='cython')
+    with profile_ctx('fake_stream'):
+        pass
+
+    # Then
+    info = get_throughput_info()['fake_stream']
+    assert info['calls'] == 1
+    assert info['elements'] == 100
+    assert info['bytes'] == 100*8*2 + 50*4
+    assert info['time'] > 0.0
+    assert np.isclose(info['bandwidth'], 1800/info['time']*1e-9)
+
+
+@annotate(i='int', x='doublep', y='doublep')
+def axpy_traffic(i, x, y):
+    y[i] += 2.0*x[i]
+
+
+def test_kernel_throughput_is_recorded_when_profiling():
+    from ..parallel import Elementwise
+
+    # Given
+    n = 1000
+    x, y = wrap(np.ones(n), np.zeros(n), backend='cython')
+    e = Elementwise(axpy_traffic, backend='cython')
+
+    # When
+    e(x, y)
+
+    # Then
+    assert 'elwise_axpy_traffic' not in get_throughput_info()
+
+    # When
+    with use_config(profile=True):
+        e(x, y)
+        e(x, y)
+
+    # Then
+    info = get_throughput_info()['elwise_axpy_traffic']
+    assert info['calls'] == 2
+    assert info['elements'] == 2*n
+    # x is read and y is read and written.
+    assert info['bytes'] == 2*3*n*8
+    assert info['elements_per_sec'] > 0.0
+
+
+def test_traffic_bookkeeping_is_not_timed():
+    from ..parallel import Elementwise
+
+    # Given
+    @profile(name='with_bookkeeping')
+    def f():
+        with profile_ctx('inner_bookkeeping'):
+            exclude_from_profile(10**9)
+
+    x, y = wrap(np.ones(10), np.zeros(10), backend='cython')
+    e = Elementwise(axpy_traffic, backend='cython')
+
+    # When
+    with use_config(profile=True):
+        f()
+        e(x, y)
+
+    # Then
+    info = get_profile_info()
+    assert info[0]['with_bookkeeping']['time'] < 0.5
+    assert info[1]['inner_bookkeeping']['time'] < 0.5
+    # The traffic is prepared when the kernel is built.
+    assert e.elementwise._traffic_info == (['x', 'y'], {'x': 1, 'y': 2})
+
+def test_measure_bandwidth():
+    # When
+    result = measure_bandwidth('cython', n=1000, repeat=2)
+
+    # Then
+    assert sorted(result) == ['add', 'copy', 'scale', 'triad']
+    assert all(v > 0.0 for v in result.values())
+    assert get_peak_bandwidth('cython') == max(result.values())
+
+
+class FakeKernel(object):
+    name = 'fake_kernel'
+    backend = 'cython'
+
+
+@build_phase('transpile')
+def _transpile(depth):
+    if depth > 0:
+        _transpile(depth - 1)
+
+
+def test_build_records_phases_and_cache():
+    # Given
+    n_records = len(get_build_records())
+
+    # When
+    with build_record(FakeKernel()) as record:
+        _transpile(3)
+        with build_record() as inner:
+            update_build_record(cache='miss', source_hash='abc')
+            with build_phase('c_compile'):
+                pass
+
+    # Then
+    records = get_build_records()
+    assert len(records) == n_records + 1
+    assert records[-1] is record
+    assert inner is record
+    assert record['name'] == 'fake_kernel'
+    assert record['kind'] == 'FakeKernel'
+    assert record['backend'] == 'cython'
+    assert record['cache'] == 'miss'
+    assert record['source_hash'] == 'abc'
+    assert sorted(record['phases']) == ['c_compile', 'transpile']
+    assert sum(record['phases'].values()) <= record['time']
+
+    # When
+    _transpile(1)
+    update_build_record(cache='hit')
+
+    # Then
+    assert len(get_build_records()) == n_records + 1
+    assert record['cache'] == 'miss'
+    print_build_summary([record])
+
+
+class FakeProfile(object):
+    def __init__(self, queued, submit, start, end):
+        self.queued, self.submit = queued, submit
+        self.start, self.end = start, end
+
+
+class FakeEvent(object):
+    def __init__(self, *times, fail=False):
+        self.profile = FakeProfile(*times)
+        self.waited = False
+        self.fail = fail
+
+    def wait(self):
+        if self.fail:
+            raise RuntimeError('event failed')
+        self.waited = True
+
+
+def _clear_fake_device_info():
+    _device_profile_info.pop('fake_knl', None)
+    _device_profile_info.pop('fake_scan', None)
+
+
+def test_device_events_are_read_lazily():
+    # Given
+    event = FakeEvent(0, 1000, 3000, 10000)
+    marker = FakeEvent(20000, 21000, 22000, 22000)
+    last = FakeEvent(22500, 23000, 30000, 42000)
+
+    try:
+        # When
+        record_device_event('fake_knl', event)
+        record_device_event('fake_scan', last, first=marker)
+
+        # Then
+        assert not event.waited
+        info = get_device_profile_info()
+        assert event.waited and last.waited
+        data = info['fake_knl']
+        assert data['calls'] == 1
+        assert np.isclose(data['queued'], 1e-6)
+        assert np.isclose(data['submit'], 2e-6)
+        assert np.isclose(data['time'], 7e-6)
+        data = info['fake_scan']
+        assert np.isclose(data['queued'], 1e-6)
+        assert np.isclose(data['submit'], 1e-6)
+        assert np.isclose(data['time'], 20e-6)
+
+        # When
+        get_device_profile_info()
+
+        # Then
+        assert info['fake_knl']['calls'] == 1
+    finally:
+        _clear_fake_device_info()
+
+
+def test_device_event_that_fails_is_not_read_again():
+    # Given
+    event = FakeEvent(0, 1000, 3000, 10000)
+    broken = FakeEvent(0, 1000, 3000, 10000, fail=True)
+
+    try:
+        # When
+        record_device_event('fake_knl', event)
+        record_device_event('fake_scan', broken)
+        with raises(RuntimeError):
+            get_device_profile_info()
+        info = get_device_profile_info()
+
+        # Then
+        assert info['fake_knl']['calls'] == 1
+        assert 'fake_scan' not in info
+    finally:
+        _clear_fake_device_info()
+
+
+def test_device_timing_opencl():
+    importorskip('pyopencl')
+    import pyopencl as cl
+    from ..opencl import get_context, get_queue, set_queue
+    from ..parallel import Elementwise, Reduction, Scan
+
+    @annotate(i='int', x='doublep')
+    def device_timed(i, x):
+        x[i] = 2.0*x[i]
+
+    @annotate(i='int', x='doublep', return_='double')
+    def device_timed_input(i, x):
+        return x[i]
+
+    @annotate(i='int', item='double', x='doublep')
+    def device_timed_output(i, item, x):
+        x[i] = item
+
+    orig_queue = get_queue()
+    set_queue(cl.CommandQueue(
+        get_context(), properties=cl.command_queue_properties.PROFILING_ENABLE
+    ))
+    try:
+        with use_config(profile=True):
+            x = ones(1000, np.float64, backend='opencl')
+            e = Elementwise(device_timed, backend='opencl')
+            r = Reduction('a+b', backend='opencl')
+            scan = Scan(device_timed_input, device_timed_output, 'a+b',
+                        dtype=np.float64, backend='opencl')
+
+            # When
+            e(x)
+            r(x)
+            scan(x=x)
+
+        # Then
+        info = get_device_profile_info()
+        for knl in (e, r, scan):
+            data = info[knl.name]
+            assert data['calls'] >= 1
+            assert data['time'] > 0.0
+    finally:
+        set_queue(orig_queue)
@@ -1535,6 +1535,69 @@ def test_atomic_dec_works():
     assert code.strip() == expect.strip()
 
 
+def test_atomic_add_min_max_use_the_type_of_the_argument():
+    # Given
+    @annotate(i='int', x='gfloatp', y='gdoublep')
+    def f(i, x, y):
+        atomic_add(x[0], 1.0)
+        atomic_min(y[i], x[i])
+
+    @annotate(i='int', n='gintp', m='glongp')
+    def g(i, n, m):
+        atomic_min(n[i], 2)
+        atomic_max(m[0], n[i])
+
+    # When
+    with use_config(use_double=True):
+        t = OpenCLConverter()
+        code_f = t.parse_function(f)
+        code_g = t.parse_function(g)
+
+    # Then
+    expect_f = dedent('''
+    WITHIN_KERNEL void f(int i, GLOBAL_MEM float* x, GLOBAL_MEM double* y)
+    {
+        atomic_add_float(&x[0], 1.0);
+        atomic_min_double(&y[i], x[i]);
+    }
+    ''')
+    expect_g = dedent('''
+    WITHIN_KERNEL void g(int i, GLOBAL_MEM int* n, GLOBAL_MEM long* m)
+    {
+        atomic_min(&n[i], 2);
+        atom_max(&m[0], n[i]);
+    }
+    ''')
+
+    assert code_f.strip() == expect_f.strip()
+    assert code_g.strip() == expect_g.strip()
+
+    # When
+    with use_config(use_double=True):
+        t = CUDAConverter()
+        code_f = t.parse_function(f)
+        code_g = t.parse_function(g)
+
+    # Then
+    expect_f = dedent('''
+    WITHIN_KERNEL void f(int i, GLOBAL_MEM float* x, GLOBAL_MEM double* y)
+    {
+        atomicAdd(&x[0], 1.0);
+        atomic_min_double(&y[i], x[i]);
+    }
+    ''')
+    expect_g = dedent('''
+    WITHIN_KERNEL void g(int i, GLOBAL_MEM int* n, GLOBAL_MEM long* m)
+    {
+        atomicMin(&n[i], 2);
+        atomicMax((long long *) &m[0], (long long) (n[i]));
+    }
+    ''')
+
+    assert code_f.strip() == expect_f.strip()
+    assert code_g.strip() == expect_g.strip()
+
+
 def test_cast_works():
     # Given
     def f(x=1.0):
@@ -129,6 +129,11 @@ class CStructHelper(object):
         return t.render(class_name=self.name, vars=self.vars)
 
 
+ATOMIC_FUNCTIONS = (
+    'atomic_inc', 'atomic_dec', 'atomic_add', 'atomic_min', 'atomic_max'
+)
+
+
 class CConverter(ast.NodeVisitor):
     def __init__(self, detect_type=detect_type, known_types=None):
         self._use_double = get_config().use_double
@@ -149,6 +154,7 @@ class CConverter(ast.NodeVisitor):
         self._added_loop_vars = set()
         self._annotations = {}
         self._declarations = None
+        self._var_types = {}
         self._ignore_methods = []
         self._replacements = {
             'True': '1', 'False': '0', 'None': 'NULL',
@@ -204,6 +210,7 @@ class CConverter(ast.NodeVisitor):
         for arg in args:
             value = call_args[arg]
             type = self._detect_type(arg, value)
+            self._var_types[arg] = type
             if 'LOCAL_MEM' in type:
                 arg, type = self._get_local_arg(arg, type)
             call_sig.append('{type} {arg}'.format(type=type, arg=arg))
@@ -320,7 +327,35 @@ class CConverter(ast.NodeVisitor):
         self._declarations = None
         return code
 
-    def render_atomic(self, func, arg):
+    def _get_atomic_args(self, func, args):
+        """Return the variable updated by an atomic function, its C type and
+        the other arguments.
+        """
+        n_args = 1 if func in ('atomic_inc', 'atomic_dec') else 2
+        if func not in ATOMIC_FUNCTIONS or len(args) != n_args:
+            raise NotImplementedError(
+                'Only atomic_inc(x), atomic_dec(x), atomic_add(x, value), '
+                'atomic_min(x, value) and atomic_max(x, value) are supported.'
+            )
+        node = args[0]
+        n_index = 0
+        while isinstance(node, ast.Subscript):
+            node = node.value
+            n_index += 1
+        type = 'int'
+        if isinstance(node, ast.Name):
+            type = self._var_types.get(node.id, type)
+        words = [x for x in type.replace('*', ' * ').split()
+                 if x not in ('GLOBAL_MEM', 'LOCAL_MEM', 'volatile')]
+        for i in range(n_index):
+            if words and words[-1] == '*':
+                words.pop()
+        type = ' '.join(words)
+        if type == 'double' and not self._use_double:
+            type = 'float'
+        return self.visit(args[0]), type, [self.visit(x) for x in args[1:]]
+
+    def render_atomic(self, func, args):
         raise NotImplementedError(
             "Atomics only supported by CUDA/OpenCL backends")
 
@@ -354,12 +389,15 @@ class CConverter(ast.NodeVisitor):
             if not isinstance(right.args[0], ast.Str):
                 self.error("Argument to declare should be a string.", node)
             type = right.args[0].s
+            ctype = get_declare_info(type)[2]
             if isinstance(left, ast.Name):
                 self._known.add(left.id)
+                self._var_types[left.id] = ctype
                 return self._get_variable_declaration(type, [self.visit(left)])
             elif isinstance(left, ast.Tuple):
                 names = [x.id for x in left.elts]
                 self._known.update(names)
+                self._var_types.update((x, ctype) for x in names)
                 return self._get_variable_declaration(type, names)
 
         return '%s = %s;' % (self.visit(left), self.visit(right))
@@ -393,7 +431,7 @@ class CConverter(ast.NodeVisitor):
             if node.func.id == 'address':
                 return '(&%s)' % self.visit(node.args[0])
             elif 'atomic' in node.func.id:
-                return self.render_atomic(node.func.id, node.args[0])
+                return self.render_atomic(node.func.id, node.args)
             elif node.func.id == 'cast':
                 return '(%s) (%s)' % (node.args[1].s, self.visit(node.args[0]))
             else:
@@ -582,6 +620,8 @@ class CConverter(ast.NodeVisitor):
             return ''
 
         self._for_count = 0
+        orig_var_types = self._var_types
+        self._var_types = {}
         orig_declares = self._declares
         self._declares = {} if not self._declarations else self._declarations
         orig_known = set(self._known)
@@ -612,6 +652,7 @@ class CConverter(ast.NodeVisitor):
         ))
         self._known = orig_known
         self._declares = orig_declares
+        self._var_types = orig_var_types
         return sig + '\n{\n' + local_decl + declares + body + '\n}\n'
 
     def visit_Gt(self, node):
@@ -788,14 +829,17 @@ class OpenCLConverter(CConverter):
     def _get_self_type(self):
         return KnownType('GLOBAL_MEM %s*' % self._class_name)
 
-    def render_atomic(self, func, arg):
-        if func == 'atomic_inc':
-            return 'atomic_inc(&%s)' % self.visit(arg)
-        elif func == 'atomic_dec':
-            return 'atomic_dec(&%s)' % self.visit(arg)
+    def render_atomic(self, func, args):
+        var, type, rest = self._get_atomic_args(func, args)
+        if func in ('atomic_inc', 'atomic_dec'):
+            return '%s(&%s)' % (func, var)
+        if type in ('float', 'double'):
+            # Emulated with a compare and swap, see OCL_ATOMICS.
+            return '%s_%s(&%s, %s)' % (func, type, var, rest[0])
+        elif 'long' in type:
+            return 'atom_%s(&%s, %s)' % (func[7:], var, rest[0])
         else:
-            raise NotImplementedError(
-                "Only atomic_inc, atomic_dec supported right now")
+            return '%s(&%s, %s)' % (func, var, rest[0])
 
 
 class CUDAConverter(OpenCLConverter):
@@ -841,11 +885,22 @@ class CUDAConverter(OpenCLConverter):
             local_decl += '\n'
         return local_decl
 
-    def render_atomic(self, func, arg):
+    def render_atomic(self, func, args):
+        var, type, rest = self._get_atomic_args(func, args)
         if func == 'atomic_inc':
-            return 'atomicAdd(&%s, 1)' % self.visit(arg)
+            return 'atomicAdd(&%s, 1)' % var
         elif func == 'atomic_dec':
-            return 'atomicAdd(&%s, -1)' % self.visit(arg)
+            return 'atomicAdd(&%s, -1)' % var
+        cuda_func = 'atomic' + func[7:].capitalize()
+        if 'long' in type:
+            # CUDA only has the 64 bit atomics for long long.
+            ll_type = 'unsigned long long' if 'unsigned' in type or \
+                func == 'atomic_add' else 'long long'
+            return '%s((%s *) &%s, (%s) (%s))' % (
+                cuda_func, ll_type, var, ll_type, rest[0]
+            )
+        elif type in ('float', 'double') and func != 'atomic_add':
+            # Emulated with a compare and swap, see CUDA_ATOMICS.
+            return '%s_%s(&%s, %s)' % (func, type, var, rest[0])
         else:
-            raise NotImplementedError(
-                "Only atomic_inc, atomic_dec supported right now")
+            return '%s(&%s, %s)' % (cuda_func, var, rest[0])
@@ -10,8 +10,9 @@ from .config import get_config
 from .ast_utils import get_unknown_names_and_calls
 from .cython_generator import CythonGenerator, CodeGenerationError
 from .translator import OpenCLConverter, CUDAConverter, literal_to_float
-from .ext_module import ExtModule
+from .ext_module import ExtModule, get_md5
 from .extern import Extern, get_extern_code
+from .profile import build_phase, profile, update_build_record
 from .utils import getsourcelines
 
 BUILTINS = set(
@@ -34,6 +35,176 @@ CY_BUILTIN_SYMBOLS = BUILTIN_SYMBOLS | set(
 
 OCL_BUILTIN_SYMBOLS = BUILTIN_SYMBOLS | set(['MAXFLOAT'])
 
+# Lock-free atomics for the Cython backend with OpenMP.  The GCC/Clang atomic
+# builtins are used when they are available and an OpenMP critical section
+# otherwise.  Integers of at least 32 bits are added with a fetch and add,
+# the other operations and the other types use compare and swap loops.
+CY_ATOMICS = dedent('''
+cdef extern from *:
+    """
+    #include <string.h>
+    #if defined(__GNUC__) || defined(__clang__)
+    #define COMPYLE_FETCH_ADD(ptr, val, old) (*(old) = __atomic_fetch_add(\\
+        (ptr), (val), __ATOMIC_SEQ_CST))
+    #define COMPYLE_CAS(ptr, old, new_) __atomic_compare_exchange(\\
+        (ptr), (old), (new_), 0, __ATOMIC_SEQ_CST, __ATOMIC_SEQ_CST)
+    #else
+    #ifdef _MSC_VER
+    #define COMPYLE_CRITICAL __pragma(omp critical(compyle_atomic))
+    #else
+    #define COMPYLE_CRITICAL _Pragma("omp critical(compyle_atomic)")
+    #endif
+    #define COMPYLE_FETCH_ADD(ptr, val, old) do {\\
+        COMPYLE_CRITICAL { *(old) = *(ptr); *(ptr) += (val); }\\
+    } while (0)
+    static int compyle_cas(void *ptr, void *old, void *new_, size_t size)
+    {
+        int done;
+        COMPYLE_CRITICAL
+        {
+            done = memcmp(ptr, old, size) == 0;
+            if (done) memcpy(ptr, new_, size);
+            else memcpy(old, ptr, size);
+        }
+        return done;
+    }
+    #define COMPYLE_CAS(ptr, old, new_) compyle_cas(\\
+        (ptr), (old), (new_), sizeof(*(ptr)))
+    #endif
+    """
+    void COMPYLE_FETCH_ADD(...) nogil
+    bint COMPYLE_CAS(...) nogil
+
+# The types narrower than an int, these are added with a compare and swap.
+ctypedef unsigned char compyle_uchar
+ctypedef unsigned short compyle_ushort
+
+ctypedef fused compyle_atomic_t:
+    char
+    compyle_uchar
+    short
+    compyle_ushort
+    int
+    unsigned int
+    long
+    unsigned long
+    long long
+    unsigned long long
+    float
+    double
+
+cdef inline compyle_atomic_t compyle_atomic_add(
+        compyle_atomic_t *ptr, compyle_atomic_t val) noexcept nogil:
+    cdef compyle_atomic_t old
+    cdef compyle_atomic_t new_
+    if (compyle_atomic_t is float or compyle_atomic_t is double or
+            compyle_atomic_t is char or compyle_atomic_t is compyle_uchar or
+            compyle_atomic_t is short or compyle_atomic_t is compyle_ushort):
+        old = ptr[0]
+        new_ = <compyle_atomic_t>(old + val)
+        while not COMPYLE_CAS(ptr, &old, &new_):
+            new_ = <compyle_atomic_t>(old + val)
+    else:
+        COMPYLE_FETCH_ADD(ptr, val, &old)
+    return old
+
+cdef inline compyle_atomic_t compyle_atomic_inc(
+        compyle_atomic_t *ptr) noexcept nogil:
+    return compyle_atomic_add(ptr, 1)
+
+cdef inline compyle_atomic_t compyle_atomic_dec(
+        compyle_atomic_t *ptr) noexcept nogil:
+    return compyle_atomic_add(ptr, <compyle_atomic_t>-1)
+
+cdef inline compyle_atomic_t compyle_atomic_min(
+        compyle_atomic_t *ptr, compyle_atomic_t val) noexcept nogil:
+    cdef compyle_atomic_t old = ptr[0]
+    while val < old:
+        if COMPYLE_CAS(ptr, &old, &val):
+            break
+    return old
+
+cdef inline compyle_atomic_t compyle_atomic_max(
+        compyle_atomic_t *ptr, compyle_atomic_t val) noexcept nogil:
+    cdef compyle_atomic_t old = ptr[0]
+    while val > old:
+        if COMPYLE_CAS(ptr, &old, &val):
+            break
+    return old
+''')
+
+
+# Atomics for floating point values on OpenCL and CUDA are emulated with a
+# compare and swap on the bits of the value.
+OCL_ATOMICS = '''
+#ifdef cl_khr_int64_base_atomics
+#pragma OPENCL EXTENSION cl_khr_int64_base_atomics : enable
+#endif
+
+% for type, itype, cmpxchg in types:
+% if type == 'double':
+#ifdef cl_khr_int64_base_atomics
+% endif
+% for name, expr in ops:
+${type} atomic_${name}_${type}(volatile __global ${type} *ptr, ${type} val)
+{
+    union {${type} f; ${itype} i;} old, new_;
+    do {
+        old.f = *ptr;
+        new_.f = ${expr};
+    } while (${cmpxchg}((volatile __global ${itype} *) ptr,
+                        old.i, new_.i) != old.i);
+    return old.f;
+}
+
+% endfor
+% if type == 'double':
+#endif
+% endif
+% endfor
+'''
+
+CUDA_ATOMICS = '''
+% for type, itype, to_int, to_float in types:
+% for name, cmp in ops:
+__device__ ${type} atomic_${name}_${type}(${type} *ptr, ${type} val)
+{
+    ${itype} *iptr = (${itype} *) ptr;
+    ${itype} old = *iptr, assumed;
+    do {
+        assumed = old;
+        if (!(val ${cmp} ${to_float}(assumed))) break;
+        old = atomicCAS(iptr, assumed, (${itype}) ${to_int}(val));
+    } while (assumed != old);
+    return ${to_float}(old);
+}
+
+% endfor
+% endfor
+'''
+
+
+def get_atomics_code(backend, use_double):
+    """Return the helper functions for the floating point atomics of the
+    given backend.
+    """
+    if backend == 'opencl':
+        types = [('float', 'unsigned int', 'atomic_cmpxchg')]
+        if use_double:
+            types.append(('double', 'unsigned long', 'atom_cmpxchg'))
+        ops = [('add', 'old.f + val'),
+               ('min', 'old.f < val ? old.f : val'),
+               ('max', 'old.f > val ? old.f : val')]
+        template = OCL_ATOMICS
+    else:
+        types = [('float', 'int', '__float_as_int', '__int_as_float')]
+        if use_double:
+            types.append(('double', 'unsigned long long',
+                          '__double_as_longlong', '__longlong_as_double'))
+        ops = [('min', '<'), ('max', '>')]
+        template = CUDA_ATOMICS
+    return Template(text=template).render(types=types, ops=ops)
+
 
 def filter_calls(calls):
     '''Given a set of calls filter out the math and other builtin functions.
@@ -135,8 +306,11 @@ class Transpiler(object):
             Can be one of 'cython', 'opencl', 'cuda' or 'python'
         """
         self.backend = backend
+        self.incl_cluda = incl_cluda
         self.blocks = []
         self.mod = None
+        # The ExtModule used for the cython backend.
+        self.ext_module = None
         self._use_double = get_config().use_double
         if os.environ.get('COMPYLE_DEBUG') is not None:
             self._debug = True
@@ -159,10 +333,7 @@ class Transpiler(object):
             if get_config().use_openmp:
                 self.header += dedent('''
                 cimport openmp
-
-                cdef openmp.omp_lock_t cy_lock
-                openmp.omp_init_lock(&cy_lock)
-                ''')
+                ''') + CY_ATOMICS
 
         elif backend == 'opencl':
             from pyopencl._cluda import CLUDA_PREAMBLE
@@ -182,6 +353,7 @@ class Transpiler(object):
             #endif
 
             '''.format(fp32='' if self._use_double else 'f'))
+            self.header += get_atomics_code(backend, self._use_double)
         elif backend == 'cuda':
             from pycuda._cluda import CLUDA_PREAMBLE
             self._cgen = CUDAConverter()
@@ -193,7 +365,7 @@ class Transpiler(object):
             self.header = cluda + dedent('''
             #define max(x, y) fmax((double)(x), (double)(y))
 
-            ''')
+            ''') + get_atomics_code(backend, self._use_double)
 
     def _handle_symbol(self, name, value):
         backend = self.backend
@@ -269,6 +441,7 @@ class Transpiler(object):
         for f in calls:
             self.add(f, declarations=declarations)
 
+    @build_phase('transpile')
     def add(self, obj, declarations=None):
         if obj in self.blocks:
             return
@@ -297,24 +470,29 @@ class Transpiler(object):
         code = [self.header] + [x.code for x in self.blocks]
         return '\n'.join(code)
 
+    @profile(name='compile', category='compile')
     def compile(self):
         if self.backend == 'cython':
             self.source = self.get_code()
-            mod = ExtModule(self.source)
-            self.mod = mod.load()
+            self.ext_module = ExtModule(self.source)
+            self.mod = self.ext_module.load()
         elif self.backend == 'opencl':
             import pyopencl as cl
             from .opencl import get_context
             ctx = get_context()
             self.source = convert_to_float_if_needed(self.get_code())
-            self.mod = cl.Program(ctx, self.source).build(
-                options=['-w']
-            )
+            update_build_record(source_hash=get_md5(self.source))
+            with build_phase('compile'):
+                self.mod = cl.Program(ctx, self.source).build(
+                    options=['-w']
+                )
         elif self.backend == 'cuda':
             import pycuda as cu
             from pycuda.compiler import SourceModule
             self.source = convert_to_float_if_needed(self.get_code())
-            self.mod = SourceModule(self.source)
+            update_build_record(source_hash=get_md5(self.source))
+            with build_phase('compile'):
+                self.mod = SourceModule(self.source)
 
         if self._debug:
             print(self.source)
@@ -1,9 +1,9 @@
 from nnps_kernels import *
 from compyle.config import get_config
 from compyle.api import declare, annotate
-from compyle.parallel import serial, Elementwise, Reduction, Scan
+from compyle.parallel import Elementwise, Histogram, Reduction, Scan
 from compyle.array import get_backend, wrap
-from compyle.low_level import atomic_inc, cast
+from compyle.low_level import cast
 from math import floor
 from time import time
 
@@ -61,6 +61,7 @@ class NNPS(object):
                                      backend=self.backend)
         self.nbrs = carr.zeros(2 * self.num_particles, dtype=np.int32,
                                backend=self.backend)
+        self.total = carr.zeros(1, dtype=np.int32, backend=self.backend)
 
     def reset_arrays(self):
         # sort arrays
@@ -78,8 +79,9 @@ class NNPS(object):
                                    self.sorted_indices, self.bin_counts,
                                    self.nbr_lengths, self.max_key)
         self.scan_start_indices(counts=self.nbr_lengths,
-                                indices=self.nbr_starts)
-        self.total_neighbors = int(self.nbr_lengths[-1] + self.nbr_starts[-1])
+                                indices=self.nbr_starts,
+                                aggregate=self.total)
+        self.total_neighbors = int(self.total[0])
         self.nbrs.resize(self.total_neighbors)
         self.find_neighbors(self.x, self.y, self.z, self.h, self.eps, self.qmax,
                             self.rmax, self.start_indices, self.sorted_indices,
@@ -96,7 +98,7 @@ class NNPSCountingSort(NNPS):
     def __init__(self, x, y, z, h, eps, xmax, ymax, zmax, backend=None):
         super().__init__(x, y, z, h, eps, xmax, ymax, zmax, backend=backend)
         # sort kernels
-        self.count_bins = Elementwise(count_bins, backend=self.backend)
+        self.count_bins = Histogram(count_bins, backend=self.backend)
         self.sort_indices = Elementwise(sort_indices, backend=self.backend)
 
     def init_arrays(self):
@@ -112,8 +114,8 @@ class NNPSCountingSort(NNPS):
     def build(self):
         self.reset_arrays()
         self.count_bins(self.x, self.y, self.z, self.h, self.eps, self.qmax,
-                        self.rmax, self.keys, self.bin_counts,
-                        self.sort_offsets)
+                        self.rmax, self.keys, counts=self.bin_counts,
+                        ranks=self.sort_offsets)
         self.scan_start_indices(counts=self.bin_counts,
                                 indices=self.start_indices)
         self.sort_indices(self.keys, self.sort_offsets, self.start_indices,
@@ -181,8 +183,9 @@ class NNPSCountingSortPeriodic(NNPSCountingSort):
                                    self.sorted_indices, self.bin_counts,
                                    self.nbr_lengths, self.max_key)
         self.scan_start_indices(counts=self.nbr_lengths,
-                                indices=self.nbr_starts)
-        self.total_neighbors = int(self.nbr_lengths[-1] + self.nbr_starts[-1])
+                                indices=self.nbr_starts,
+                                aggregate=self.total)
+        self.total_neighbors = int(self.total[0])
         self.nbrs.resize(self.total_neighbors)
         self.find_neighbors(self.x, self.y, self.z, self.h, self.eps,
                             self.xmax, self.ymax, self.zmax,
@@ -214,8 +217,9 @@ class NNPSRadixSortPeriodic(NNPSRadixSort):
                                    self.sorted_indices, self.bin_counts,
                                    self.nbr_lengths, self.max_key)
         self.scan_start_indices(counts=self.nbr_lengths,
-                                indices=self.nbr_starts)
-        self.total_neighbors = int(self.nbr_lengths[-1] + self.nbr_starts[-1])
+                                indices=self.nbr_starts,
+                                aggregate=self.total)
+        self.total_neighbors = int(self.total[0])
         self.nbrs.resize(self.total_neighbors)
         self.find_neighbors(self.x, self.y, self.z, self.h, self.eps,
                             self.xmax, self.ymax, self.zmax,
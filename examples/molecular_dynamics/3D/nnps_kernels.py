@@ -1,6 +1,5 @@
 from compyle.api import declare, annotate
-from compyle.parallel import serial
-from compyle.low_level import atomic_inc, cast
+from compyle.low_level import cast
 from math import floor
 import numpy as np
 
@@ -17,16 +16,13 @@ def flatten(p, q, r, qmax, rmax):
     return (p * qmax + q) * rmax + r
 
 
-@serial
 @annotate
-def count_bins(i, x, y, z, h, eps, qmax, rmax, keys, bin_counts,
-               sort_offsets):
+def count_bins(i, x, y, z, h, eps, qmax, rmax, keys):
     c = declare('matrix(3, "int")')
     find_cell_id(x[i], y[i], z[i], h, eps, c)
     key = flatten(c[0], c[1], c[2], qmax, rmax)
     keys[i] = key
-    idx = atomic_inc(bin_counts[key])
-    sort_offsets[i] = idx
+    return key
 
 
 @annotate
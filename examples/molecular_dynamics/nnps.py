@@ -1,9 +1,9 @@
 from nnps_kernels import *
 from compyle.config import get_config
 from compyle.api import declare, annotate
-from compyle.parallel import serial, Elementwise, Reduction, Scan
+from compyle.parallel import Elementwise, Histogram, Reduction, Scan
 from compyle.array import get_backend, wrap
-from compyle.low_level import atomic_inc, cast
+from compyle.low_level import cast
 from math import floor
 from time import time
 
@@ -51,6 +51,7 @@ class NNPS(object):
                                      backend=self.backend)
         self.nbrs = carr.zeros(2 * self.num_particles, dtype=np.int32,
                                backend=self.backend)
+        self.total = carr.zeros(1, dtype=np.int32, backend=self.backend)
 
     def reset_arrays(self):
         # sort arrays
@@ -68,8 +69,9 @@ class NNPS(object):
                                    self.bin_counts, self.nbr_lengths,
                                    self.max_key)
         self.scan_start_indices(counts=self.nbr_lengths,
-                                indices=self.nbr_starts)
-        self.total_neighbors = int(self.nbr_lengths[-1] + self.nbr_starts[-1])
+                                indices=self.nbr_starts,
+                                aggregate=self.total)
+        self.total_neighbors = int(self.total[0])
         self.nbrs.resize(self.total_neighbors)
         self.find_neighbors(self.x, self.y, self.h, self.qmax,
                             self.start_indices, self.sorted_indices,
@@ -81,7 +83,7 @@ class NNPSCountingSort(NNPS):
     def __init__(self, x, y, h, xmax, ymax, backend=None):
         super().__init__(x, y, h, xmax, ymax, backend=backend)
         # sort kernels
-        self.count_bins = Elementwise(count_bins, backend=self.backend)
+        self.count_bins = Histogram(count_bins, backend=self.backend)
         self.sort_indices = Elementwise(sort_indices, backend=self.backend)
 
     def init_arrays(self):
@@ -97,7 +99,7 @@ class NNPSCountingSort(NNPS):
     def build(self):
         self.reset_arrays()
         self.count_bins(self.x, self.y, self.h, self.qmax, self.keys,
-                        self.bin_counts, self.sort_offsets)
+                        counts=self.bin_counts, ranks=self.sort_offsets)
         self.scan_start_indices(counts=self.bin_counts,
                                 indices=self.start_indices)
         self.sort_indices(self.keys, self.sort_offsets, self.start_indices,
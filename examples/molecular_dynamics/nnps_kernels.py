@@ -1,6 +1,5 @@
 from compyle.api import declare, annotate
-from compyle.parallel import serial
-from compyle.low_level import atomic_inc, cast
+from compyle.low_level import cast
 from math import floor
 import numpy as np
 
@@ -16,16 +15,13 @@ def flatten(p, q, qmax):
     return p * qmax + q
 
 
-@serial
 @annotate
-def count_bins(i, x, y, h, cmax, keys, bin_counts,
-               sort_offsets):
+def count_bins(i, x, y, h, cmax, keys):
     c = declare('matrix(2, "int")')
     find_cell_id(x[i], y[i], h, c)
     key = flatten(c[0], c[1], cmax)
     keys[i] = key
-    idx = atomic_inc(bin_counts[key])
-    sort_offsets[i] = idx
+    return key
 
 
 @annotate